@@ -0,0 +1,171 @@
+import gzip
+import hashlib
+import os
+
+from email.utils import formatdate
+from string import Template
+
+CONTENT_TYPES = {
+    '.js': 'application/javascript',
+    '.css': 'text/css',
+    '.html': 'text/html; charset=utf-8',
+}
+
+ASSET_DIRECTORIES = ('js', 'css')
+INDEX_FILE = 'index.html'
+
+#region Asset
+class Asset(object):
+    """
+    A cached file (or rendered index.html) with its precompressed body, ETags and
+    headers. filename is None for rendered files, which can't be sent with
+    sendfile.
+    """
+    def __init__(self, path, content_type, body, mtime, filename=None):
+        self.path = path
+        self.content_type = content_type
+        self.body = body
+        self.mtime = mtime
+        self.filename = filename
+        self.etag = '"%s"' % hashlib.sha1(body).hexdigest()[:16]
+        self.last_modified = formatdate(mtime, usegmt=True)
+
+        # keep the compressed body only if it is smaller
+        compressed = gzip.compress(body, 9, mtime=0)
+        if len(compressed) < len(body):
+            self.gzip_body = compressed
+            self.gzip_etag = self.etag[:-1] + '-gz"'
+        else:
+            self.gzip_body = None
+            self.gzip_etag = None
+
+    def response(self, request_headers):
+        """
+        Returns the response for the request headers (lower case names) as tuple
+        (status, headers, body, filename). Either body is set or filename (send
+        the file with sendfile), both are None for 304 Not Modified.
+        """
+        use_gzip = (self.gzip_body is not None
+                    and 'gzip' in request_headers.get('accept-encoding', ''))
+        etag = self.gzip_etag if use_gzip else self.etag
+        headers = [('Content-Type', self.content_type),
+                   ('ETag', etag),
+                   ('Last-Modified', self.last_modified),
+                   ('Cache-Control', 'no-cache'),
+                   ('Vary', 'Accept-Encoding')]
+
+        if etag_matches(request_headers.get('if-none-match'), etag):
+            return 304, headers, None, None
+        if use_gzip:
+            headers.append(('Content-Encoding', 'gzip'))
+            headers.append(('Content-Length', len(self.gzip_body)))
+            return 200, headers, self.gzip_body, None
+        headers.append(('Content-Length', len(self.body)))
+        if self.filename is not None:
+            return 200, headers, None, self.filename
+        return 200, headers, self.body, None
+
+
+def etag_matches(if_none_match, etag):
+    """
+    Returns True, if the If-None-Match header contains the ETag (or *).
+    """
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags or ('W/' + etag) in tags
+#endregion
+
+#region AssetCache
+class AssetCache(object):
+    """
+    In-memory cache for the files of the web client (index.html, js, css). All
+    files are loaded (and compressed) once at startup. An asset is reloaded when
+    the modification time of its file changes. index.html is rendered once per
+    server address (the template contains the websocket address).
+    """
+    def __init__(self, ws_port, root='.'):
+        self.ws_port = ws_port
+        self.root = root
+        self.assets = {}            # path -> Asset
+        self.index = {}             # server address -> rendered index.html
+        self.index_template = None
+        self.index_mtime = None
+
+        for directory in ASSET_DIRECTORIES:
+            for name in sorted(os.listdir(os.path.join(root, directory))):
+                self.load('/%s/%s' % (directory, name))
+
+    def filename(self, path):
+        """
+        Returns the filename of a static file path (/js/..., /css/...) or None, if
+        the path isn't allowed.
+        """
+        filename = os.path.normpath(path.lstrip('/'))
+        directory, separator, name = filename.partition(os.sep)
+        if (not separator or directory not in ASSET_DIRECTORIES
+                or os.path.splitext(name)[1] not in CONTENT_TYPES):
+            return None
+        return os.path.join(self.root, filename)
+
+    def load(self, path):
+        """
+        Loads the file of a static file path into the cache. Returns the asset or
+        None, if the path isn't allowed or the file doesn't exist.
+        """
+        filename = self.filename(path)
+        if filename is None:
+            return None
+        try:
+            with open(filename, 'rb') as f:
+                mtime = os.fstat(f.fileno()).st_mtime
+                body = f.read()
+        except OSError:
+            self.assets.pop(path, None)
+            return None
+        content_type = CONTENT_TYPES[os.path.splitext(filename)[1]]
+        asset = Asset(path, content_type, body, mtime, filename)
+        self.assets[path] = asset
+        return asset
+
+    def get(self, path, address):
+        """
+        Returns the asset of a request path or None (404). address is the local
+        address of the connection (for index.html).
+        """
+        path = path.split('?', 1)[0]
+        if path == '/index.html':
+            return self.get_index(address)
+
+        asset = self.assets.get(path)
+        if asset is None:
+            return self.load(path)
+        try:
+            if os.stat(asset.filename).st_mtime != asset.mtime:
+                return self.load(path)
+        except OSError:
+            self.assets.pop(path, None)
+            return None
+        return asset
+
+    def get_index(self, address):
+        """
+        Returns index.html rendered for the server address.
+        """
+        filename = os.path.join(self.root, INDEX_FILE)
+        mtime = os.stat(filename).st_mtime
+        if mtime != self.index_mtime:
+            with open(filename, 'r') as f:
+                self.index_template = Template(f.read())
+            self.index_mtime = mtime
+            self.index.clear()
+
+        asset = self.index.get(address)
+        if asset is None:
+            content = self.index_template.safe_substitute(dict(
+                ADDRESS='%s:%d' % (address, self.ws_port)
+                )).encode('utf-8')
+            asset = Asset('/index.html', CONTENT_TYPES['.html'], content, mtime)
+            self.index[address] = asset
+        return asset
+#endregion
@@ -0,0 +1,380 @@
+import asyncio
+import base64
+import hashlib
+import struct
+import config
+import metrics
+
+from assetcache import AssetCache
+from framequeue import AsyncClientFrameQueue
+from telemetrystream import AsyncTelemetryClient, SCHEMA, TELEMETRY_PATH, client_rate
+
+#region http helpers
+REASONS = {
+    101: 'Switching Protocols',
+    200: 'OK',
+    301: 'Moved Permanently',
+    304: 'Not Modified',
+    400: 'Bad Request',
+    404: 'Not Found',
+    501: 'Not Implemented',
+}
+
+async def read_request(reader):
+    """
+    Reads the head of an HTTP request and returns the tuple (method, path, headers)
+    with lower case header names. Returns None, if the connection was closed or the
+    request is invalid.
+    """
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        return None
+    lines = head.decode('latin-1').split('\r\n')
+    try:
+        method, path, version = lines[0].split(' ', 2)
+    except ValueError:
+        return None
+    headers = {}
+    for line in lines[1:]:
+        name, separator, value = line.partition(':')
+        if separator:
+            headers[name.strip().lower()] = value.strip()
+    return method, path, headers
+
+
+def response_head(status, headers=()):
+    """
+    Returns the head of an HTTP response (status line and headers) as bytes.
+    """
+    lines = ['HTTP/1.1 %d %s' % (status, REASONS.get(status, ''))]
+    lines.extend('%s: %s' % header for header in headers)
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+#endregion
+
+#region AsyncHttpServer
+class AsyncHttpServer(object):
+    """
+    HTTP server for the web client (index.html, js, css) on the event loop. Serves
+    the same paths as StreamingHttpHandler from the asset cache.
+    """
+    def __init__(self):
+        """
+        Constructor: preloads index.html, js and css into the asset cache.
+        """
+        self.asset_cache = AssetCache(config.WS_PORT)
+        self.server = None
+
+    async def start(self):
+        """
+        Starts listening on the HTTP-PORT.
+        """
+        self.server = await asyncio.start_server(self.handle, '', config.HTTP_PORT)
+
+    async def close(self):
+        """
+        Stops listening and waits until the server is closed.
+        """
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        """
+        This method handles the requests of one connection (keep-alive).
+        """
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                method, path, headers = request
+                await self.respond(writer, method, path, headers)
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, method, path, request_headers):
+        """
+        This method responds to HTTP GET and HEAD requests.
+        """
+        if method not in ('GET', 'HEAD'):
+            await self.send(writer, method, 501, [], b'')
+            return
+
+        #Serve index.html
+        if path == '/':
+            await self.send(writer, method, 301, [('Location', '/index.html')], b'')
+            return
+
+        #Serve the metrics (Prometheus text format)
+        if path == '/metrics':
+            await self.send(writer, method, 200, [('Content-Type', metrics.CONTENT_TYPE)],
+                            metrics.render())
+            return
+
+        #Serve index.html, js and css
+        asset = self.asset_cache.get(path, writer.get_extra_info('sockname')[0])
+        if asset is None:
+            await self.send(writer, method, 404, [], b'File not found')
+            return
+        status, headers, body, filename = asset.response(request_headers)
+        if filename is not None and method == 'GET':
+            # zero-copy: the kernel sends the file
+            writer.write(response_head(status, headers))
+            await writer.drain()
+            with open(filename, 'rb') as f:
+                await asyncio.get_running_loop().sendfile(writer.transport, f)
+            return
+        writer.write(response_head(status, headers))
+        if method == 'GET' and body:
+            writer.write(body)
+        await writer.drain()
+
+    async def send(self, writer, method, status, headers, content):
+        """
+        Sends a response, which isn't cached (without body for HEAD requests).
+        """
+        headers = headers + [('Content-Length', len(content))]
+        writer.write(response_head(status, headers))
+        if method == 'GET' and content:
+            writer.write(content)
+        await writer.drain()
+#endregion
+
+#region websocket
+WEBSOCKET_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+MAX_CLIENT_MESSAGE = 65536      # messages from the browser are small (control only)
+
+_HEADER_16 = struct.Struct('!BBH')
+_HEADER_64 = struct.Struct('!BBQ')
+
+def frame_header(opcode, length):
+    """
+    Returns the header of an unmasked, final websocket frame (server -> client).
+    """
+    if length < 126:
+        return bytes((0x80 | opcode, length))
+    if length < 65536:
+        return _HEADER_16.pack(0x80 | opcode, 126, length)
+    return _HEADER_64.pack(0x80 | opcode, 127, length)
+
+
+async def read_frame(reader, max_length=MAX_CLIENT_MESSAGE):
+    """
+    Reads a websocket frame (masked: client -> server, unmasked: server -> client)
+    and returns the tuple (opcode, payload).
+    """
+    byte0, byte1 = await reader.readexactly(2)
+    opcode = byte0 & 0x0F
+    length = byte1 & 0x7F
+    if length == 126:
+        length, = struct.unpack('!H', await reader.readexactly(2))
+    elif length == 127:
+        length, = struct.unpack('!Q', await reader.readexactly(8))
+    if length > max_length:
+        raise ValueError(f'Websocket message too big: {length}')
+    mask = await reader.readexactly(4) if byte1 & 0x80 else None
+    payload = await reader.readexactly(length)
+    if mask is not None and length:
+        # unmask all bytes at once (xor with the repeated mask)
+        key = (mask * (length // 4 + 1))[:length]
+        payload = (int.from_bytes(payload, 'little')
+                   ^ int.from_bytes(key, 'little')).to_bytes(length, 'little')
+    return opcode, payload
+
+
+def accept_key(key):
+    """
+    Returns the Sec-WebSocket-Accept value for the Sec-WebSocket-Key of a client.
+    """
+    return base64.b64encode(hashlib.sha1(key.encode('latin-1') + WEBSOCKET_GUID)
+                            .digest()).decode('latin-1')
+
+
+class AsyncWebSocket(object):
+    """
+    One websocket client of the asyncio server. The messages of its send queue
+    (see framequeue.SendQueue) are sent by a sender task, the receiver task
+    answers pings and the close handshake. The queue is subscribed to its source
+    (StreamingOutput, TelemetryChannel) while the client is connected.
+    """
+    name = 'Client'
+
+    def __init__(self, reader, writer, source, queue, first=None):
+        """
+        Constructor: first is a text message, which is sent before the messages of
+        the queue (e.g. the telemetry schema).
+        """
+        self.reader = reader
+        self.writer = writer
+        self.source = source
+        self.queue = queue
+        self.first = first
+
+    async def run(self):
+        """
+        This method streams the messages until the client disconnects or the queue
+        is closed.
+        """
+        print(f'New {self.name.lower()} connected', flush=True)
+        self.source.subscribe(self.queue)
+        sender = asyncio.create_task(self.send_messages())
+        try:
+            await self.receive()
+        finally:
+            self.source.unsubscribe(self.queue)
+            self.queue.close()
+            await sender
+            print(f'{self.name} disconnected ({self.summary()})', flush=True)
+
+    def summary(self):
+        """
+        Returns the statistics of the client for the log.
+        """
+        return f'messages: {self.queue.sent}'
+
+    async def send_messages(self):
+        """
+        This method sends the queued messages. While the socket is busy (drain),
+        the queue keeps (or drops) the new messages.
+        """
+        writer = self.writer
+        queue = self.queue
+        try:
+            if self.first is not None:
+                first = self.first.encode('utf-8')
+                writer.write(frame_header(OPCODE_TEXT, len(first)) + first)
+            while True:
+                message = await queue.get()
+                if message is None:
+                    break
+                writer.write(frame_header(OPCODE_BINARY, len(message)))
+                writer.write(message)
+                queue.sent += 1
+                await writer.drain()
+        except ConnectionError:
+            queue.close()
+        finally:
+            writer.close()
+
+    async def receive(self):
+        """
+        This method receives the client messages (ping, close) until the client
+        disconnects or the queue is closed.
+        """
+        try:
+            while not self.queue.closed:
+                opcode, payload = await read_frame(self.reader)
+                if opcode == OPCODE_CLOSE:
+                    self.writer.write(frame_header(OPCODE_CLOSE, len(payload[:2]))
+                                      + payload[:2])
+                    break
+                elif opcode == OPCODE_PING:
+                    self.writer.write(frame_header(OPCODE_PONG, len(payload)) + payload)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+
+    def close(self):
+        """
+        This method closes the connection (server shutdown).
+        """
+        if not self.writer.is_closing():
+            self.writer.write(frame_header(OPCODE_CLOSE, 2) + struct.pack('!H', 1001))
+        self.queue.close()
+        self.reader.feed_eof()
+
+
+class AsyncStreamingWebSocket(AsyncWebSocket):
+    """
+    Video client: the frames of the StreamingOutput through a bounded
+    AsyncClientFrameQueue (frames are dropped, while the socket is busy).
+    """
+    def __init__(self, reader, writer, output):
+        super(AsyncStreamingWebSocket, self).__init__(
+            reader, writer, output, AsyncClientFrameQueue(config.WS_QUEUE_SIZE))
+
+    def summary(self):
+        return f'dropped frames: {self.queue.dropped}'
+
+
+class AsyncTelemetryWebSocket(AsyncWebSocket):
+    """
+    Telemetry client (path TELEMETRY_PATH): the schema, then the updates of an
+    AsyncTelemetryClient (at most one per interval, changes in between are
+    merged).
+    """
+    name = 'Telemetry client'
+
+    def __init__(self, reader, writer, channel, rate):
+        super(AsyncTelemetryWebSocket, self).__init__(
+            reader, writer, channel, AsyncTelemetryClient(channel, rate), SCHEMA)
+
+    def summary(self):
+        return f'updates: {self.queue.sent}'
+
+
+class AsyncWebSocketServer(object):
+    """
+    Websocket server for the video stream and the telemetry (path TELEMETRY_PATH)
+    on the event loop (replaces the ws4py server thread).
+    """
+    def __init__(self, output, telemetry=None):
+        self.output = output
+        self.telemetry = telemetry
+        self.server = None
+        self.clients = set()
+
+    async def start(self):
+        """
+        Starts listening on the WS-PORT.
+        """
+        self.server = await asyncio.start_server(self.handle, '', config.WS_PORT)
+
+    async def close(self):
+        """
+        Stops listening, closes all clients and waits until the server is closed.
+        """
+        self.server.close()
+        for client in list(self.clients):
+            client.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        """
+        This method performs the websocket handshake and streams the frames (or the
+        telemetry) to the client.
+        """
+        request = await read_request(reader)
+        key = request[2].get('sec-websocket-key') if request else None
+        if (key is None or request[0] != 'GET'
+                or request[2].get('upgrade', '').lower() != 'websocket'):
+            writer.write(response_head(400, [('Content-Length', 0),
+                                             ('Connection', 'close')]))
+            writer.close()
+            return
+        writer.write(response_head(101, [('Upgrade', 'websocket'),
+                                         ('Connection', 'Upgrade'),
+                                         ('Sec-WebSocket-Accept', accept_key(key))]))
+
+        path, separator, query = request[1].partition('?')
+        if path == TELEMETRY_PATH and self.telemetry is not None:
+            client = AsyncTelemetryWebSocket(reader, writer, self.telemetry,
+                                             client_rate(query, config.WS_TELEMETRY_RATE))
+        else:
+            client = AsyncStreamingWebSocket(reader, writer, self.output)
+        self.clients.add(client)
+        try:
+            await client.run()
+        finally:
+            self.clients.discard(client)
+#endregion
@@ -0,0 +1,1418 @@
+"""
+Micro-benchmarks for the hot paths of the communication server. They run without
+the Raspberry Pi hardware (no camera, no UART), so they can be used on any machine.
+
+Usage:
+    python benchmark.py                 # run all benchmarks
+    python benchmark.py control_packet  # run selected benchmarks
+"""
+import argparse
+import asyncio
+import bisect
+import collections
+import contextlib
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import random
+import select
+import socket
+import struct
+import time
+import timeit
+from io import BytesIO
+from threading import Thread
+
+import icuprotocol
+import metrics
+import flightrecorder
+from broadcast import BroadcastThread
+from camerasource import synthetic_h264
+from communicationdata import CommData, CONTROL_PACKET, CONTROL_PACKET_MAGIC, CONTROL_PACKET_VERSION
+from framequeue import ClientFrameQueue, FrameSender
+from loadtest import percentile, run_load
+from output import StreamingOutput, nal_type, NAL_IDR
+from subscribers import SubscriberRegistry, SUBSCRIBE, encode_subscription
+from telemetrybatch import TelemetryBatcher, TELEMETRY_BATCH_MAGIC, decode_batch
+from telemetrydata import TelemetryData, TelemetryDataEncoder, TelemetrySerializer, TELEMETRY_FRAME
+from telemetrystream import TelemetryChannel, TelemetryClient
+
+
+def report(label, seconds, number):
+    """
+    Prints the cost per operation and the operations per second.
+    """
+    per_op = seconds / number
+    print(f'{label:<40} {per_op * 1e6:9.3f} us/op {1 / per_op:14,.0f} op/s',
+          flush=True)
+
+
+def measure(label, func, number):
+    """
+    Runs func number times (best of 3) and reports the result.
+    """
+    seconds = min(timeit.repeat(func, number=number, repeat=3))
+    report(label, seconds, number)
+    return seconds
+
+
+#region control packet
+def bench_control_packet(args):
+    """
+    Compares the per-packet cost of decoding the JSON control packet with the
+    binary control packet (both into CommData).
+    """
+    commdata = CommData(999, 555, 888, 666, 777, 766, 944)
+    json_packet = json.dumps(dict(commdata)).encode('utf-8')
+    binary_packet = commdata.to_packet(seq=1)
+
+    print(f'JSON packet: {len(json_packet)} Bytes, '
+          f'binary packet: {len(binary_packet)} Bytes', flush=True)
+
+    t_json = measure('decode JSON control packet',
+                     lambda: CommData.from_datagram(json_packet), args.number)
+    t_binary = measure('decode binary control packet',
+                       lambda: CommData.from_datagram(binary_packet), args.number)
+    print(f'speedup: {t_json / t_binary:.1f}x', flush=True)
+#endregion
+
+#region ICU encoder
+def encode_icu_reference(pitch, roll, yaw, power, pitchg, yawg):
+    """
+    The original byte-by-byte implementation of CommData.to_uart_data. Only used as
+    reference for the benchmark.
+    """
+    pitch_arr = pitch.to_bytes(2, 'little')
+    roll_arr = roll.to_bytes(2, 'little')
+    yaw_arr = yaw.to_bytes(2, 'little')
+    power_arr = power.to_bytes(2, 'little')
+    pitchg_arr = pitchg.to_bytes(2, 'little')
+    yawg_arr = yawg.to_bytes(2, 'little')
+
+    byte0 = power_arr[0]
+    byte1 = ((yaw_arr[0]<<3) & 0b11111000) | (power_arr[1] & 0b00000111)
+    byte2 = ((pitch_arr[0]<<6) & 0b11000000) | ((yaw_arr[1]<<3) & 0b00111000) | ((yaw_arr[0]>>5) & 0b00000111)
+    byte3 = ((pitch_arr[1]<<6) & 0b11000000) | ((pitch_arr[0]>>2) & 0b00111111)
+    byte4 = ((roll_arr[0]<<1) & 0b11111110) | ((pitch_arr[1]>>2) & 0b00000001)
+    byte5 = ((yawg_arr[0]<<4) & 0b11110000) | ((roll_arr[1]<<1) & 0b00001110) | ((roll_arr[0]>>7) & 0b00000001)
+    byte6 = ((pitchg_arr[0]<<6) & 0b11000000) | ((yawg_arr[1]<<4) & 0b00110000) | ((yawg_arr[0]>>4) & 0b00001111)
+    byte7 = ((pitchg_arr[1]<<6) & 0b11000000) | ((pitchg_arr[0]>>2) & 0b00111111)
+    return bytearray([byte0, byte1, byte2, byte3, byte4, byte5, byte6, byte7])
+
+
+def bench_icu_encoder(args):
+    """
+    Compares the frames encoded per second of the original byte-by-byte ICU
+    encoder with the packed 64 Bit encoder (with and without preallocated buffer).
+    """
+    values = (999, 555, 888, 666, 777, 944)
+    buffer = bytearray(icuprotocol.FRAME_SIZE)
+
+    t_reference = measure('encode ICU frame (original)',
+                          lambda: encode_icu_reference(*values), args.number)
+    t_encode = measure('encode ICU frame (packed)',
+                       lambda: icuprotocol.encode(*values), args.number)
+    t_into = measure('encode ICU frame (packed, into buffer)',
+                     lambda: icuprotocol.encode_into(buffer, 0, *values), args.number)
+    print(f'speedup: {t_reference / t_encode:.1f}x (into buffer: '
+          f'{t_reference / t_into:.1f}x)', flush=True)
+#endregion
+
+#region telemetry
+TELEMETRY_SAMPLE = (12.5, 23, 25.8, 466, 54, 24, 9.856, 47.58)
+
+
+class DictTelemetryData(object):
+    """
+    The original TelemetryData (attributes in __dict__). Only used as reference for
+    the benchmark.
+    """
+    def __init__(self, timestamp, float_values_tuple):
+        self.TIMESTAMP = timestamp
+        self.BATT_AMP = round(float_values_tuple[0], 6)
+        self.BATT_VOLT = round(float_values_tuple[1], 6)
+        self.BOARD_AMP = round(float_values_tuple[2], 6)
+        self.HYDRO = round(float_values_tuple[3], 6)
+        self.TEMP = round(float_values_tuple[4], 6)
+        self.PRESSURE = round(float_values_tuple[5], 6)
+        self.LONGITUDE = round(float_values_tuple[6], 6)
+        self.LATITUDE = round(float_values_tuple[7], 6)
+
+
+class DictTelemetryDataEncoder(json.JSONEncoder):
+    def default(self, o):
+        return o.__dict__
+
+
+def bench_telemetry(args):
+    """
+    Compares the telemetry messages per second of the original path (format string,
+    struct.unpack, TelemetryData with __dict__, json.dumps), of the precompiled
+    struct with the slotted TelemetryData (json.dumps with TelemetryDataEncoder)
+    and of the compiled serializer (TelemetrySerializer). Like the real sensor
+    values, the values change from sample to sample.
+    """
+    rng = random.Random(0)
+    frames = [TELEMETRY_FRAME.pack(*(value * rng.uniform(0.9, 1.1)
+                                     for value in TELEMETRY_SAMPLE)) for _ in range(4096)]
+    timestamp = time.time()
+    changing = itertools.cycle(frames)
+
+    def original():
+        floats = struct.unpack('<' + 'f' * 8, next(changing))
+        teldata = DictTelemetryData(timestamp, floats)
+        return json.dumps(teldata, cls=DictTelemetryDataEncoder).encode('utf-8')
+
+    def slots():
+        teldata = TelemetryData.from_bytes(timestamp, next(changing))
+        return json.dumps(teldata, cls=TelemetryDataEncoder).encode('utf-8')
+
+    serializer = TelemetrySerializer()
+
+    def compiled():
+        return serializer.serialize(timestamp, TELEMETRY_FRAME.unpack(next(changing)))
+
+    for frame in frames:
+        expected = json.dumps(TelemetryData.from_bytes(timestamp, frame),
+                              cls=TelemetryDataEncoder).encode('utf-8')
+        assert serializer.serialize(timestamp, TELEMETRY_FRAME.unpack(frame)) == expected
+    t_original = measure('telemetry message (original)', original, args.number)
+    t_slots = measure('telemetry message (slots, json.dumps)', slots, args.number)
+    t_compiled = measure('telemetry message (compiled serializer)', compiled, args.number)
+    print(f'speedup: {t_original / t_slots:.1f}x (slots), '
+          f'{t_original / t_compiled:.1f}x (compiled)', flush=True)
+
+
+def bench_telemetry_batch(args):
+    """
+    Simulates one second of telemetry at several Teensy rates and reports the
+    datagrams (= sendto syscalls) and the bytes on the wire (incl. 28 Bytes IP/UDP
+    header) per second for the batching modes.
+    """
+    modes = (
+        ('one JSON object per sample', dict()),
+        ('JSON array, 10 samples/50 ms', dict(batch_size=10, interval=0.05)),
+        ('JSON array, MTU/50 ms', dict(batch_size=1000, interval=0.05)),
+        ('binary, MTU/50 ms', dict(batch_size=1000, interval=0.05, binary=True)),
+        ('decimated to 50 Hz', dict(rate=50)),
+    )
+    print(f'{"mode":<30} {"rate":>6} {"syscalls/s":>11} {"bytes/s":>10}', flush=True)
+    for rate in (100, 500, 1000, 5000):
+        for label, options in modes:
+            batcher = TelemetryBatcher(lambda datagram: None, **options)
+            for i in range(rate):
+                batcher.add(1697000000 + i / rate, TELEMETRY_SAMPLE)
+            batcher.flush()
+            wire = batcher.bytes + 28 * batcher.datagrams
+            print(f'{label:<30} {rate:>6} {batcher.datagrams:>11} {wire:>10}', flush=True)
+
+
+class PythonWindow(object):
+    """
+    Rolling statistics of the telemetry with Python loops (the per-frame path):
+    running sums and EMA per sample, min/max over the window when queried.
+    """
+    def __init__(self, window, alpha):
+        self.window = window
+        self.alpha = alpha
+        self.samples = collections.deque()
+        self.sums = [0.0] * 8
+        self.ema = [math.nan] * 8
+
+    def append(self, timestamp, floats):
+        self.samples.append((timestamp, floats))
+        sums = self.sums
+        ema = self.ema
+        alpha = self.alpha
+        for i, value in enumerate(floats):
+            sums[i] += value
+            ema[i] = value if ema[i] != ema[i] else alpha * value + (1 - alpha) * ema[i]
+        samples = self.samples
+        while samples[0][0] < timestamp - self.window:
+            for i, value in enumerate(samples.popleft()[1]):
+                sums[i] -= value
+
+    def statistics(self):
+        count = len(self.samples)
+        columns = list(zip(*(floats for timestamp, floats in self.samples)))
+        return ([total / count for total in self.sums], [min(c) for c in columns],
+                [max(c) for c in columns], list(self.ema))
+
+
+def bench_telemetry_array(args):
+    """
+    Decoding and rolling statistics (mean, min, max, EMA per channel over 10 s,
+    queried every 100 samples) of 10000 telemetry frames at 1 kHz: per frame
+    (struct, TelemetryData, Python loops) compared with the NumPy batch path
+    (telemetryarray: np.frombuffer, TelemetryWindow per sample and per batch).
+    """
+    try:
+        from telemetryarray import TelemetryWindow, channels, decode_frames
+    except ImportError as e:
+        print(f'skipped ({e})', flush=True)
+        return
+
+    count = 10000
+    rng = random.Random(0)
+    samples = [tuple(value + rng.uniform(-1, 1) for value in TELEMETRY_SAMPLE)
+               for _ in range(count)]
+    data = b''.join(TELEMETRY_FRAME.pack(*sample) for sample in samples)
+    timestamps = [i / 1000 for i in range(count)]
+    number = max(1, args.number // 100000)
+
+    def per_frame_objects():
+        return [TelemetryData.from_bytes(timestamps[i], data[i * 32:i * 32 + 32])
+                for i in range(count)]
+
+    def per_frame_struct():
+        return list(TELEMETRY_FRAME.iter_unpack(data))
+
+    def batch_decode():
+        # np.frombuffer only creates a view, the conversion reads every value (like
+        # the Python floats of struct)
+        return channels(decode_frames(data)).astype(float)
+
+    def python_window():
+        window = PythonWindow(10.0, 0.1)
+        for i, floats in enumerate(TELEMETRY_FRAME.iter_unpack(data)):
+            window.append(timestamps[i], floats)
+            if i % 100 == 99:
+                window.statistics()
+        return window.statistics()
+
+    def numpy_window():
+        window = TelemetryWindow(10.0, alpha=0.1)
+        for i, floats in enumerate(TELEMETRY_FRAME.iter_unpack(data)):
+            window.append(timestamps[i], floats)
+            if i % 100 == 99:
+                window.statistics()
+        return window.statistics()
+
+    def numpy_batch_window():
+        window = TelemetryWindow(10.0, alpha=0.1)
+        frames = decode_frames(data)
+        for start in range(0, count, 100):
+            window.extend(timestamps[start:start + 100], frames[start:start + 100])
+            window.statistics()
+        return window.statistics()
+
+    expected = python_window()
+    for statistics in (numpy_window(), numpy_batch_window()):
+        for values, kind in zip(expected, ('mean', 'min', 'max', 'ema')):
+            assert all(math.isclose(a, b, rel_tol=1e-6) for a, b in
+                       zip(values, statistics[kind])), (kind, values, statistics[kind])
+
+    for label, func in (('decode: TelemetryData per frame', per_frame_objects),
+                        ('decode: struct.iter_unpack', per_frame_struct),
+                        ('decode: np.frombuffer, astype', batch_decode),
+                        ('window: Python loops per frame', python_window),
+                        ('window: TelemetryWindow.append', numpy_window),
+                        ('window: extend, batches of 100', numpy_batch_window)):
+        seconds = min(timeit.repeat(func, number=number, repeat=3))
+        report(label + ' /frame', seconds, number * count)
+
+
+class NullTransport(object):
+    """
+    UDP transport, which counts the datagrams instead of sending them.
+    """
+    def __init__(self):
+        self.datagrams = 0
+
+    def sendto(self, data, addr):
+        self.datagrams += 1
+
+
+def bench_telemetry_fanout(args):
+    """
+    Measures the cost per telemetry sample (serialization and sendto calls) for 1 to
+    8 subscribers. The sample is serialized once, only the sendto calls scale with
+    the number of subscribers.
+    """
+    for count in (1, 2, 4, 8):
+        registry = SubscriberRegistry(timeout=3600, max_subscribers=count)
+        registry.transport = NullTransport()
+        # the registry logs every new client (redirected to /dev/null)
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            registry.control_received(('192.168.0.2', 5000))
+            for i in range(1, count):
+                registry.subscription_received(encode_subscription(SUBSCRIBE),
+                                               ('192.168.0.%d' % (i + 2), 5000))
+        batcher = TelemetryBatcher(registry.send)
+        measure(f'telemetry sample, {count} subscriber(s)',
+                lambda: batcher.add(1697000000.123456, TELEMETRY_SAMPLE), args.number)
+
+
+def bench_telemetry_ws(args):
+    """
+    Simulates 10 s of telemetry (100 Hz, slowly drifting values) for a browser
+    client with 10 updates/s and compares the bytes of the full JSON message with
+    the delta updates. Measures the cost of publishing a sample for 1 to 8 clients.
+    """
+    rng = random.Random(0)
+    values = list(TELEMETRY_SAMPLE)
+    channel = TelemetryChannel()
+    client = TelemetryClient(channel)
+    channel.subscribe(client)
+    serializer = TelemetrySerializer()
+    json_bytes = delta_bytes = updates = 0
+    for i in range(1000):
+        j = rng.randrange(len(values))
+        values[j] += rng.gauss(0, abs(values[j]) * 1e-4)
+        channel.publish(tuple(values))
+        if i % 10 == 0:
+            updates += 1
+            json_bytes += len(serializer.serialize(1697000000 + i / 100, values))
+            message = client.update()
+            delta_bytes += len(message) if message is not None else 0
+    print(f'full JSON      {json_bytes / updates:7.1f} bytes/update', flush=True)
+    print(f'delta updates  {delta_bytes / updates:7.1f} bytes/update', flush=True)
+
+    for count in (1, 2, 4, 8):
+        channel = TelemetryChannel()
+        for i in range(count):
+            channel.subscribe(TelemetryClient(channel))
+        measure(f'publish sample, {count} browser client(s)',
+                lambda: channel.publish(TELEMETRY_SAMPLE), args.number)
+#endregion
+
+#region flight recorder
+def bench_flight_recorder(args):
+    """
+    Measures the cost of a record call on the event loop (telemetry and ICU
+    frames) and checks the recorded data: writes records into small segments
+    (rotation), reads them back and exports them to CSV.
+    """
+    import tempfile
+
+    telemetry = TELEMETRY_FRAME.pack(*TELEMETRY_SAMPLE)
+    control = icuprotocol.encode(1024, 1024, 1024, 0, 512, 512)
+    with tempfile.TemporaryDirectory() as directory:
+        # staging only (the thread isn't started, the ring is big enough)
+        recorder = flightrecorder.FlightRecorder(directory, staging_size=6 * args.number)
+        measure('record telemetry frame',
+                lambda: recorder.record(flightrecorder.RECORD_TELEMETRY, telemetry),
+                args.number)
+        measure('record ICU frame',
+                lambda: recorder.record(flightrecorder.RECORD_CONTROL, control),
+                args.number)
+
+    with tempfile.TemporaryDirectory() as directory:
+        # 10 kHz in bursts of 100 records for 2 s, 64 KiB segments (rotation)
+        recorder = flightrecorder.FlightRecorder(directory, 64 * 1024, 4)
+        recorder.start()
+        for i in range(200):
+            for j in range(50):
+                recorder.record(flightrecorder.RECORD_TELEMETRY, telemetry)
+                recorder.record(flightrecorder.RECORD_CONTROL, control)
+            time.sleep(0.01)
+        recorder.stop_thread()
+        print(f'recorder: {recorder.stats()}', flush=True)
+
+        # 4 segments --> the newest records are kept, without gaps
+        records = list(flightrecorder.read_records(directory))
+        seqs = [record.seq for record in records]
+        assert recorder.dropped or seqs == list(range(seqs[0], seqs[0] + len(seqs)))
+        assert seqs[-1] == recorder.seq
+        assert flightrecorder.decode_record(records[-1]) == icuprotocol.decode(control)
+        assert flightrecorder.decode_record(records[-2]) == TELEMETRY_FRAME.unpack(telemetry)
+        print(f'read back: {len(records)} records in '
+              f'{len(flightrecorder.segment_indexes(directory))} segments', flush=True)
+        flightrecorder.main(['export', directory, '--type', 'control', '--last', '0.5',
+                             '-o', os.path.join(directory, 'control.csv')])
+        flightrecorder.main(['export', directory,
+                             '-o', os.path.join(directory, 'telemetry.npy')])
+#endregion
+
+#region metrics
+def bench_metrics(args):
+    """
+    Measures the cost of the instrumentation per stage: timestamp and histogram
+    record, compared with the per-packet print it replaces.
+    """
+    histogram = metrics.Histogram('benchmark_seconds', 'benchmark')
+    monotonic_ns = time.monotonic_ns
+    start = monotonic_ns()
+    measure('monotonic_ns + histogram record',
+            lambda: histogram.record(monotonic_ns() - start), args.number)
+    frame = icuprotocol.encode(1024, 1024, 1024, 0, 512, 512)
+    with open(os.devnull, 'w') as devnull:
+        measure('print ICU frame (/dev/null)',
+                lambda: print(frame, file=devnull, flush=True), args.number)
+    measure('render /metrics', metrics.render, 1000)
+#endregion
+
+#region control path latency
+def telemetry_key(floats):
+    """
+    Returns the key of a telemetry sample (values as sent in the JSON object).
+    """
+    return tuple(round(value, 6) for value in floats)
+
+
+def phone_process(port, schedule, start_ns, duration, conn):
+    """
+    Smartphone emulation (own process, so it doesn't share the event loop and the
+    GIL with the server): sends the control packets of the schedule (list of
+    (offset in s, control values)) from start_ns on and receives the telemetry.
+    Sends the tuple (sent, received) of (monotonic_ns, key) lists to conn.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    address = ('127.0.0.1', port)
+    start = start_ns / 1e9
+    end = start + duration + 0.5        # receive the last telemetry
+    sent = []
+    received = []
+    i = 0
+    while True:
+        now = time.monotonic()
+        while i < len(schedule) and start + schedule[i][0] <= now:
+            values = schedule[i][1]
+            sock.sendto(CONTROL_PACKET.pack(CONTROL_PACKET_MAGIC, CONTROL_PACKET_VERSION,
+                                            i & 0xFFFF, *values), address)
+            pitch, roll, yaw, power, pitchg, rollg, yawg = values
+            sent.append((time.monotonic_ns(), icuprotocol.decode(
+                icuprotocol.encode(pitch, roll, yaw, power, pitchg, yawg))))
+            i += 1
+        if now >= end:
+            break
+        timeout = end - now
+        if i < len(schedule):
+            timeout = min(timeout, start + schedule[i][0] - now)
+        readable, _, _ = select.select([sock], [], [], max(0, timeout))
+        while readable:
+            try:
+                datagram = sock.recv(65536)
+            except BlockingIOError:
+                break
+            now_ns = time.monotonic_ns()
+            if datagram[0] == TELEMETRY_BATCH_MAGIC:
+                for record in decode_batch(datagram):
+                    received.append((now_ns, telemetry_key(record[1:])))
+                continue
+            samples = json.loads(datagram)
+            for sample in samples if isinstance(samples, list) else [samples]:
+                received.append((now_ns, tuple(sample[name]
+                                               for name in TelemetryData.__slots__[1:])))
+    sock.close()
+    conn.send((sent, received))
+
+
+def match_latencies(sent, received):
+    """
+    Returns the latencies (us) of the received items: time since the latest sent
+    item with the same key.
+    """
+    times = {}
+    for ns, key in sent:
+        times.setdefault(key, []).append(ns)
+    latencies = []
+    for ns, key in received:
+        sent_times = times.get(key)
+        if not sent_times:
+            continue
+        i = bisect.bisect_right(sent_times, ns)
+        if i:
+            latencies.append((ns - sent_times[i - 1]) / 1000)
+    return latencies
+
+
+async def run_control_path(args, schedule, rate, telemetry_records):
+    """
+    Runs the control path of the server (UDP, UART with the Teensy emulator) with
+    the smartphone emulation and returns the tuple (sent, written, emitted,
+    received) of (monotonic_ns, key) lists.
+    """
+    import config
+    import server
+    from telemetrystream import TelemetryChannel
+    from uarttransports import TeensyEmulator
+
+    loop = asyncio.get_running_loop()
+    emulator = TeensyEmulator(log=True)
+    tasks, transports = await server.start_control_path(TelemetryChannel(), None,
+                                                        args.uart, emulator)
+    while not emulator.handshake:
+        await asyncio.sleep(0.01)
+
+    duration = schedule[-1][0] if telemetry_records else args.duration
+    start_ns = time.monotonic_ns() + 1_000_000_000      # time for the process start
+    conn, child_conn = multiprocessing.Pipe()
+    phone = multiprocessing.get_context('spawn').Process(
+        target=phone_process,
+        args=(config.SMARTPHONE_PORT, schedule, start_ns, duration, child_conn))
+    phone.start()
+    if telemetry_records:
+        await emulator.replay(telemetry_records, start_ns + (
+            telemetry_records[0].monotonic_ns - telemetry_records.base_ns))
+    else:
+        await emulator.send_synthetic(rate, duration, start_ns)
+    sent, received = await loop.run_in_executor(None, conn.recv)
+    phone.join()
+
+    for transport in transports:
+        transport.close()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    written = [(ns, icuprotocol.decode(frame)) for ns, frame in emulator.frames]
+    emitted = [(ns, telemetry_key(floats)) for ns, floats in emulator.telemetry]
+    return sent, written, emitted, received
+
+
+class RecordList(list):
+    """
+    List of flight recorder records with the start time of the recording.
+    """
+    base_ns = 0
+
+
+def bench_control_latency(args):
+    """
+    End-to-end latency of the control path without the Pi hardware (UART: Teensy
+    emulator, see uarttransports): UDP receive --> UART write (control packets of
+    the smartphone emulation) and UART receive --> UDP send (telemetry of the
+    emulator) at several packet rates or for a flight recorder recording
+    (--replay). The latencies include the UDP loopback of the kernel (and with
+    config.LOG_LEVEL 'debug' the per-packet prints, redirected to /dev/null).
+    """
+    runs = []
+    if args.replay:
+        records = list(flightrecorder.read_records(args.replay))
+        if not records:
+            print(f'no records in {args.replay}', flush=True)
+            return
+        base_ns = records[0].monotonic_ns
+        schedule = [((record.monotonic_ns - base_ns) / 1e9,
+                     flightrecorder.decode_record(record))
+                    for record in records if record.type == flightrecorder.RECORD_CONTROL]
+        telemetry = RecordList(record for record in records
+                               if record.type == flightrecorder.RECORD_TELEMETRY)
+        telemetry.base_ns = base_ns
+        runs.append(('replay', schedule, 0, telemetry))
+    else:
+        for rate in args.rates:
+            # Pitch/Roll: packet counter, so every ICU frame is unique
+            schedule = [(i / rate, (i % 2048, (i // 2048) % 2048, 1024, 0, 512, 0, 512))
+                        for i in range(int(args.duration * rate))]
+            runs.append((f'{rate:g}', schedule, rate, None))
+
+    print(f'{"rate":>7} {"direction":<12} {"sent":>7} {"recv":>7} {"p50 us":>9} '
+          f'{"p99 us":>9} {"p999 us":>9}', flush=True)
+    for label, schedule, rate, telemetry in runs:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            sent, written, emitted, received = asyncio.run(
+                run_control_path(args, schedule, rate, telemetry))
+        for direction, items, results in (('UDP->UART', sent, written),
+                                           ('UART->UDP', emitted, received)):
+            latencies = match_latencies(items, results)
+            print(f'{label:>7} {direction:<12} {len(items):>7} {len(latencies):>7} '
+                  f'{percentile(latencies, 50):9.1f} {percentile(latencies, 99):9.1f} '
+                  f'{percentile(latencies, 99.9):9.1f}', flush=True)
+
+
+async def run_uart_stall(writer_class, rate, stall, cycles):
+    """
+    Writes ICU frames (frame number as payload) at rate frames/s (logical time)
+    into the emulated UART, which is stalled (CTS) for stall seconds once per
+    second. Returns the tuple (ages, burst, max. depth): the age (ms) of every
+    delivered frame, the max. number of frames delivered at once after a stall
+    and the max. write buffer size (bytes).
+    """
+    import config
+    from communicationtransports import Uart_Protocol
+    from uarttransports import LoopbackTransport, TeensyEmulator, HANDSHAKE
+
+    emulator = TeensyEmulator(log=True)
+    protocol = Uart_Protocol(asyncio.Queue(), asyncio.Queue())
+    transport = LoopbackTransport(protocol, emulator)
+    protocol.connection_made(transport)
+    transport.write(HANDSHAKE)
+    writer = writer_class(transport, config.UART_WRITE_HIGH_WATER,
+                          config.UART_WRITE_LOW_WATER)
+    protocol.writer = writer
+
+    ages = []
+    burst = depth = 0
+    stall_frames = int(stall * rate)
+    for i in range(int(rate) * cycles):
+        before = len(emulator.frames)
+        phase = i % int(rate)
+        if phase == 0:
+            transport.set_cts(False)
+        elif phase == stall_frames:
+            transport.set_cts(True)
+        writer.write(struct.pack('<Q', i))
+        depth = max(depth, transport.get_write_buffer_size())
+        delivered = emulator.frames[before:]
+        burst = max(burst, len(delivered))
+        for ns, frame in delivered:
+            ages.append((i - struct.unpack('<Q', frame)[0]) / rate * 1000)
+    return ages, burst, depth
+
+
+class DirectWriter(object):
+    """
+    Writes every frame to the transport (the behaviour without UartWriter).
+    """
+    def __init__(self, transport, high=None, low=None):
+        self.transport = transport
+        transport.set_write_buffer_limits(high, low)
+
+    def write(self, frame):
+        self.transport.write(frame)
+
+    def pause(self):
+        pass
+
+    def resume(self):
+        pass
+
+
+def bench_uart_backpressure(args):
+    """
+    Control frames during UART stalls (the Teensy holds CTS for 50/200 ms once per
+    second, --rates): writing every frame (buffer grows, stale frames are sent
+    after the stall) compared with the UartWriter (newest frame only). The age is
+    the time between writing a frame and its delivery to the Teensy, stale frames
+    are older than one frame interval (with the UartWriter: only the frames, which
+    were in the write buffer up to the high water mark, when the stall began).
+    """
+    from controlchannel import UartWriter
+
+    print(f'{"rate":>7} {"stall ms":>8} {"writer":<8} {"frames":>7} {"burst":>6} '
+          f'{"depth B":>8} {"stale":>6} {"max ms":>7}', flush=True)
+    for rate in args.rates:
+        for stall in (0.05, 0.2):
+            for label, writer_class in (('direct', DirectWriter), ('coalesce', UartWriter)):
+                ages, burst, depth = asyncio.run(run_uart_stall(writer_class, rate, stall, 3))
+                stale = sum(1 for age in ages if age > 1000 / rate)
+                print(f'{rate:>7g} {stall * 1000:>8g} {label:<8} {len(ages):>7} {burst:>6} '
+                      f'{depth:>8} {stale:>6} {max(ages):>7.1f}', flush=True)
+#endregion
+
+#region control watchdog
+async def run_link_loss(rate, loss, duration, timeout):
+    """
+    Sends control packets at rate packets/s with the loss ratio (random) to the
+    watchdog for duration seconds, then the link is silent. Returns the tuple
+    (watchdog, lost packets, failsafe delay in ms): the time between the last
+    valid packet and the first failsafe frame delivered to the emulated Teensy.
+    """
+    from controlchannel import ControlWatchdog, UartWriter
+    from communicationtransports import Uart_Protocol
+    from uarttransports import LoopbackTransport, TeensyEmulator, HANDSHAKE
+
+    emulator = TeensyEmulator(log=True)
+    protocol = Uart_Protocol(asyncio.Queue(), asyncio.Queue())
+    transport = LoopbackTransport(protocol, emulator)
+    protocol.connection_made(transport)
+    transport.write(HANDSHAKE)
+    writer = UartWriter(transport)
+    failsafe = CommData(1024, 1024, 1024, 0, 512, 512, 512).to_uart_data()
+    watchdog = ControlWatchdog(writer, timeout, failsafe, timeout / 20)
+    task = asyncio.create_task(watchdog.run())
+    watchdog.arm()
+
+    rng = random.Random(0)
+    commdata = CommData(999, 555, 888, 666, 777, 766, 944)
+    addr = ('127.0.0.1', 50000)
+    lost = 0
+    start = time.monotonic()
+    for seq in range(int(rate * duration)):
+        await asyncio.sleep(max(0, start + seq / rate - time.monotonic()))
+        if rng.random() < loss:
+            lost += 1
+            continue
+        now = time.monotonic_ns()
+        watchdog.arrived(now, commdata.to_packet(seq), addr)
+        watchdog.valid(now)
+        writer.write(commdata.to_uart_data())
+    last_valid = watchdog.last_valid
+    while not any(frame == failsafe for ns, frame in emulator.frames[-3:]):
+        await asyncio.sleep(0.001)
+    delay = (emulator.frames[-1][0] - last_valid) / 1e6
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    return watchdog, lost, delay
+
+
+def bench_control_watchdog(args):
+    """
+    Cost of the watchdog of the control link per received packet (arrived in the
+    UDP callback, valid after decoding) and the memory retained by it, the loss
+    and jitter statistics of a lossy link (--rates, 5 % loss, 2 s) and the delay
+    between the last valid packet and the failsafe frame at the UART (timeout
+    0.2 s, checked every 10 ms).
+    """
+    import tracemalloc
+    from controlchannel import ControlWatchdog
+
+    watchdog = ControlWatchdog(None, 0.5, bytes(8))     # run isn't started
+    packets = [CommData(999, 555, 888, 666, 777, 766, 944).to_packet(seq)
+               for seq in range(1000)]
+    addr = ('127.0.0.1', 50000)
+    clock = iter(range(0, 10**18, 5_000_000))
+
+    def packets_arrived():
+        arrived = watchdog.arrived
+        for packet in packets:
+            now = next(clock)
+            arrived(now, packet, addr)
+            watchdog.valid(now)
+
+    seconds = min(timeit.repeat(packets_arrived, number=max(1, args.number // 1000),
+                                repeat=3))
+    report('watchdog arrived + valid per packet', seconds,
+           max(1, args.number // 1000) * len(packets))
+
+    packets_arrived()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for _ in range(100):
+        packets_arrived()
+    retained = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print(f'memory retained after {100 * len(packets)} packets: {retained} Bytes', flush=True)
+
+    print(f'{"rate":>7} {"sent":>6} {"lost":>5} {"counted":>7} {"loss %":>7} '
+          f'{"jitter ms":>9} {"failsafe ms":>11}', flush=True)
+    for rate in args.rates:
+        if rate > 1000:
+            continue    # asyncio.sleep can't pace faster
+        watchdog, lost, delay = asyncio.run(run_link_loss(rate, 0.05, 2.0, 0.2))
+        stats = watchdog.stats()
+        print(f'{rate:>7g} {int(rate * 2):>6} {lost:>5} {stats["lost"]:>7} '
+              f'{stats["loss"] * 100:>7.2f} {stats["jitter"] * 1000:>9.3f} '
+              f'{delay:>11.1f}', flush=True)
+#endregion
+
+#region NAL splitter
+def read_h264(args):
+    """
+    Returns the recorded h264 stream (--file) or a synthetic stream.
+    """
+    if args.file:
+        with open(args.file, 'rb') as f:
+            return f.read()
+    return synthetic_h264()
+
+
+def chunks(data, size):
+    """
+    Splits the data into camera-sized chunks.
+    """
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class BytesIOOutput(object):
+    """
+    The original StreamingOutput (BytesIO, start code only at the beginning of a
+    buffer). Only used as reference for the benchmark.
+    """
+    def __init__(self):
+        self.frame = None
+        self.buffer = BytesIO()
+        self.separator = b'\x00\x00\x00\x01'
+        self.frames = 0
+
+    def write(self, buf):
+        if buf.startswith(self.separator):
+            self.buffer.seek(0)
+            self.frame = self.buffer.read()
+            self.frames += 1
+            self.buffer.seek(0)
+            self.buffer.truncate()
+        return self.buffer.write(buf)
+
+
+def bench_nal_splitter(args):
+    """
+    Replays a recorded (or synthetic) h264 stream into the original and the new
+    StreamingOutput, once with one NAL unit per write (like picamera, slices are
+    passed without copy) and once in fixed-size chunks (every chunk is scanned),
+    and compares throughput and the number of frames found.
+    """
+    data = read_h264(args)
+    separator = b'\x00\x00\x00\x01'
+    units = [separator + unit for unit in data.split(separator) if unit]
+
+    for label, bufs in (('per NAL unit', units), (f'{args.chunk} Byte chunks',
+                                                   chunks(data, args.chunk))):
+        per_unit = bufs is units
+        for name, factory in (('BytesIO', BytesIOOutput),
+                              ('NalSplitter', lambda: StreamingOutput(slice_per_write=per_unit))):
+            frames = []
+            output = factory()
+            if isinstance(output, StreamingOutput):
+                output.splitter.callback = frames.append
+
+            start = time.perf_counter()
+            for buf in bufs:
+                output.write(buf)
+            seconds = time.perf_counter() - start
+
+            found = output.frames if name == 'BytesIO' else len(frames)
+            print(f'{name:<12} {label:<18} {len(data) / seconds / 2**20:9.1f} MiB/s '
+                  f'{found:6d}/{len(units)} frames', flush=True)
+#endregion
+
+#region websocket clients
+class FakeWebSocket(object):
+    """
+    A websocket replacement, which needs delay seconds to send a frame.
+    """
+    def __init__(self, delay):
+        self.delay = delay
+        self.sent = []
+        self.first_idr = None       # time, when the first IDR frame was sent
+
+    def send(self, data, binary=False):
+        if self.delay:
+            time.sleep(self.delay)
+        if self.first_idr is None and nal_type(data) == NAL_IDR:
+            self.first_idr = time.perf_counter()
+        self.sent.append(data)
+
+
+class FakeCamera(object):
+    """
+    A picamera replacement, which replays NAL units into the output at fps (once or
+    until the recording is stopped). With stamp=True, the time of writing is put
+    into the payload of every NAL unit (20 ASCII digits after the NAL header).
+    """
+    def __init__(self, units, fps, repeat=False, stamp=False):
+        self.units = units
+        self.fps = fps
+        self.repeat = repeat
+        self.stamp = stamp
+        self.stopped = False
+        self.thread = None
+
+    def start_recording(self, output, format, **options):
+        self.thread = Thread(target=self.replay, args=(output,), daemon=True)
+        self.thread.start()
+
+    def replay(self, output):
+        start = time.perf_counter()
+        i = 0
+        while not self.stopped:
+            unit = self.units[i % len(self.units)]
+            if self.stamp and len(unit) >= 25:
+                unit = unit[:5] + b'%020d' % time.monotonic_ns() + unit[25:]
+            output.write(unit)
+            i += 1
+            if i == len(self.units) and not self.repeat:
+                break
+            delay = start + i / self.fps - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        output.flush()
+
+    def stop_recording(self):
+        self.stopped = True
+
+
+def bench_slow_clients(args):
+    """
+    Broadcasts a synthetic h264 stream to fake websocket clients with different
+    send delays (one fast, two slow ones) and reports for every client the sent,
+    dropped and queued frames. The fast client must receive every frame.
+    """
+    import config
+
+    data = read_h264(args)
+    separator = b'\x00\x00\x00\x01'
+    units = [separator + unit for unit in data.split(separator) if unit]
+
+    clients = []
+    for delay in (0, 0.02, 0.1):
+        websocket = FakeWebSocket(delay)
+        queue = ClientFrameQueue(config.WS_QUEUE_SIZE)
+        FrameSender(websocket, queue).start()
+        clients.append((websocket, queue))
+
+    interval = 1 / args.fps
+    start = time.perf_counter()
+    for i, unit in enumerate(units):
+        for websocket, queue in clients:
+            queue.put(unit)
+        delay = start + (i + 1) * interval - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+    broadcast_time = time.perf_counter() - start
+    time.sleep(0.2)
+
+    print(f'{len(units)} NAL units in {broadcast_time:.2f} s', flush=True)
+    for websocket, queue in clients:
+        stats = queue.stats()
+        print(f'send delay {websocket.delay * 1000:5.0f} ms: sent {stats["sent"]:4d} '
+              f'dropped {stats["dropped"]:4d} queued {stats["depth"]:3d}', flush=True)
+        queue.close()
+
+def bench_late_join(args):
+    """
+    Replays a recorded (or synthetic) h264 stream through StreamingOutput and the
+    broadcast thread and lets clients join at random points of the stream. Reports
+    the time from joining until the first IDR frame was sent (time to first
+    decodable frame) with and without keyframe cache.
+    """
+    import config
+
+    data = read_h264(args)
+    separator = b'\x00\x00\x00\x01'
+    units = [separator + unit for unit in data.split(separator) if unit]
+    rng = random.Random(1)
+
+    for cache_size in (0, config.KEYFRAME_CACHE_SIZE):
+        output = StreamingOutput(cache_size)
+        camera = FakeCamera(units, args.fps)
+        broadcast_thread = BroadcastThread(camera, output)
+        broadcast_thread.daemon = True
+        broadcast_thread.start()
+
+        duration = len(units) / args.fps
+        join_times = sorted(rng.uniform(0.2, duration * 0.7) for _ in range(10))
+        clients = []
+        start = time.perf_counter()
+        for join_time in join_times:
+            delay = start + join_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            websocket = FakeWebSocket(0)
+            queue = ClientFrameQueue(config.WS_QUEUE_SIZE)
+            joined = time.perf_counter()
+            output.subscribe(queue)
+            FrameSender(websocket, queue).start()
+            clients.append((joined, websocket, queue))
+
+        camera.thread.join()
+        broadcast_thread.stop_event.set()
+        time.sleep(0.1)
+
+        latencies = sorted((websocket.first_idr - joined) * 1000
+                           for joined, websocket, queue in clients
+                           if websocket.first_idr is not None)
+        label = 'with keyframe cache' if cache_size else 'without keyframe cache'
+        if latencies:
+            print(f'{label:<24} time to first IDR: median {latencies[len(latencies) // 2]:7.1f} ms'
+                  f' max {latencies[-1]:7.1f} ms ({len(latencies)}/{len(clients)} clients)',
+                  flush=True)
+        else:
+            print(f'{label:<24} no client received an IDR frame', flush=True)
+        for joined, websocket, queue in clients:
+            queue.close()
+
+class SimulatedCamera(object):
+    """
+    A picamera replacement in logical time (for the video adaptation): a frame of
+    the size given by the bitrate every 1/framerate seconds (IDR frame: 4 times a
+    P-frame), a group of pictures per second, SPS, PPS and IDR at the start of the
+    recording and after request_key_frame. The capture time (s) is put after the
+    NAL header. The recording starts restart_delay seconds after start_recording.
+    """
+    def __init__(self, restart_delay=0.3):
+        self.restart_delay = restart_delay
+        self.resolution = (0, 0)
+        self.framerate = 25
+        self.bitrate = 0
+        self.recording = False
+        self.keyframe_requested = False
+        self.gop_position = 0
+        self.now = 0.0              # logical time (s)
+        self.next_time = 0.0        # capture time of the next frame
+
+    def start_recording(self, output, format, **options):
+        self.bitrate = options['bitrate']
+        self.recording = True
+        self.gop_position = 0
+        self.next_time = self.now + self.restart_delay
+
+    def stop_recording(self):
+        self.recording = False
+
+    def request_key_frame(self):
+        self.keyframe_requested = True
+
+    def unit(self, nal, size):
+        return b'\x00\x00\x00\x01' + bytes((nal,)) + struct.pack('<d', self.now) + \
+            bytes(max(0, size - 13))
+
+    def capture(self):
+        """
+        Returns the NAL units of the next frame (the time is set to its capture
+        time).
+        """
+        self.now = self.next_time
+        self.next_time += 1 / self.framerate
+        gop = int(self.framerate)
+        p_size = int(self.bitrate / 8 / self.framerate * gop / (gop + 3))
+        if self.gop_position == 0 or self.keyframe_requested:
+            self.keyframe_requested = False
+            self.gop_position = 1
+            return [self.unit(0x67, 20), self.unit(0x68, 20), self.unit(0x65, 4 * p_size)]
+        self.gop_position = (self.gop_position + 1) % gop
+        return [self.unit(0x41, p_size)]
+
+
+class SimulatedLink(object):
+    """
+    Sends the frames of a client queue over a link with a bandwidth schedule (list
+    of (start time in s, bit/s)) in logical time and collects the tuples (capture
+    time, latency, bytes) of the sent frames.
+    """
+    def __init__(self, queue, schedule):
+        self.queue = queue
+        self.schedule = schedule
+        self.free_at = 0.0          # the link is busy until then
+        self.sent = []
+
+    def bandwidth(self, now):
+        rate = self.schedule[0][1]
+        for start, bandwidth in self.schedule:
+            if start <= now:
+                rate = bandwidth
+        return rate
+
+    def advance(self, now):
+        """
+        Sends the queued frames, which are sent completely until now.
+        """
+        queue = self.queue
+        while queue.frames:
+            frame = queue.frames[0]
+            captured, = struct.unpack_from('<d', frame, 5)
+            start = max(self.free_at, captured)
+            end = start + len(frame) * 8 / self.bandwidth(start)
+            if end > now:
+                break
+            queue.poll()
+            self.free_at = end
+            self.sent.append((captured, end - captured, len(frame)))
+
+
+def simulate_video_link(schedule, duration, adaptive):
+    """
+    Runs the simulated camera, the broadcast (StreamingOutput) and one websocket
+    client over the simulated link. Returns the tuple (link, queue, adapter).
+    """
+    import config
+    from videoadaptation import VideoAdapter, PROFILES, recording_options
+
+    camera = SimulatedCamera()
+    output = StreamingOutput(0)
+    queue = ClientFrameQueue(config.WS_QUEUE_SIZE)
+    output.subscribe(queue)
+    link = SimulatedLink(queue, schedule)
+    adapter = None
+    if adaptive:
+        adapter = VideoAdapter(camera, output)
+        adapter.start_recording()
+    else:
+        camera.framerate = PROFILES[0].framerate
+        camera.start_recording(output, 'h264', **recording_options(PROFILES[0]))
+
+    while camera.next_time < duration:
+        units = camera.capture()
+        now = camera.now
+        link.advance(now)
+        for unit in units:
+            if adapter is not None:
+                adapter.observe(unit, int(now * 1e9), int(now * 1e9))
+            with output.condition:
+                output.publish(unit)
+            if adapter is not None and adapter.switch_event.is_set():
+                adapter.switch(int(now * 1e9))
+    link.advance(duration + 10)
+    return link, queue, adapter
+
+
+def bench_video_adaptation(args):
+    """
+    Video latency of one websocket client over a simulated link (6 Mbit/s, drop
+    to 1.2 Mbit/s after 15 s, 2.5 Mbit/s after 35 s, 6 Mbit/s after 50 s) with the
+    best profile of config.VIDEO_PROFILES (fixed) and with the adaptation
+    (VideoAdapter, logical time: the profile changes are printed). The latency is
+    capture --> sent completely; frames are dropped, when the client queue is full.
+    """
+    schedule = [(0, 6e6), (15, 1.2e6), (35, 2.5e6), (50, 6e6)]
+    duration = 80
+    for label, adaptive in (('fixed', False), ('adaptive', True)):
+        link, queue, adapter = simulate_video_link(schedule, duration, adaptive)
+        latencies = [latency * 1000 for captured, latency, size in link.sent]
+        megabits = sum(size for captured, latency, size in link.sent) * 8 / duration / 1e6
+        print(f'{label:<9} frames {len(link.sent):5d} dropped {queue.dropped:5d} '
+              f'latency p50 {percentile(latencies, 50):7.1f} ms p99 '
+              f'{percentile(latencies, 99):7.1f} ms  {megabits:4.2f} Mbit/s'
+              + (f'  switches {adapter.switches}' if adapter is not None else ''),
+              flush=True)
+
+
+def bench_video_server(args):
+    """
+    Streams a synthetic h264 stream with timestamps through the asyncio and the
+    threaded (ws4py) video server to websocket viewers in a separate process and
+    compares the CPU usage of the server process and the frame latency (camera
+    write -> viewer receive), see loadtest.py.
+    """
+    data = read_h264(args)
+    separator = b'\x00\x00\x00\x01'
+    units = [separator + unit for unit in data.split(separator) if unit]
+
+    for mode in ('asyncio', 'threaded'):
+        camera = FakeCamera(units, args.fps, repeat=True, stamp=True)
+        try:
+            cpu, viewer_results = asyncio.run(run_load(camera, mode, args.viewers,
+                                                       args.duration))
+        except ImportError as e:
+            print(f'{mode:<9} skipped ({e})', flush=True)
+            continue
+        latencies = [latency for frames, received, lat in viewer_results
+                     for latency in lat]
+        frames = sum(result[0] for result in viewer_results)
+        print(f'{mode:<9} CPU {cpu * 100:5.1f} %  frames {frames:6d}  latency p50 '
+              f'{percentile(latencies, 50):6.2f} ms p99 {percentile(latencies, 99):6.2f} ms',
+              flush=True)
+#endregion
+
+#region video process
+async def run_control_with_video(args, schedule, rate, video):
+    """
+    Runs the control path (see run_control_path) while the video subsystem streams
+    a synthetic stream to websocket viewers (--viewers): video None (no video),
+    'inproc' (asyncio video server in the control process) or 'process'
+    (VideoProcess). Returns the tuple (sent, written, frames received by the
+    viewers).
+    """
+    import config
+    from camerasource import SyntheticCamera
+    from loadtest import run_viewers
+    from videoprocess import VideoProcess
+    from videoserver import create_video_server
+
+    if video is None:
+        sent, written, emitted, received = await run_control_path(args, schedule, rate, None)
+        return sent, written, 0
+    if video == 'inproc':
+        server = create_video_server(SyntheticCamera(),
+                                     StreamingOutput(config.KEYFRAME_CACHE_SIZE),
+                                     'asyncio', adaptation=False)
+    else:
+        server = VideoProcess('synthetic', 'asyncio', adaptation=False, cpus=())
+    await server.start()
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    viewers = context.Process(target=run_viewers,
+                              args=(args.viewers, args.duration + 2, results))
+    viewers.start()
+    try:
+        sent, written, emitted, received = await run_control_path(args, schedule, rate, None)
+        viewer_results = await asyncio.get_running_loop().run_in_executor(None, results.get)
+    finally:
+        viewers.join()
+        await server.stop()
+    return sent, written, sum(result[0] for result in viewer_results)
+
+
+def bench_control_jitter(args):
+    """
+    Latency and jitter (standard deviation) of the control path UDP receive -->
+    UART write (Teensy emulator) at --rates without video, with the video server
+    on the event loop of the control process and with the video subsystem in a
+    separate process (config.VIDEO_PROCESS), each streaming a synthetic stream to
+    --viewers websocket viewers for --duration seconds.
+    """
+    import statistics
+
+    print(f'{"rate":>7} {"video":<8} {"frames":>7} {"recv":>6} {"p50 us":>8} {"p99 us":>8} '
+          f'{"p999 us":>8} {"max us":>8} {"stdev us":>8}', flush=True)
+    for rate in args.rates:
+        schedule = [(i / rate, (i % 2048, (i // 2048) % 2048, 1024, 0, 512, 0, 512))
+                    for i in range(int(args.duration * rate))]
+        for video in (None, 'inproc', 'process'):
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                sent, written, frames = asyncio.run(
+                    run_control_with_video(args, schedule, rate, video))
+            latencies = match_latencies(sent, written)
+            print(f'{rate:>7g} {video or "off":<8} {frames:>7} {len(latencies):>6} '
+                  f'{percentile(latencies, 50):8.1f} {percentile(latencies, 99):8.1f} '
+                  f'{percentile(latencies, 99.9):8.1f} {max(latencies):8.1f} '
+                  f'{statistics.pstdev(latencies):8.1f}', flush=True)
+#endregion
+
+
+#region server supervisor
+class SlowOutput(object):
+    """
+    Output stream, which needs delay seconds per written line (slow terminal).
+    """
+    def __init__(self, delay):
+        self.delay = delay
+        self.lines = 0
+
+    def write(self, text):
+        self.lines += 1
+        time.sleep(self.delay)
+
+    def flush(self):
+        pass
+
+
+async def run_supervised(command, duration, edges=(), health_interval=0, delay=0.001,
+                         restart_delay=0.05):
+    """
+    Supervises command with the MockGpio backend: the switch is set to on at the
+    start and to the levels of edges [(time, level)], after duration seconds the
+    supervisor is cancelled. The relay writes to a SlowOutput (delay s per line).
+    Returns the tuple (supervisor, output, edge latencies in us).
+    """
+    from server_starter import LogRelay, MockGpio, Supervisor
+
+    output = SlowOutput(delay)
+    relay = LogRelay(output=output)
+    relay.start()
+    gpio = MockGpio(stdin=False)
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]        # no control endpoint: health checks fail
+    supervisor = Supervisor(gpio, relay, command, health_port=port,
+                            health_interval=health_interval, restart_delay=restart_delay)
+    latencies = []
+    handle_edge = supervisor.edge
+
+    def edge(level, edge_ns):
+        latencies.append((time.monotonic_ns() - edge_ns) / 1e3)
+        handle_edge(level, edge_ns)
+    supervisor.edge = edge
+
+    def switch():
+        start = time.monotonic()
+        for at, level in [(0, True), *edges]:
+            time.sleep(max(0, start + at - time.monotonic()))
+            gpio.set(level)
+
+    task = asyncio.create_task(supervisor.run())
+    await asyncio.sleep(0.1)
+    switcher = Thread(target=switch)
+    switcher.start()
+    await asyncio.sleep(duration)
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    switcher.join()
+    relay.stop(5)
+    return supervisor, output, latencies
+
+
+def bench_supervisor(args):
+    """
+    Event-driven supervisor of server.py (server_starter.py) with the MockGpio
+    backend: latency from the GPIO edge (mock thread) to the event loop; a server,
+    which prints as fast as it can (the old per-packet output), behind a stdout
+    of 1 ms per line: run time of the server (the relay drops lines instead of
+    blocking it); restarts with exponential backoff after crashes and after
+    failed health checks.
+    """
+    import sys
+    from server import READY_MESSAGE
+
+    # fake servers: exit quietly on SIGINT (stop of the supervisor)
+    prelude = ('import signal, sys, time\nsignal.signal(signal.SIGINT, lambda *args: sys.exit(0))\n'
+               f'print({READY_MESSAGE!r}, flush=True)\n')
+    ready = prelude + 'time.sleep(60)'
+
+    # edges: every 50 ms, the server starts and stops
+    edges = [(0.05 * i, i % 2 == 0) for i in range(1, 40)]
+    supervisor, output, latencies = asyncio.run(
+        run_supervised([sys.executable, '-c', ready], 2.5, edges))
+    latencies.sort()
+    print(f'GPIO edge --> event loop: p50 {percentile(latencies, 50):.0f} us, '
+          f'p99 {percentile(latencies, 99):.0f} us, max {latencies[-1]:.0f} us '
+          f'({len(latencies)} edges, {supervisor.starts} starts; polling: up to 10000 us)',
+          flush=True)
+
+    # flooding server behind a slow stdout: the server isn't blocked
+    lines = 200000
+    flood = (prelude + 'start = time.monotonic()\n'
+             f'for i in range({lines}): print("packet", i, "x" * 60, flush=True)\n'
+             f'print("server printed {lines} lines in %.2f s" % (time.monotonic() - start), '
+             'file=sys.stderr, flush=True)\ntime.sleep(60)')
+    supervisor, output, latencies = asyncio.run(
+        run_supervised([sys.executable, '-c', flood], 5))
+    stats = supervisor.stats()
+    print(f'slow stdout (1 ms/line): {stats["relayed"]} lines relayed, {stats["dropped"]} '
+          f'dropped', flush=True)
+
+    # crashing server: restarts with backoff 0.05, 0.1, 0.2, ... s
+    crash = [sys.executable, '-c', 'import sys; sys.exit(3)']
+    supervisor, output, latencies = asyncio.run(run_supervised(crash, 2))
+    print(f'crashing server: {supervisor.starts} starts in 2 s (backoff from 0.05 s)', flush=True)
+
+    # hanging server (ready, no control endpoint): restarts after HEALTH_FAILURES failed checks
+    supervisor, output, latencies = asyncio.run(
+        run_supervised([sys.executable, '-c', ready], 2, health_interval=0.05))
+    print(f'unhealthy server: {supervisor.starts} starts, {supervisor.health_failures} failed '
+          f'health checks in 2 s', flush=True)
+#endregion
+
+
+BENCHMARKS = {
+    'control_packet': bench_control_packet,
+    'icu_encoder': bench_icu_encoder,
+    'telemetry': bench_telemetry,
+    'telemetry_batch': bench_telemetry_batch,
+    'telemetry_array': bench_telemetry_array,
+    'telemetry_fanout': bench_telemetry_fanout,
+    'telemetry_ws': bench_telemetry_ws,
+    'flight_recorder': bench_flight_recorder,
+    'metrics': bench_metrics,
+    'control_latency': bench_control_latency,
+    'uart_backpressure': bench_uart_backpressure,
+    'control_watchdog': bench_control_watchdog,
+    'nal_splitter': bench_nal_splitter,
+    'slow_clients': bench_slow_clients,
+    'late_join': bench_late_join,
+    'video_server': bench_video_server,
+    'video_adaptation': bench_video_adaptation,
+    'control_jitter': bench_control_jitter,
+    'supervisor': bench_supervisor,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('names', nargs='*', metavar='name',
+                        help='benchmarks to run (default: all): ' + ', '.join(BENCHMARKS))
+    parser.add_argument('-n', '--number', type=int, default=100000,
+                        help='iterations per measurement')
+    parser.add_argument('--file', help='recorded h264 stream (default: synthetic stream)')
+    parser.add_argument('--chunk', type=int, default=65536,
+                        help='chunk size for replaying the h264 stream')
+    parser.add_argument('--fps', type=float, default=100,
+                        help='NAL units per second for the streaming benchmarks')
+    parser.add_argument('--viewers', type=int, default=4,
+                        help='websocket viewers for the video server and control jitter benchmarks')
+    parser.add_argument('--duration', type=float, default=5,
+                        help='duration of the video server and control jitter benchmarks in seconds')
+    parser.add_argument('--rates', type=lambda value: [float(rate) for rate in value.split(',')],
+                        default=[100, 500, 1000, 2000],
+                        help='packet rates for the control latency, UART backpressure, control '
+                             'watchdog and control jitter benchmarks (comma separated)')
+    parser.add_argument('--uart', choices=('emulator', 'pty'), default='emulator',
+                        help='UART transport for the control latency benchmark')
+    parser.add_argument('--replay',
+                        help='flight recorder directory to replay (control latency benchmark)')
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error(f'unknown benchmark: {name}')
+
+    for name in args.names or BENCHMARKS:
+        print(f'--- {name} ---', flush=True)
+        BENCHMARKS[name](args)
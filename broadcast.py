@@ -5,19 +5,20 @@ from threading import Thread, Event
 
 class BroadcastThread(Thread):
     """
-    A Class that inherits from Thread and broadcasts camera frames to a 
-    websocket server.
+    A Class that inherits from Thread and broadcasts camera frames to the 
+    websocket clients (via their send queues, see StreamingOutput.subscribe).
     """
     
-    def __init__(self, camera, output, websocket_server):
+    def __init__(self, camera, output, adapter=None):
         """
-        Constructor: params are the camera object, streamoutput and a websocket 
-        server object
+        Constructor: params are the camera object, streamoutput (the clients 
+        subscribe to the streamoutput) and the VideoAdapter (optional, starts the 
+        recording with its video profile)
         """
         super(BroadcastThread, self).__init__()
         self.camera = camera
         self.output = output
-        self.websocket_server = websocket_server
+        self.adapter = adapter
         self.stop_event = Event()
 
     def run(self):
@@ -27,12 +28,19 @@ class BroadcastThread(Thread):
         for low cost applications like low delay video streams.
         """
         try:
-            self.camera.start_recording(self.output, 'h264', profile="baseline")
+            if self.adapter is not None:
+                self.adapter.start_recording()
+            else:
+                self.camera.start_recording(self.output, 'h264', profile="baseline")
             while not self.stop_event.is_set():
                 with self.output.condition:
-                    self.output.condition.wait()
-                    self.websocket_server.manager.broadcast(self.output.frame, 
-                                                            binary=True)           
+                    if not self.output.frames:
+                        self.output.condition.wait()
+                    # put every frame since the last wakeup (e.g. SPS, PPS and IDR 
+                    # of one write) into the send queue of every client (never 
+                    # blocks, the clients' sender threads send it)
+                    for frame, captured in self.output.take_frames():
+                        self.output.publish(frame, captured)
         except:
             raise Exception
     
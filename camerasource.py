@@ -0,0 +1,236 @@
+"""
+Video sources of the streaming pipeline (config.CAMERA_SOURCE):
+
+    'picamera':  the Pi camera (picamera.PiCamera)
+    'file':      recorded h264 stream (Annex B, e.g. raspivid -o video.h264,
+                 config.CAMERA_FILE), replayed in a loop
+    'synthetic': generated h264-like stream (random payload, not decodable)
+
+The file and synthetic sources have the interface of picamera.PiCamera, which is
+used by the video servers (start_recording, stop_recording, request_key_frame,
+resolution, framerate, ...). They write one frame per write call into the
+output (like the camera: SPS and PPS together with the following IDR frame), at
+framerate * speed frames per second (speed 0: as fast as possible). So the
+pipeline (StreamingOutput, broadcast, websocket fan-out) runs without the Pi
+hardware, e.g. for load tests (see loadtest.py).
+"""
+import random
+import time
+from threading import Thread
+
+import config
+
+SEPARATOR = b'\x00\x00\x00\x01'
+
+# NAL unit types, which complete a frame
+_SLICE_TYPES = (1, 5)
+
+
+def synthetic_h264(frames=250, frame_size=20000, gop=25, seed=0):
+    """
+    Returns a synthetic h264 stream (Annex B): SPS, PPS and an IDR frame every gop
+    frames, P-frames in between. The payload is random, but without start codes.
+    """
+    rng = random.Random(seed)
+    stream = bytearray()
+
+    def nal(header, size):
+        payload = rng.randbytes(size).replace(b'\x00', b'\x01')
+        stream.extend(SEPARATOR + bytes([header]) + payload)
+
+    for i in range(frames):
+        if i % gop == 0:
+            nal(0x27, 12)                   # SPS
+            nal(0x28, 4)                    # PPS
+            nal(0x25, frame_size * 4)       # IDR
+        else:
+            nal(0x21, rng.randrange(frame_size // 2, frame_size * 3 // 2))  # P-frame
+    return bytes(stream)
+
+
+def split_frames(data):
+    """
+    Splits an h264 stream (Annex B) into frames: every frame ends with a slice (IDR
+    or P-frame), the NAL units before it (SPS, PPS, SEI, ...) belong to it.
+    Returns the list of frames (bytes).
+    """
+    frames = []
+    start = pos = data.find(SEPARATOR)
+    if start < 0:
+        return frames
+    while True:
+        end = data.find(SEPARATOR, pos + 4)
+        if end < 0:
+            end = len(data)
+        if pos + 4 < len(data) and data[pos + 4] & 0x1F in _SLICE_TYPES:
+            frames.append(data[start:end])
+            start = end
+        if end == len(data):
+            break
+        pos = end
+    if start < len(data):
+        frames.append(data[start:])     # trailing NAL units without slice
+    return frames
+
+
+def slice_type(frame):
+    """
+    Returns the NAL unit type of the last NAL unit of a frame (the slice).
+    """
+    offset = frame.rfind(SEPARATOR) + 4
+    return frame[offset] & 0x1F if 4 <= offset < len(frame) else None
+
+
+#region StreamCamera
+class StreamCamera(object):
+    """
+    picamera replacement, which writes the frames of an h264 stream into the
+    output of start_recording (thread, paced to framerate * speed). With stamp,
+    the time of writing (monotonic ns, 20 ASCII digits) is put into the slice of
+    every frame after its NAL header (for latency measurements of the viewers,
+    the stream isn't decodable anymore).
+    """
+    def __init__(self, frames, framerate=None, speed=1.0, repeat=True, stamp=False):
+        """
+        Constructor: frames is the list of frames (see split_frames), framerate the
+        frames per second (default: config.FRAMERATE).
+        """
+        self.frames = frames
+        self.framerate = framerate or config.FRAMERATE
+        self.speed = speed
+        self.repeat = repeat
+        self.stamp = stamp
+        self.resolution = (config.WIDTH, config.HEIGHT)
+        self.vflip = self.hflip = False
+        self.keyframes = [i for i, frame in enumerate(frames) if slice_type(frame) == 5]
+        self.position = 0           # next frame
+        self.keyframe_requested = False
+        self.stopped = True
+        self.thread = None
+
+        # statistics
+        self.written = 0            # frames written
+        self.late = 0               # frames written after their time (overload)
+
+    def start_recording(self, output, format='h264', **options):
+        """
+        Starts writing the frames into the output (the options of picamera, e.g.
+        bitrate, are ignored).
+        """
+        self.stopped = False
+        self.thread = Thread(target=self.replay, args=(output,), daemon=True)
+        self.thread.start()
+
+    def stop_recording(self):
+        """
+        Stops writing (the output is flushed like by picamera).
+        """
+        self.stopped = True
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def request_key_frame(self):
+        """
+        The next frame is the next keyframe (SPS, PPS, IDR) of the stream.
+        """
+        self.keyframe_requested = True
+
+    def close(self):
+        self.stop_recording()
+
+    def next_frame(self):
+        """
+        Returns the next frame or None at the end of the stream.
+        """
+        if self.keyframe_requested and self.keyframes:
+            self.keyframe_requested = False
+            following = [i for i in self.keyframes if i >= self.position]
+            self.position = following[0] if following else self.keyframes[0]
+        if self.position >= len(self.frames):
+            if not self.repeat:
+                return None
+            self.position = 0
+        frame = self.frames[self.position]
+        self.position += 1
+        if self.stamp:
+            offset = frame.rfind(SEPARATOR) + 5
+            if len(frame) >= offset + 20:
+                frame = frame[:offset] + b'%020d' % time.monotonic_ns() + frame[offset + 20:]
+        return frame
+
+    def replay(self, output):
+        """
+        This function writes the frames until the recording is stopped (or the end
+        of the stream without repeat) and flushes the output.
+        """
+        start = time.perf_counter()
+        i = 0
+        while not self.stopped:
+            rate = self.framerate * self.speed
+            if rate > 0:
+                delay = start + i / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                elif delay < -1 / rate:
+                    self.late += 1
+            frame = self.next_frame()
+            if frame is None:
+                break
+            output.write(frame)
+            self.written += 1
+            i += 1
+        output.flush()
+
+class FileCamera(StreamCamera):
+    """
+    StreamCamera, which replays a recorded h264 file (Annex B).
+    """
+    def __init__(self, path, framerate=None, speed=1.0, repeat=True, stamp=False):
+        with open(path, 'rb') as f:
+            frames = split_frames(f.read())
+        if not frames:
+            raise ValueError(f'No h264 frames in {path}')
+        super(FileCamera, self).__init__(frames, framerate, speed, repeat, stamp)
+
+class SyntheticCamera(StreamCamera):
+    """
+    StreamCamera with a synthetic stream (see synthetic_h264: 10 s, a group of
+    pictures per second).
+    """
+    def __init__(self, framerate=None, speed=1.0, frame_size=20000, stamp=False):
+        framerate = framerate or config.FRAMERATE
+        gop = max(1, int(framerate))
+        frames = split_frames(synthetic_h264(10 * gop, frame_size, gop))
+        super(SyntheticCamera, self).__init__(frames, framerate, speed, True, stamp)
+#endregion
+
+
+def create_camera(source=None):
+    """
+    Returns the camera for the source ('picamera', 'file' or 'synthetic', default:
+    config.CAMERA_SOURCE).
+    """
+    source = source or config.CAMERA_SOURCE
+    if source == 'picamera':
+        import picamera     # only on the Pi
+        return picamera.PiCamera()
+    if source == 'file':
+        return FileCamera(config.CAMERA_FILE, speed=config.CAMERA_SPEED)
+    if source == 'synthetic':
+        return SyntheticCamera(speed=config.CAMERA_SPEED)
+    raise ValueError(f'Unknown camera source: {source}')
+
+
+if __name__ == "__main__":
+    '''
+    Testprogramm for split_frames: every frame of the synthetic stream ends with a
+    slice, the frames add up to the stream.
+    '''
+    data = synthetic_h264(50, 1000, 10)
+    frames = split_frames(data)
+    assert b''.join(frames) == data
+    assert len(frames) == 50, len(frames)
+    camera = StreamCamera(frames)
+    assert camera.keyframes == list(range(0, 50, 10)), camera.keyframes
+    print(f'{len(frames)} frames, keyframes {camera.keyframes}')
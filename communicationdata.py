@@ -1,13 +1,27 @@
 # https://howtodoinjava.com/python-json/custom-deserialization/
 import json
+import struct
+
+import icuprotocol
+
+# Binary control packet (sent by newer smartphone clients instead of JSON).
+# Layout (little-endian, 18 Bytes):
+#   magic (1 Byte), version (1 Byte), sequence number (2 Bytes),
+#   Pitch, Roll, Yaw, Power, PitchG, RollG, YawG (7x signed 16 Bit)
+# The magic byte can never be the first byte of a JSON object, therefore the 
+# packet type is detected by the first byte only.
+CONTROL_PACKET_MAGIC = 0xC5
+CONTROL_PACKET_VERSION = 1
+CONTROL_PACKET = struct.Struct('<BBH7h')
 
 class CommData:
     """
     A class to represent communication data as object and to convert into ICU protocol.
     """
-    def __init__(self, Pitch, Roll, Yaw, Power, PitchG, RollG, YawG):
+    def __init__(self, Pitch, Roll, Yaw, Power, PitchG, RollG, YawG, Seq=None):
         """
         Initializes a CommData object with values for pitch, roll, ...
+        Seq is the sequence number of the packet (None for clients without one).
         """
         self.Pitch = Pitch
         self.Roll = Roll
@@ -16,70 +30,71 @@ class CommData:
         self.PitchG = PitchG
         self.RollG = RollG
         self.YawG = YawG
+        self.Seq = Seq
     
     def to_object(d):
         """
         Converts a JSON object to a CommData object
         """
         inst = CommData(d['Pitch'], d['Roll'], d['Yaw'], d['Power'],
-                        d['PitchG'], d['RollG'], d['YawG'])
+                        d['PitchG'], d['RollG'], d['YawG'], d.get('Seq'))
         return inst
     
+    @staticmethod
+    def from_packet(data):
+        """
+        Converts a binary control packet (see CONTROL_PACKET) to a CommData object.
+        Raises ValueError, if the packet has an unknown version or a wrong length.
+        """
+        if len(data) != CONTROL_PACKET.size:
+            raise ValueError(f'Invalid control packet length: {len(data)}')
+        (magic, version, seq, pitch, roll, yaw, power, 
+         pitchg, rollg, yawg) = CONTROL_PACKET.unpack(data)
+        if version != CONTROL_PACKET_VERSION:
+            raise ValueError(f'Unsupported control packet version: {version}')
+        return CommData(pitch, roll, yaw, power, pitchg, rollg, yawg, seq)
+    
+    @staticmethod
+    def from_datagram(data):
+        """
+        Converts a received datagram to a CommData object. Binary control packets 
+        are detected by the magic byte, everything else is parsed as JSON 
+        (fallback for older clients). Raises ValueError, if the datagram isn't a 
+        control packet or a JSON object with the control values.
+        """
+        if data and data[0] == CONTROL_PACKET_MAGIC:
+            return CommData.from_packet(data)
+        comm_data = json.loads(data, object_hook=CommData.to_object)
+        if not isinstance(comm_data, CommData):
+            raise ValueError('Communication data is not a JSON object')
+        return comm_data
+    
+    def to_packet(self, seq=0):
+        """
+        Converts the communication data to a binary control packet and returns bytes
+        """
+        return CONTROL_PACKET.pack(CONTROL_PACKET_MAGIC, CONTROL_PACKET_VERSION, 
+                                   seq & 0xFFFF, 
+                                   int(self.Pitch), int(self.Roll), int(self.Yaw), 
+                                   int(self.Power), int(self.PitchG), int(self.RollG), 
+                                   int(self.YawG))
+    
     def to_uart_data(self):
         """
-        Converts the communication data to ICU protocol and returns a bytearray
+        Converts the communication data to ICU protocol and returns 8 bytes 
+        (see icuprotocol for the bit layout)
         """
-        pitch = int(self.Pitch)
-        roll = int(self.Roll)
-        yaw = int(self.Yaw)
-        power = int(self.Power)
-        pitchg = int(self.PitchG)
-        rollg = int(self.RollG)
-        yawg = int(self.YawG)
-        
-        # split into 2x8 Bit array
-        # TODO: should it get negative numbers?
-        pitch_arr = pitch.to_bytes(2, 'little')  
-        # pitchg_arr = pitchg.to_bytes(4, 'little', signed=True) # example for signed int (32 Bits)
-        
-        roll_arr = roll.to_bytes(2, 'little')
-        yaw_arr = yaw.to_bytes(2, 'little')
-        power_arr = power.to_bytes(2, 'little')
-        
-        pitchg_arr = pitchg.to_bytes(2, 'little')
-        rollg_arr = rollg.to_bytes(2, 'little')
-        yawg_arr = yawg.to_bytes(2, 'little')
-        
-        # 8 Bits Power
-        byte0 = power_arr[0]
-        # 5 Bits Yaw ; 3 Bits Power
-        byte1 =  ((yaw_arr[0]<<3) & 0b11111000) | (power_arr[1] & 0b00000111)
-        # 2 Bits Pitch ; 6 Bits Yaw ( 3 Bits ; 3 Bits)
-        byte2 =  ((pitch_arr[0]<<6) & 0b11000000) | ((yaw_arr[1]<<3) & 0b00111000) | ((yaw_arr[0]>>5) & 0b00000111)
-        # 8 Bits Pitch (2 Bits ; 6 Bits) 
-        byte3 = ((pitch_arr[1]<<6) & 0b11000000) | ((pitch_arr[0]>>2) & 0b00111111)
-        # 7 Bits Roll ; 1 Bit Pitch (1 Bit ; 0) 
-        byte4 = ((roll_arr[0]<<1) & 0b11111110) | ((pitch_arr[1]>>2) & 0b00000001)
-        # 4 Bits YawG; 4 Bits Roll (3 Bits; 1 Bit)
-        byte5 =  ((yawg_arr[0]<<4) & 0b11110000) | ((roll_arr[1]<<1) & 0b00001110) | ((roll_arr[0]>>7) & 0b00000001)
-        # 2 Bits PitchG; 6 Bits YawG (2 Bits ;4 Bits) 
-        byte6 =  ((pitchg_arr[0]<<6) & 0b11000000) | ((yawg_arr[1]<<4) & 0b00110000) | ((yawg_arr[0]>>4) & 0b00001111)
-        # 8 Bits PitchG (2Bits ; 6 Bits)
-        byte7 = ((pitchg_arr[1]<<6) & 0b11000000) | ((pitchg_arr[0]>>2) & 0b00111111)
-        
-        # print the representing bytes (testing purposes)
-        # print(byte0)
-        # print(byte1)
-        # print(byte2)
-        # print(byte3)
-        # print(byte4)
-        # print(byte5)
-        # print(byte6)
-        # print(byte7)
-
-        uart_data = bytearray([byte0, byte1, byte2, byte3, byte4, byte5, byte6, byte7])
-        # print("ICU-Prot: ",uart_data)
-        return uart_data
+        return icuprotocol.encode(int(self.Pitch), int(self.Roll), int(self.Yaw), 
+                                  int(self.Power), int(self.PitchG), int(self.YawG))
+    
+    def to_uart_data_into(self, buffer, offset=0):
+        """
+        Converts the communication data to ICU protocol and writes it into a 
+        preallocated buffer (bytearray or memoryview) at the given offset
+        """
+        icuprotocol.encode_into(buffer, offset, 
+                                int(self.Pitch), int(self.Roll), int(self.Yaw), 
+                                int(self.Power), int(self.PitchG), int(self.YawG))
 
     def __iter__(self):
         yield from {
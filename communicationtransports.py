@@ -1,15 +1,29 @@
 import asyncio
-import struct 
+import config
+import time
+
+from flightrecorder import RECORD_TELEMETRY
+from subscribers import SUBSCRIPTION_MAGIC
+from telemetrydata import TELEMETRY_FRAME
+from uartframing import TelemetryFrameAssembler, FixedFrameAssembler
 
 #region UDP_ServerProtocol
+SUBSCRIPTION_BYTE = bytes((SUBSCRIPTION_MAGIC,))
+
 # UDP protocol server class
 class UDP_ServerProtocol(asyncio.DatagramProtocol):
-    def __init__(self, queue):
+    def __init__(self, mailbox, registry, watchdog=None):
         """
         Constructor:
-        Initializes the queue variable (here: a queue) to put received data into a queue.
+        Initializes the mailbox variable (here: a ControlMailbox) to put received data 
+        into. Only the newest datagram of every client is kept. The registry (here: 
+        a SubscriberRegistry) keeps the receivers of the telemetry data and the client 
+        with control authority. The watchdog (optional, a ControlWatchdog) gets every 
+        datagram of the client with control authority (jitter and loss statistics).
         """
-        self.queue = queue
+        self.mailbox = mailbox
+        self.registry = registry
+        self.watchdog = watchdog
 
     def connection_made(self, transport):
         """
@@ -20,26 +34,43 @@ class UDP_ServerProtocol(asyncio.DatagramProtocol):
     # get udp data from smartphone
     def datagram_received(self, data, addr):
         """
-        Method called when a datagram (UDP packet: JSON) is received.
-        Puts the data and address into the given queue.
+        Method called when a datagram (UDP packet: subscription packet, binary 
+        control packet or JSON) is received. Subscription packets are passed to the 
+        registry. Communication data of the client with control authority is put 
+        into the mailbox (key: address of the client, value: (receive time in ns, 
+        data)), the data of other clients is discarded. The data is decoded later 
+        in process_udp_data (not here, to keep the callback cheap and to decode 
+        only data that isn't coalesced).
         """
-        print(f'Received data from {addr}: {data.decode()}', flush=True)
-        self.queue.put_nowait((data, addr))
+        if data[:1] == SUBSCRIPTION_BYTE:
+            self.registry.subscription_received(data, addr)
+        elif self.registry.control_received(addr):
+            now = time.monotonic_ns()
+            if self.watchdog is not None:
+                self.watchdog.arrived(now, data, addr)
+            self.mailbox.put_nowait(addr, (now, data))
 #endregion
 
 #region UART Protokol 
 # UART Protokol Klasse
 class Uart_Protocol(asyncio.Protocol):
-    def __init__(self, queue, queue_handshake):
+    def __init__(self, queue, queue_handshake, recorder=None):
         """
         Constructor:
-        Initializes the queue and queue_handshake variables (here: queues).
-        Sets the handshake variable to False.
+        Initializes the queue and queue_handshake variables (here: queues) and the 
+        flight recorder (optional, records every telemetry frame).
+        Sets the handshake variable to False and creates the frame assembler 
+        (config.UART_FRAMING: sync word, length and CRC-16 or unframed 32 Bytes).
         """
         self.queue = queue
         self.queue_handshake = queue_handshake
+        self.recorder = recorder
+        self.writer = None      # UartWriter (pause/resume_writing are forwarded)
         self.handshake = False  
         # self.handshake = True     # testing purposes
+        
+        assembler = TelemetryFrameAssembler if config.UART_FRAMING else FixedFrameAssembler
+        self.assembler = assembler(self.frame_received, TELEMETRY_FRAME.size)
 
     def connection_made(self, transport):
         """
@@ -47,53 +78,62 @@ class Uart_Protocol(asyncio.Protocol):
         """
         self.transport = transport
 
+    def pause_writing(self):
+        """
+        Method called when the write buffer of the transport exceeds the high water 
+        mark (e.g. the Teensy holds CTS).
+        """
+        if self.writer is not None:
+            self.writer.pause()
+
+    def resume_writing(self):
+        """
+        Method called when the write buffer of the transport drained below the low 
+        water mark.
+        """
+        if self.writer is not None:
+            self.writer.resume()
+
     # Receive UART data (ICU-protocol) from Teensy and put it into queue for 
     # further processing
     def data_received(self, data):
         """
         This method is called when UART data is received.
-        If the handshake is already done, decodes the data and puts it into 
-        dataqueue. If the received data is the handshake (0xAA), sets the handshake 
-        variable to True and puts a message into queue_handshake.
+        If the handshake is already done, the data is passed to the frame assembler 
+        (a read can contain parts of a frame or several frames). If the received 
+        data is the handshake (0xAA), sets the handshake variable to True and puts a 
+        message into queue_handshake.
         """
-        #decoded_data = data.decode(encoding='utf-8')
-        # print(f'Received data from UART port: {data}', flush=True)
-        
         # check if handshake done 
         if self.handshake == True:
-            # if handshake done, put received UART data into queue 
-            # receive telemetry data
-            
-            # Check if the length of data is 32 bytes
-            if (len(data) == 32):
-                # region unpacking float values
-                # https://docs.python.org/3/library/struct.html
-                # byte order, data type, and size of floats
-                byte_order = '<'    # little-endian
-                float_type = 'f'    # single-precision float
-                float_size = 4      # float size
-                float_count = 8     # 8x4Bytes => 32 Bytes
-                
-                # decode float values
-                floats = struct.unpack(byte_order + float_type * float_count, data)
-            
-                # put telemetry data into queue to send to smartphone via JSON
-                # print(floats, flush=True)
-                
-                self.queue.put_nowait(floats)
-                # endregion
-            else:
-                # wrong bit size
-                print('The length of telemetrydata is incorrect! Length: ', flush=True)
-                print(len(data), flush=True)
-                pass
-            
+            # if handshake done, receive telemetry data
+            self.assembler.feed(data)
+            return
 
         # Check if Teensy is ready
         # if not ready, then wait for Teensy in "process_udp_data" and 
         # discard communication data received from smartphone
-        if data == b'\xAA' and self.handshake == False:
+        if data[:1] == b'\xAA':
             self.handshake = True
             self.queue_handshake.put_nowait(True)
             print('Handshake in UART-transport done!', flush=True)
+            # telemetry data in the same read
+            if len(data) > 1:
+                self.assembler.feed(data[1:])
+
+    def frame_received(self, payload):
+        """
+        This method is called by the frame assembler for every complete telemetry 
+        frame. Decodes the float values and puts them into the queue (with the 
+        receive time in ns).
+        """
+        # decode float values (precompiled struct: 8x float32, little-endian)
+        # https://docs.python.org/3/library/struct.html
+        floats = TELEMETRY_FRAME.unpack(payload)
+        
+        if self.recorder is not None:
+            self.recorder.record(RECORD_TELEMETRY, payload)
+        
+        # put telemetry data into queue to send to smartphone via JSON
+        self.queue.put_nowait((time.monotonic_ns(), floats))
 #endregion    
@@ -11,13 +11,100 @@ HEIGHT = 720
 FRAMERATE = 25          # delay is getting bigger, when resolution and 
                         # framerate is higher!!
 
+VIDEO_ADAPTATION = False # step the video profile (resolution, framerate, bitrate) 
+                         # down/up with the latency of the websocket clients (see 
+                         # videoadaptation.py), False --> WIDTH, HEIGHT, FRAMERATE
+VIDEO_PROFILES = [       # (width, height, framerate, bitrate in bit/s), best first
+    (1280, 720, 25, 4000000),
+    (1024, 576, 25, 2500000),
+    (848, 480, 25, 1500000),
+    (640, 360, 20, 800000),
+    (424, 240, 15, 400000),
+]
+VIDEO_TARGET_LATENCY = 0.3  # latency target in s (broadcast delay + client backlog)
+VIDEO_ADAPT_INTERVAL = 1.0  # s, window of the peak latency (one decision per window)
+VIDEO_ADAPT_UP_HOLD = 10.0  # s below VIDEO_ADAPT_UP_RATIO * target --> next better 
+VIDEO_ADAPT_UP_RATIO = 0.5  # profile
+
+SERVER_MODE = 'asyncio' # 'asyncio': HTTP, websocket and broadcast on the event loop 
+                        # of the control loop, 'threaded': ws4py/HTTPServer/broadcast 
+                        # threads
+
+VIDEO_PROCESS = False   # True: camera, broadcast, HTTP and websocket server in a 
+                        # separate process (see videoprocess.py), the control loop 
+                        # doesn't share the GIL with the video fan-out
+VIDEO_PROCESS_CPUS = (2, 3)     # cpus of the video process (VIDEO_PROCESS, () --> 
+CONTROL_PROCESS_CPUS = (0, 1)   # no pinning) and of the control process
+
 HTTP_PORT = 8082        # default value is 8082
 SMARTPHONE_PORT = 8088
 
 PICO_PORT = 8086        # information for smartphone; for Raspberry Pi not relevant
 WS_PORT = 8084          # default value is 8084
+WS_QUEUE_SIZE = 30      # max. queued frames per websocket client, when a client 
+                        # falls behind, frames are dropped until the next keyframe
+KEYFRAME_CACHE_SIZE = 2 * 1024 * 1024   # max. size of the cached keyframes (SPS, 
+                        # PPS, frames since the last IDR) in bytes, which are sent 
+                        # to a new websocket client first (0 --> no cache)
+WS_TELEMETRY_RATE = 10  # max. telemetry updates/s per browser client (websocket path 
+                        # /telemetry, a client can ask for less with ?rate=...)
+
+CAMERA_SOURCE = 'picamera'  # 'picamera', 'file': recorded h264 stream CAMERA_FILE, 
+                            # 'synthetic': generated stream (see camerasource.py)
+CAMERA_FILE = 'video.h264'
+CAMERA_SPEED = 1.0          # replay speed of 'file'/'synthetic' (0: max. speed)
 
 VFLIP = True
 HFLIP = True
 
+UART_TRANSPORT = 'serial'   # 'serial': UART_DEVICE with RTS/CTS, 'pty'/'emulator': 
+                            # Teensy emulator without the Pi hardware (see 
+                            # uarttransports.py)
+UART_DEVICE = '/dev/ttyAMA0'
+EMULATOR_RATE = 100         # synthetic telemetry frames/s of the Teensy emulator
+UART_WRITE_HIGH_WATER = 16  # UART write buffer limits in bytes (ICU frame: 8 Bytes): 
+UART_WRITE_LOW_WATER = 0    # above HIGH_WATER (e.g. CTS held by the Teensy) control 
+                            # frames are coalesced until the buffer drained to LOW_WATER
+
+UART_FRAMING = False    # True: telemetry frames from the Teensy with sync word, length 
+                        # and CRC-16 (see uartframing.py, needs the Teensy firmware 
+                        # with framing), False --> unframed 32 Bytes (current firmware)
+
+TELEMETRY_BATCH_SIZE = 1        # telemetry samples per datagram (1 and no interval 
+                                # --> one JSON object per sample, the original format)
+TELEMETRY_BATCH_INTERVAL = 0    # max. seconds a sample waits for its batch (0 --> off)
+TELEMETRY_BATCH_BINARY = False  # batches as binary block instead of JSON array
+TELEMETRY_RATE = 0              # decimate the telemetry to max. samples/s (0 --> off)
+TELEMETRY_MAX_DATAGRAM = 1400   # max. datagram size in bytes (below the MTU)
+TELEMETRY_WINDOW = 0            # seconds of rolling telemetry statistics (mean, min, 
+                                # max, EMA per channel on /metrics, see 
+                                # telemetryarray.py, needs numpy; 0 --> off)
+TELEMETRY_EMA_ALPHA = 0.1       # weight of a new sample in the EMA
+TELEMETRY_SUBSCRIBERS = 8       # max. receivers of the telemetry (control client and 
+                                # observers, see subscribers.py)
+TELEMETRY_SUBSCRIBER_TIMEOUT = 5.0  # seconds without datagram --> subscriber removed
+CONTROL_AUTHORITY_TIMEOUT = 1.0     # seconds without communication data --> another 
+                                    # client can take over the control
+
+CONTROL_TIMEOUT = 0.5   # seconds without valid communication data (after the 
+                        # handshake) --> failsafe frame to the Teensy
+FAILSAFE_CONTROL = (1024, 1024, 1024, 0, 512, 512, 512)     # failsafe values (Pitch, 
+                        # Roll, Yaw, Power, PitchG, RollG, YawG): neutral sticks, 
+                        # zero power, gimbal centered
+
+CONTROL_RATE = 0        # UART write cadence of the control data in Hz 
+                        # (0 --> send on arrival, e.g. 200 --> max. 200 frames/s,
+                        # always the newest data)
+
+LOG_LEVEL = 'info'      # 'debug': print every ICU frame and invalid datagram 
+                        # (costs time per packet), 'info': no per-packet output; 
+                        # latencies and counters: http://<pi>:HTTP_PORT/metrics
+
+FLIGHT_RECORDER = False         # record the telemetry and control frames 
+                                # (see flightrecorder.py)
+FLIGHT_RECORDER_DIR = 'flightrecorder'
+FLIGHT_RECORDER_SEGMENT_SIZE = 16 * 1024 * 1024     # bytes per segment file
+FLIGHT_RECORDER_SEGMENTS = 8    # max. segment files (the oldest is deleted), 
+                                # 8 x 16 MiB --> several hours
+
 ###########################################
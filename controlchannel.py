@@ -0,0 +1,396 @@
+import asyncio
+import time
+
+from communicationdata import CONTROL_PACKET, CONTROL_PACKET_MAGIC
+from flightrecorder import RECORD_CONTROL
+
+CONTROL_PACKET_SIZE = CONTROL_PACKET.size
+
+#region ControlMailbox
+class ControlMailbox:
+    """
+    Latest-value-wins mailbox for control data (smartphone -> Teensy).
+
+    In contrast to an asyncio.Queue, only the newest value of every client (key) is
+    kept. If a client sends faster than the values are consumed, the older value
+    is replaced (coalesced), so the consumer always gets the freshest setpoint and
+    stale stick positions can't pile up. Clients are served in the order in which
+    they got a pending value.
+    """
+    def __init__(self, max_clients=8):
+        """
+        Constructor:
+        max_clients limits the number of clients with a pending value, values of
+        further clients are dropped.
+        """
+        self.max_clients = max_clients
+        self.slots = {}         # key -> newest pending value
+        self.waiter = None      # future of a waiting get()
+
+        # statistics
+        self.received = 0       # values put into the mailbox
+        self.coalesced = 0      # values replaced by a newer value of the same client
+        self.dropped = 0        # values discarded (too many clients, clear())
+
+    def put_nowait(self, key, value):
+        """
+        Puts the value of a client (key) into the mailbox. A pending value of the
+        same client is replaced.
+        """
+        self.received += 1
+        slots = self.slots
+        if key in slots:
+            self.coalesced += 1
+        elif len(slots) >= self.max_clients:
+            self.dropped += 1
+            return
+        slots[key] = value
+
+        waiter = self.waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    def get_nowait(self):
+        """
+        Returns the tuple (key, value) of the next pending client. Raises
+        asyncio.QueueEmpty, if there is no pending value.
+        """
+        slots = self.slots
+        if not slots:
+            raise asyncio.QueueEmpty
+        key = next(iter(slots))
+        return key, slots.pop(key)
+
+    async def get(self):
+        """
+        Waits until a value is pending and returns the tuple (key, value).
+        """
+        while not self.slots:
+            self.waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self.waiter
+            finally:
+                self.waiter = None
+        return self.get_nowait()
+
+    def empty(self):
+        """
+        Returns True, if there is no pending value.
+        """
+        return not self.slots
+
+    def qsize(self):
+        """
+        Returns the number of clients with a pending value.
+        """
+        return len(self.slots)
+
+    def clear(self):
+        """
+        Discards all pending values (e.g. values received before the handshake).
+        """
+        self.dropped += len(self.slots)
+        self.slots.clear()
+
+    def stats(self):
+        """
+        Returns the statistics of the mailbox as dictionary.
+        """
+        return {
+            'received': self.received,
+            'coalesced': self.coalesced,
+            'dropped': self.dropped,
+            'pending': len(self.slots),
+        }
+#endregion
+
+#region UartWriter
+class UartWriter(object):
+    """
+    Writer of the ICU frames (smartphone -> Teensy) with backpressure.
+
+    The transport calls pause_writing/resume_writing of the protocol (forwarded to
+    pause/resume), when its write buffer exceeds the high water mark or drains
+    below the low water mark. A serial port buffers in the driver first (while the
+    Teensy holds CTS, the driver's output queue fills up before the transport
+    buffers anything), so the queue of the driver (out_waiting) is checked as well
+    and polled while paused. After a write, the driver queue is only checked, if
+    the transport buffers data (the driver didn't take all of it), not after every
+    frame (one ioctl per frame). While paused, no frame is written: only the
+    newest frame is kept and a pending frame is replaced by a newer one
+    (coalesced), so the stale frames can't pile up and the Teensy gets the newest
+    setpoint after the stall.
+    """
+    POLL_INTERVAL = 0.001       # seconds between the checks of the driver queue
+
+    def __init__(self, transport, high=None, low=None, recorder=None):
+        """
+        Constructor:
+        Sets the write buffer limits (bytes) of the transport (None --> default of
+        the transport, the driver queue isn't checked). Every written frame is
+        recorded by the flight recorder (optional).
+        """
+        self.transport = transport
+        self.recorder = recorder
+        self.high = high
+        self.low = low if low is not None else 0
+        if high is not None or low is not None:
+            try:
+                transport.set_write_buffer_limits(high, low)
+            except NotImplementedError:
+                pass
+        # serial port of serial_asyncio.SerialTransport (None: other transports)
+        self.serial = getattr(transport, 'serial', None) if high is not None else None
+        self.paused = False
+        self.pending = None         # newest frame, which wasn't written (paused)
+        self.paused_since = 0
+        self.poll_handle = None
+
+        # statistics
+        self.written = 0            # frames written to the transport
+        self.coalesced = 0          # frames replaced by a newer one while paused
+        self.pauses = 0             # stalls (transport paused or driver queue full)
+        self.stalled_ns = 0         # time spent paused (finished pauses)
+        self.max_depth = 0          # max. bytes queued (transport and driver)
+
+    def depth(self):
+        """
+        Returns the number of bytes, which are queued (transport and driver).
+        """
+        depth = self.transport.get_write_buffer_size()
+        if self.serial is not None:
+            try:
+                depth += self.serial.out_waiting
+            except Exception:
+                self.serial = None      # driver queue not available
+        return depth
+
+    def write(self, frame):
+        """
+        Writes the frame or keeps it until the stall is over. Returns True, if the
+        frame was written.
+        """
+        if self.paused:
+            if self.pending is not None:
+                self.coalesced += 1
+            self.pending = frame
+            return False
+        self.send(frame)
+        return True
+
+    def send(self, frame):
+        """
+        Writes the frame to the transport (the transport may pause in write).
+        """
+        self.transport.write(frame)
+        self.written += 1
+        if self.recorder is not None:
+            self.recorder.record(RECORD_CONTROL, frame)
+        depth = self.transport.get_write_buffer_size()
+        if depth:
+            depth = self.depth()
+        if depth > self.max_depth:
+            self.max_depth = depth
+        if self.serial is not None and depth > self.high:
+            self.pause()
+
+    def pause(self):
+        """
+        This method is called, when the write buffer of the transport (or the
+        queue of the driver) exceeds the high water mark.
+        """
+        if not self.paused:
+            self.paused = True
+            self.pauses += 1
+            self.paused_since = time.monotonic_ns()
+        if self.serial is not None and self.poll_handle is None:
+            self.poll_handle = asyncio.get_running_loop().call_later(self.POLL_INTERVAL,
+                                                                     self.poll)
+
+    def poll(self):
+        """
+        Checks the queue of the driver while paused.
+        """
+        self.poll_handle = None
+        if self.paused and self.transport.get_write_buffer_size() <= self.low:
+            self.resume()
+        elif self.paused:
+            self.pause()
+
+    def resume(self):
+        """
+        This method is called, when the write buffer of the transport drained below
+        the low water mark. Writes the pending frame, if the queue of the driver
+        drained as well.
+        """
+        if not self.paused:
+            return
+        if self.serial is not None and self.depth() > self.low:
+            self.pause()        # poll until the driver queue drained
+            return
+        self.paused = False
+        self.stalled_ns += time.monotonic_ns() - self.paused_since
+        frame = self.pending
+        if frame is not None:
+            self.pending = None
+            self.send(frame)
+
+    def stats(self):
+        """
+        Returns the statistics of the writer as dictionary (stalled: seconds, incl.
+        the current pause).
+        """
+        stalled = self.stalled_ns
+        if self.paused:
+            stalled += time.monotonic_ns() - self.paused_since
+        return {
+            'written': self.written,
+            'coalesced': self.coalesced,
+            'pauses': self.pauses,
+            'paused': int(self.paused),
+            'stalled': stalled / 1e9,
+            'depth': self.depth(),
+            'max_depth': self.max_depth,
+        }
+#endregion
+
+#region ControlWatchdog
+class ControlWatchdog(object):
+    """
+    Watchdog and link statistics of the control link (smartphone -> Pi).
+
+    arrived is called by the UDP protocol for every datagram of the client with
+    control authority: inter-arrival time and jitter (moving average of the
+    change of the inter-arrival time, like the RTP jitter without send times) and
+    the loss from the sequence numbers of the binary control packets. valid is
+    called for every decoded packet. Both only update integer counters (no
+    containers, no objects kept per packet).
+
+    The run task checks the time since the last valid packet: after the timeout
+    the failsafe ICU frame (precomputed) is written to the UART and repeated every
+    check interval, until valid packets arrive again.
+    """
+    def __init__(self, writer, timeout, failsafe_frame, check_interval=None):
+        """
+        Constructor: writer is the UartWriter, timeout the max. time (s) without a
+        valid packet, failsafe_frame the ICU frame (8 Bytes) for the failsafe
+        (default check interval: timeout / 5).
+        """
+        self.writer = writer
+        self.timeout_ns = int(timeout * 1e9)
+        self.failsafe_frame = bytes(failsafe_frame)
+        self.check_interval = check_interval or timeout / 5
+        self.armed = False          # True after the handshake
+        self.failsafe = False
+        self.failsafe_since = 0
+
+        self.addr = None            # client of the statistics
+        self.last_arrival = 0       # ns
+        self.last_interval = 0      # ns
+        self.last_seq = -1
+        self.last_valid = 0         # receive time of the last valid packet (ns)
+
+        # statistics
+        self.arrivals = 0           # datagrams of the control client
+        self.sequenced = 0          # packets with sequence number
+        self.lost = 0               # missing sequence numbers
+        self.duplicates = 0
+        self.reordered = 0          # packets older than the newest one
+        self.interval = 0           # moving average of the inter-arrival time (ns)
+        self.jitter = 0             # moving average of the inter-arrival change (ns)
+        self.failsafes = 0          # failsafe activations
+
+    def arrived(self, now, data, addr):
+        """
+        This method is called for every datagram of the control client (now: receive
+        time in ns).
+        """
+        if addr != self.addr:
+            # new control client: new sequence numbers and timing
+            self.addr = addr
+            self.last_arrival = 0
+            self.last_interval = 0
+            self.last_seq = -1
+        self.arrivals += 1
+        if self.last_arrival:
+            interval = now - self.last_arrival
+            self.interval += (interval - self.interval) >> 4
+            if self.last_interval:
+                change = interval - self.last_interval
+                if change < 0:
+                    change = -change
+                self.jitter += (change - self.jitter) >> 4
+            self.last_interval = interval
+        self.last_arrival = now
+
+        if len(data) == CONTROL_PACKET_SIZE and data[0] == CONTROL_PACKET_MAGIC:
+            seq = data[2] | data[3] << 8
+            self.sequenced += 1
+            if self.last_seq >= 0:
+                gap = (seq - self.last_seq) & 0xFFFF
+                if gap == 0:
+                    self.duplicates += 1
+                    return
+                if gap >= 0x8000:
+                    self.reordered += 1
+                    return
+                self.lost += gap - 1
+            self.last_seq = seq
+
+    def valid(self, received):
+        """
+        This method is called for every decoded packet (received: receive time in
+        ns). Ends the failsafe.
+        """
+        self.last_valid = received
+        if self.failsafe:
+            self.failsafe = False
+            print(f'Control link restored (failsafe for '
+                  f'{(time.monotonic_ns() - self.failsafe_since) / 1e9:.1f} s)', flush=True)
+
+    def arm(self):
+        """
+        Starts the watchdog (after the handshake, the timeout starts now).
+        """
+        self.last_valid = time.monotonic_ns()
+        self.armed = True
+
+    async def run(self):
+        """
+        Checks the control link every check interval and writes the failsafe
+        frame while the link is lost.
+        """
+        while True:
+            await asyncio.sleep(self.check_interval)
+            if not self.armed:
+                continue
+            now = time.monotonic_ns()
+            if now - self.last_valid <= self.timeout_ns:
+                continue
+            if not self.failsafe:
+                self.failsafe = True
+                self.failsafe_since = now
+                self.failsafes += 1
+                print(f'Control link lost ({(now - self.last_valid) / 1e9:.2f} s without '
+                      f'valid packet): failsafe', flush=True)
+            self.writer.write(self.failsafe_frame)
+
+    def stats(self):
+        """
+        Returns the link statistics as dictionary (times in s).
+        """
+        expected = self.sequenced + self.lost
+        return {
+            'arrivals': self.arrivals,
+            'lost': self.lost,
+            'loss': self.lost / expected if expected else 0.0,
+            'duplicates': self.duplicates,
+            'reordered': self.reordered,
+            'interval': self.interval / 1e9,
+            'jitter': self.jitter / 1e9,
+            'since_valid': (time.monotonic_ns() - self.last_valid) / 1e9
+                           if self.last_valid else 0.0,
+            'failsafe': int(self.failsafe),
+            'failsafes': self.failsafes,
+        }
+#endregion
@@ -0,0 +1,378 @@
+"""
+Flight recorder: records the raw telemetry frames (Teensy -> Pi, 32 Bytes) and the
+ICU control frames (Pi -> Teensy, 8 Bytes) with monotonic timestamps, so incidents
+can be replayed and analysed.
+
+The records are written into segment files (memory-mapped, preallocated). When a
+segment is full, the next one is started and the oldest segments beyond
+max_segments are deleted (ring of segment files). Segment file layout
+(little-endian):
+
+    header (64 Bytes): magic 'FREC', version, record size, records per segment,
+                       segment index, wall clock time and monotonic time (ns) of
+                       the start
+    records (48 Bytes each): monotonic time (ns, uint64), sequence number (uint32),
+                             type (uint8), payload length (uint8), reserved (2 Bytes),
+                             payload (32 Bytes, zero padded)
+
+A record with type 0 marks the end of the data (the rest of the preallocated file).
+
+Usage (export):
+    python flightrecorder.py info [directory]
+    python flightrecorder.py export [directory] --type telemetry --last 60 -o out.csv
+    python flightrecorder.py export [directory] --type control --start 1697000000 -o out.npy
+"""
+import config
+import mmap
+import os
+import struct
+import time
+from collections import namedtuple
+from threading import Event, Thread
+
+import icuprotocol
+from telemetrydata import TELEMETRY_FRAME, TelemetryData
+
+SEGMENT_MAGIC = b'FREC'
+SEGMENT_VERSION = 1
+SEGMENT_HEADER = struct.Struct('<4sHHIIdQ')
+HEADER_SIZE = 64
+
+RECORD_HEADER = struct.Struct('<QIBBH')
+PAYLOAD_SIZE = 32
+RECORD_SIZE = RECORD_HEADER.size + PAYLOAD_SIZE
+
+# record types
+RECORD_TELEMETRY = 1
+RECORD_CONTROL = 2
+
+RECORD_TYPES = {
+    'telemetry': RECORD_TELEMETRY,
+    'control': RECORD_CONTROL,
+}
+
+SEGMENT_NAME = 'segment-%08d.rec'
+
+_ZEROS = memoryview(bytes(PAYLOAD_SIZE))
+
+Record = namedtuple('Record', ('time', 'monotonic_ns', 'seq', 'type', 'payload'))
+
+
+#region FlightRecorder
+class FlightRecorder(Thread):
+    """
+    A Class that inherits from Thread and writes the records into the segment
+    files.
+
+    record is called on the event loop and only copies the record into a
+    preallocated staging ring (no syscall, no allocation). The thread copies the
+    staged records into the memory-mapped segment (one copy per batch), flushes it
+    every flush_interval seconds and rotates the segments, so slow writes of the SD
+    card never stall the control loop. If the thread falls behind by more than
+    staging_size records, new records are dropped (see dropped, the sequence
+    numbers have a gap).
+    """
+    def __init__(self, directory, segment_size=16 * 1024 * 1024, max_segments=8,
+                 staging_size=4096, flush_interval=1.0):
+        super(FlightRecorder, self).__init__(daemon=True)
+        self.directory = directory
+        self.records_per_segment = (segment_size - HEADER_SIZE) // RECORD_SIZE
+        self.max_segments = max_segments
+        self.flush_interval = flush_interval
+
+        self.staging = bytearray(staging_size * RECORD_SIZE)
+        self.staging_view = memoryview(self.staging)
+        self.capacity = staging_size
+        self.head = 0               # records staged (event loop)
+        self.tail = 0               # records written into the segment (thread)
+        self.seq = 0
+        self.stop_event = Event()
+
+        self.segment_index = None
+        self.segment_file = None
+        self.segment_map = None
+        self.position = 0           # records in the current segment
+
+        # statistics
+        self.dropped = 0            # records dropped (staging ring full)
+        self.segments = 0           # segments started
+
+        os.makedirs(directory, exist_ok=True)
+
+    def record(self, kind, payload):
+        """
+        Stages a record (kind: RECORD_TELEMETRY, RECORD_CONTROL; payload: bytes-like,
+        at most 32 Bytes). Only the staging ring is touched, never the file.
+        """
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+        head = self.head
+        if head - self.tail >= self.capacity:
+            self.dropped += 1
+            return
+        offset = (head % self.capacity) * RECORD_SIZE
+        length = len(payload)
+        RECORD_HEADER.pack_into(self.staging, offset, time.monotonic_ns(), self.seq,
+                                kind, length, 0)
+        offset += RECORD_HEADER.size
+        self.staging_view[offset:offset + length] = payload
+        if length < PAYLOAD_SIZE:
+            self.staging_view[offset + length:offset + PAYLOAD_SIZE] = _ZEROS[length:]
+        self.head = head + 1
+
+    def run(self):
+        """
+        This function writes the staged records until the recorder is stopped.
+        """
+        self.open_segment()
+        last_flush = time.monotonic()
+        while not self.stop_event.wait(0.05):
+            self.write_staged()
+            if time.monotonic() - last_flush >= self.flush_interval:
+                self.segment_map.flush()
+                last_flush = time.monotonic()
+        self.write_staged()
+        self.close_segment()
+
+    def write_staged(self):
+        """
+        This method copies the staged records into the segment (rotates the segment,
+        if it is full).
+        """
+        head = self.head
+        tail = self.tail
+        while tail < head:
+            if self.position >= self.records_per_segment:
+                self.close_segment()
+                self.open_segment()
+            start = tail % self.capacity
+            count = min(head - tail, self.capacity - start,
+                        self.records_per_segment - self.position)
+            offset = HEADER_SIZE + self.position * RECORD_SIZE
+            self.segment_map[offset:offset + count * RECORD_SIZE] = \
+                self.staging_view[start * RECORD_SIZE:(start + count) * RECORD_SIZE]
+            self.position += count
+            tail += count
+            self.tail = tail
+
+    def open_segment(self):
+        """
+        This method creates the next segment file (preallocated) and deletes the
+        oldest segments.
+        """
+        indexes = segment_indexes(self.directory)
+        if self.segment_index is None:
+            self.segment_index = indexes[-1] + 1 if indexes else 1
+        else:
+            self.segment_index += 1
+        for index in indexes[:max(0, len(indexes) + 1 - self.max_segments)]:
+            os.remove(os.path.join(self.directory, SEGMENT_NAME % index))
+
+        size = HEADER_SIZE + self.records_per_segment * RECORD_SIZE
+        filename = os.path.join(self.directory, SEGMENT_NAME % self.segment_index)
+        self.segment_file = open(filename, 'w+b')
+        try:
+            os.posix_fallocate(self.segment_file.fileno(), 0, size)
+        except (AttributeError, OSError):
+            self.segment_file.truncate(size)
+        self.segment_map = mmap.mmap(self.segment_file.fileno(), size)
+        SEGMENT_HEADER.pack_into(self.segment_map, 0, SEGMENT_MAGIC, SEGMENT_VERSION,
+                                 RECORD_SIZE, self.records_per_segment,
+                                 self.segment_index, time.time(), time.monotonic_ns())
+        self.position = 0
+        self.segments += 1
+
+    def close_segment(self):
+        """
+        This method flushes and closes the current segment (the unused part of the
+        file is cut off).
+        """
+        self.segment_map.flush()
+        self.segment_map.close()
+        self.segment_file.truncate(HEADER_SIZE + self.position * RECORD_SIZE)
+        self.segment_file.close()
+        self.segment_map = None
+        self.segment_file = None
+
+    def stop_thread(self):
+        """
+        Stops the thread after writing the staged records.
+        """
+        self.stop_event.set()
+        self.join()
+
+    def stats(self):
+        """
+        Returns the statistics of the recorder as dictionary.
+        """
+        return {
+            'seq': self.seq,
+            'staged': self.head - self.tail,
+            'dropped': self.dropped,
+            'segments': self.segments,
+        }
+#endregion
+
+#region reader
+def segment_indexes(directory):
+    """
+    Returns the sorted indexes of the segment files in the directory.
+    """
+    indexes = []
+    for name in os.listdir(directory):
+        if name.startswith('segment-') and name.endswith('.rec'):
+            try:
+                indexes.append(int(name[8:-4]))
+            except ValueError:
+                pass
+    return sorted(indexes)
+
+
+def read_segment(filename):
+    """
+    Iterates over the records of a segment file (oldest first).
+    """
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if len(data) < HEADER_SIZE:
+        return
+    (magic, version, record_size, records, index,
+     wall_time, monotonic_ns) = SEGMENT_HEADER.unpack_from(data)
+    if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION:
+        raise ValueError(f'Invalid segment file: {filename}')
+    view = memoryview(data)
+    for offset in range(HEADER_SIZE, len(data) - record_size + 1, record_size):
+        record_ns, seq, kind, length, reserved = RECORD_HEADER.unpack_from(data, offset)
+        if kind == 0:
+            break
+        payload = bytes(view[offset + RECORD_HEADER.size:
+                             offset + RECORD_HEADER.size + length])
+        yield Record(wall_time + (record_ns - monotonic_ns) / 1e9, record_ns, seq,
+                     kind, payload)
+
+
+def read_records(directory, start=None, end=None, kind=None):
+    """
+    Iterates over the records of all segments (oldest first). start and end limit
+    the wall clock time (unix seconds), kind the record type.
+    """
+    for index in segment_indexes(directory):
+        for record in read_segment(os.path.join(directory, SEGMENT_NAME % index)):
+            if kind is not None and record.type != kind:
+                continue
+            if start is not None and record.time < start:
+                continue
+            if end is not None and record.time > end:
+                continue
+            yield record
+
+
+def decode_record(record):
+    """
+    Returns the decoded values of a record: the 8 telemetry floats or the ICU
+    values (Pitch, Roll, Yaw, Power, PitchG, RollG, YawG).
+    """
+    if record.type == RECORD_TELEMETRY:
+        return TELEMETRY_FRAME.unpack(record.payload)
+    if record.type == RECORD_CONTROL:
+        return icuprotocol.decode(record.payload)
+    raise ValueError(f'Unknown record type: {record.type}')
+#endregion
+
+#region export
+CONTROL_FIELDS = ('Pitch', 'Roll', 'Yaw', 'Power', 'PitchG', 'RollG', 'YawG')
+
+def record_fields(kind):
+    """
+    Returns the names of the decoded values of a record type.
+    """
+    if kind == RECORD_TELEMETRY:
+        return TelemetryData.__slots__[1:]
+    return CONTROL_FIELDS
+
+
+def export_csv(records, kind, filename):
+    """
+    Writes the records (one type) into a CSV file. Returns the number of records.
+    """
+    import csv
+
+    count = 0
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(('time', 'monotonic_ns', 'seq') + record_fields(kind))
+        for record in records:
+            writer.writerow((repr(record.time), record.monotonic_ns, record.seq)
+                            + decode_record(record))
+            count += 1
+    return count
+
+
+def export_numpy(records, kind, filename):
+    """
+    Writes the records (one type) into a NumPy file (.npy, structured array).
+    Returns the number of records.
+    """
+    try:
+        import numpy as np
+    except ImportError:
+        raise SystemExit('NumPy export needs numpy (pip install numpy)')
+
+    value_type = np.float32 if kind == RECORD_TELEMETRY else np.int16
+    dtype = np.dtype([('time', np.float64), ('monotonic_ns', np.uint64), ('seq', np.uint32)]
+                     + [(name, value_type) for name in record_fields(kind)])
+    rows = [(record.time, record.monotonic_ns, record.seq) + decode_record(record)
+            for record in records]
+    np.save(filename, np.array(rows, dtype=dtype))
+    return len(rows)
+
+
+def main(argv=None):
+    """
+    Command line interface: info and export of the recorded data.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Flight recorder data export')
+    commands = parser.add_subparsers(dest='command', required=True)
+    info = commands.add_parser('info', help='show the segments and the time range')
+    info.add_argument('directory', nargs='?', default=config.FLIGHT_RECORDER_DIR)
+    export = commands.add_parser('export', help='export a time range to CSV or NumPy')
+    export.add_argument('directory', nargs='?', default=config.FLIGHT_RECORDER_DIR)
+    export.add_argument('--type', choices=RECORD_TYPES, default='telemetry')
+    export.add_argument('--start', type=float, help='start time (unix seconds)')
+    export.add_argument('--end', type=float, help='end time (unix seconds)')
+    export.add_argument('--last', type=float,
+                        help='only the last LAST seconds of the recording')
+    export.add_argument('-o', '--output', required=True,
+                        help='output file (.csv or .npy)')
+    args = parser.parse_args(argv)
+
+    if args.command == 'info':
+        for index in segment_indexes(args.directory):
+            records = list(read_segment(os.path.join(args.directory, SEGMENT_NAME % index)))
+            if records:
+                print(f'{SEGMENT_NAME % index}: {len(records)} records, '
+                      f'{time.ctime(records[0].time)} - {time.ctime(records[-1].time)}')
+            else:
+                print(f'{SEGMENT_NAME % index}: empty')
+        return
+
+    kind = RECORD_TYPES[args.type]
+    start = args.start
+    if args.last is not None:
+        last = None
+        for record in read_records(args.directory, kind=kind):
+            last = record.time
+        if last is not None:
+            start = max(start or 0, last - args.last)
+    records = read_records(args.directory, start, args.end, kind)
+    if args.output.endswith('.npy'):
+        count = export_numpy(records, kind, args.output)
+    else:
+        count = export_csv(records, kind, args.output)
+    print(f'{count} records exported to {args.output}')
+#endregion
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+import asyncio
+import time
+from collections import deque
+from threading import Condition, Thread
+
+from output import nal_type, NAL_IDR, NAL_SPS, NAL_PPS
+
+# a decoder can (re)start at these NAL units
+KEYFRAME_TYPES = (NAL_SPS, NAL_PPS, NAL_IDR)
+
+#region SendQueue
+class SendQueue(object):
+    """
+    Base class of the send queues of the websocket clients (ClientFrameQueue,
+    TelemetryClient). The producer (broadcast thread, telemetry channel) changes
+    the queue while holding the condition and wakes up the sender, the sender
+    (FrameSender thread or the coroutine of an asyncio websocket) takes the
+    messages with get. A subclass implements poll: the next message or None, if
+    there is nothing to send. After a message, the next one is taken at the
+    earliest interval seconds later (throttle, 0 --> no limit).
+    """
+    def __init__(self, interval=0):
+        self.condition = Condition()
+        self.interval = interval
+        self.next_time = 0          # earliest time of the next message (monotonic)
+        self.closed = False
+
+        # statistics
+        self.sent = 0               # messages sent to the client
+
+    def poll(self):
+        """
+        Removes and returns the next message or returns None, if there is nothing
+        to send (called while holding the condition).
+        """
+        raise NotImplementedError
+
+    def take(self):
+        """
+        Returns the next message (poll) and starts the interval (called while
+        holding the condition).
+        """
+        message = self.poll()
+        if message is not None and self.interval:
+            self.next_time = time.monotonic() + self.interval
+        return message
+
+    def wake(self):
+        """
+        Wakes up the sender (called while holding the condition).
+        """
+        self.condition.notify()
+
+    def get(self, timeout=None):
+        """
+        Waits for the next message and returns it. Returns None, if the queue is
+        closed or the timeout expired.
+        """
+        with self.condition:
+            delay = self.next_time - time.monotonic()
+            if delay > 0:
+                self.condition.wait_for(lambda: self.closed, delay)
+            end = time.monotonic() + timeout if timeout is not None else None
+            while not self.closed:
+                message = self.take()
+                if message is not None:
+                    return message
+                remaining = end - time.monotonic() if end is not None else None
+                if remaining is not None and remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return None
+
+    def close(self):
+        """
+        Closes the queue and wakes up the sender.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+class AsyncSendQueue(object):
+    """
+    Mixin for the send queues of the asyncio server (AsyncClientFrameQueue,
+    AsyncTelemetryClient): same queue, but the sender is a coroutine, which waits
+    for an asyncio.Event instead of the condition. All methods must be called on
+    the event loop.
+    """
+    def __init__(self, *args, **kwargs):
+        super(AsyncSendQueue, self).__init__(*args, **kwargs)
+        self.event = asyncio.Event()
+
+    def wake(self):
+        """
+        Wakes up the sender.
+        """
+        self.event.set()
+
+    async def get(self):
+        """
+        Waits for the next message and returns it. Returns None, if the queue is
+        closed.
+        """
+        while not self.closed:
+            self.event.clear()
+            delay = self.next_time - time.monotonic()
+            if delay > 0:
+                # throttled, but close wakes up the sender
+                try:
+                    await asyncio.wait_for(self.event.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            message = self.take()
+            if message is not None:
+                return message
+            await self.event.wait()
+        return None
+
+    def close(self):
+        """
+        Closes the queue and wakes up the sender.
+        """
+        super(AsyncSendQueue, self).close()
+        self.event.set()
+#endregion
+
+#region ClientFrameQueue
+class ClientFrameQueue(SendQueue):
+    """
+    Bounded send queue of one websocket client.
+
+    The broadcast thread only puts frames into the queues of the clients and never
+    waits for a socket, so one slow client can't stall the others. If a client
+    falls behind (queue is full), its queued frames are dropped and the queue
+    restarts at the next keyframe (SPS/PPS/IDR), because P-frames can't be decoded
+    without the frames before them.
+    """
+    def __init__(self, maxlen):
+        super(ClientFrameQueue, self).__init__()
+        self.frames = deque()
+        self.maxlen = maxlen
+        self.limit = maxlen         # raised by prefill until the client caught up
+        self.resync = True          # True: waiting for the next keyframe (a new 
+                                    # client starts at a decodable point)
+
+        # statistics
+        self.dropped = 0            # frames dropped because the client fell behind
+
+    @property
+    def depth(self):
+        """
+        Returns the number of queued frames.
+        """
+        return len(self.frames)
+
+    def put(self, frame):
+        """
+        Puts a frame (NAL unit) into the queue. Returns False, if the frame was
+        dropped.
+        """
+        with self.condition:
+            if self.closed:
+                return False
+            keyframe = nal_type(frame) in KEYFRAME_TYPES
+            if self.resync:
+                if not keyframe:
+                    self.dropped += 1
+                    return False
+                self.resync = False
+            elif len(self.frames) >= self.limit:
+                # client fell behind --> drop the queued frames and restart at 
+                # the next keyframe
+                self.dropped += len(self.frames)
+                self.frames.clear()
+                if not keyframe:
+                    self.resync = True
+                    self.dropped += 1
+                    return False
+            self.frames.append(frame)
+            self.wake()
+            return True
+
+    def prefill(self, frames):
+        """
+        Puts the cached keyframes of a new client into the queue (without size 
+        limit, the client is expected to catch up).
+        """
+        with self.condition:
+            if not frames:
+                return
+            self.frames.extend(frames)
+            self.limit = self.maxlen + len(frames)
+            self.resync = False
+            self.wake()
+
+    def skip(self):
+        """
+        Drops the queued frames, the queue restarts at the next keyframe (e.g. the 
+        stream was restarted with a lower video profile, the backlog of the old 
+        stream would only delay it).
+        """
+        with self.condition:
+            self.dropped += len(self.frames)
+            self.frames.clear()
+            self.limit = self.maxlen
+            self.resync = True
+
+    def poll(self):
+        """
+        Removes and returns the next frame or returns None, if the queue is empty.
+        """
+        if not self.frames:
+            return None
+        frame = self.frames.popleft()
+        if self.limit > self.maxlen and len(self.frames) < self.maxlen:
+            self.limit = self.maxlen
+        return frame
+
+    def close(self):
+        """
+        Closes the queue and wakes up the sender.
+        """
+        with self.condition:
+            self.frames.clear()
+            super(ClientFrameQueue, self).close()
+
+    def stats(self):
+        """
+        Returns the statistics of the queue as dictionary.
+        """
+        return {
+            'depth': len(self.frames),
+            'sent': self.sent,
+            'dropped': self.dropped,
+        }
+
+class AsyncClientFrameQueue(AsyncSendQueue, ClientFrameQueue):
+    """
+    ClientFrameQueue for the asyncio server: same drop policy, but the sender is a 
+    coroutine (see AsyncSendQueue).
+    """
+#endregion
+
+#region FrameSender
+class FrameSender(Thread):
+    """
+    A Class that inherits from Thread and sends the messages of a send queue 
+    (ClientFrameQueue, TelemetryClient) to one websocket (anything with a 
+    send(data, binary) method).
+    """
+    def __init__(self, websocket, queue, first=None):
+        """
+        Constructor: first is a text message, which is sent before the messages of
+        the queue (e.g. the telemetry schema).
+        """
+        super(FrameSender, self).__init__(daemon=True)
+        self.websocket = websocket
+        self.queue = queue
+        self.first = first
+
+    def run(self):
+        """
+        This function sends the messages (binary) until the queue is closed or 
+        sending fails.
+        """
+        try:
+            if self.first is not None:
+                self.websocket.send(self.first, binary=False)
+            while True:
+                message = self.queue.get()
+                if message is None:
+                    break
+                self.websocket.send(message, binary=True)
+                self.queue.sent += 1
+        except Exception as e:
+            print(f'Sending failed: {e}', flush=True)
+            self.queue.close()
+#endregion
@@ -1,12 +1,11 @@
-import io
 import config
+import metrics
 
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from ws4py.websocket import WebSocket
-from string import Template
-from os import curdir, sep
-
-from time import time 
+from assetcache import AssetCache
+from framequeue import ClientFrameQueue, FrameSender
+from telemetrystream import SCHEMA, TelemetryClient, client_rate
 
 
 #region streaming httphandler
@@ -24,7 +23,8 @@ class StreamingHttpHandler(BaseHTTPRequestHandler):
 
     def do_GET(self):
         """
-        This method responds to HTTP GET requests.
+        This method responds to HTTP GET requests. index.html, js and css are 
+        served from the asset cache of the server (gzip, ETag, 304 Not Modified).
         """
         #Serve index.html
         if self.path == '/':
@@ -32,44 +32,38 @@ class StreamingHttpHandler(BaseHTTPRequestHandler):
             self.send_header('Location', '/index.html')
             self.end_headers()
             return
-        elif self.path == '/index.html':
-            content_type = 'text/html; charset=utf-8'
-            tpl = Template(self.server.index_template)
-            content = tpl.safe_substitute(dict(
-                ADDRESS='%s:%d' % (self.request.getsockname()[0], config.WS_PORT)
-                ))
-        #Serve js
-        elif self.path.startswith('/js/'):
-            f = open(curdir + sep + self.path)
-            
-            self.send_response(200)
-            self.send_header('Content-type',    'application/javascript')
-            self.end_headers()
-            self.wfile.write(bytes(f.read(),encoding='utf-8'))
-            f.close()
-            return
-        #Serve css
-        elif self.path.startswith('/css/'):
-            f = open(curdir + sep + self.path)
+        
+        #Serve the metrics (Prometheus text format)
+        if self.path == '/metrics':
+            content = metrics.render()
             self.send_response(200)
-            self.send_header('Content-type',    'text/css')
+            self.send_header('Content-Type', metrics.CONTENT_TYPE)
+            self.send_header('Content-Length', len(content))
             self.end_headers()
-            self.wfile.write(bytes(f.read(),encoding='utf-8'))
-            f.close()
+            if self.command == 'GET':
+                self.wfile.write(content)
             return
-            
-        else:
+        
+        #Serve index.html, js and css
+        asset = self.server.asset_cache.get(self.path, self.request.getsockname()[0])
+        if asset is None:
             self.send_error(404, 'File not found')
             return
-        content = content.encode('utf-8')
-
-        self.send_response(200)
-        self.send_header('Content-Type', content_type)
-        self.send_header('Content-Length', len(content))
-        self.send_header('Last-Modified', self.date_time_string(time()))
+        
+        status, headers, body, filename = asset.response(
+            {name.lower(): value for name, value in self.headers.items()})
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
         self.end_headers()
-        if self.command == 'GET':
-            self.wfile.write(content)
+        if self.command != 'GET' or status != 200:
+            return
+        if filename is not None:
+            # zero-copy: the kernel sends the file
+            with open(filename, 'rb') as f:
+                self.connection.sendfile(f)
+        else:
+            self.wfile.write(body)
 
 
 
@@ -82,24 +76,82 @@ class StreamingHttpServer(HTTPServer):
         """
         Constructor: 
         Initializes the HTTPServer class, sets the HTTP-PORT and 
-        StreamingHttpHandler handler. Then it reads and saves the index.html 
-        file into index_template variable.
+        StreamingHttpHandler handler. Then it preloads index.html, js and css 
+        into the asset cache.
         """
         super(StreamingHttpServer, self).__init__(
                     ('', config.HTTP_PORT), StreamingHttpHandler)
-        with io.open('index.html', 'r') as f:
-            self.index_template = f.read()
+        self.asset_cache = AssetCache(config.WS_PORT)
 
 
 class StreamingWebSocket(WebSocket):
+    output = None           # StreamingOutput (set by the server)
+    frame_queue = None      # ClientFrameQueue (set when the socket is opened)
+    
     def opened(self):
         """
         This method is called, when socket is opened. It also prints, when new clients 
-        are connected.
+        are connected. Every client gets its own bounded send queue and sender thread, 
+        so a slow client doesn't stall the broadcast to the others. The queue starts 
+        with the cached keyframes, so the client can decode the stream immediately.
         """
         print("New client connected", flush=True)
+        self.frame_queue = ClientFrameQueue(config.WS_QUEUE_SIZE)
+        self.output.subscribe(self.frame_queue)
+        FrameSender(self, self.frame_queue).start()
         # you can override various WebSocket class methods
         # to do more stuff with WebSockets other than streaming
+    
+    def closed(self, code, reason=None):
+        """
+        This method is called, when socket is closed. Stops the sender thread.
+        """
+        if self.frame_queue is not None:
+            print(f'Client disconnected (dropped frames: {self.frame_queue.dropped})', 
+                  flush=True)
+            self.output.unsubscribe(self.frame_queue)
+            self.frame_queue.close()
+
+
+class TelemetryWebSocket(WebSocket):
+    channel = None          # TelemetryChannel (set by the server)
+    client = None           # TelemetryClient (set when the socket is opened)
+    
+    def opened(self):
+        """
+        This method is called, when socket is opened (path /telemetry). The client 
+        gets its own update state and sender thread (throttled to 
+        config.WS_TELEMETRY_RATE or the rate of the query string).
+        """
+        print("New telemetry client connected", flush=True)
+        rate = client_rate(self.environ.get('QUERY_STRING', ''), config.WS_TELEMETRY_RATE)
+        self.client = TelemetryClient(self.channel, rate)
+        self.channel.subscribe(self.client)
+        FrameSender(self, self.client, SCHEMA).start()
+    
+    def closed(self, code, reason=None):
+        """
+        This method is called, when socket is closed. Stops the sender thread.
+        """
+        if self.client is not None:
+            print(f'Telemetry client disconnected (updates: {self.client.sent})', 
+                  flush=True)
+            self.channel.unsubscribe(self.client)
+            self.client.close()
+
+
+class WebSocketRouter(object):
+    """
+    WSGI application, which passes a websocket request to the application of its 
+    path (default: the video stream).
+    """
+    def __init__(self, default, routes):
+        self.default = default
+        self.routes = routes
+    
+    def __call__(self, environ, start_response):
+        app = self.routes.get(environ.get('PATH_INFO', '/'), self.default)
+        return app(environ, start_response)
   
 #endregion      
 
@@ -0,0 +1,71 @@
+"""
+Encoder/decoder for the ICU protocol (Pi -> Teensy control frames).
+
+An ICU frame is a 64 Bit little-endian word with the following bit layout:
+
+    bit  0..10  Power   (11 Bits)
+    bit 11..21  Yaw     (11 Bits)
+    bit 22..32  Pitch   (11 Bits)
+    bit 33..43  Roll    (11 Bits)
+    bit 44..53  YawG    (10 Bits)
+    bit 54..63  PitchG  (10 Bits)
+
+RollG is not part of the frame. Instead of building every byte with shifts and
+masks, the fields are packed into one integer and written with a single
+precompiled struct.
+"""
+import struct
+
+FRAME_SIZE = 8
+
+_FRAME = struct.Struct('<Q')
+
+
+def pack(pitch, roll, yaw, power, pitchg, yawg):
+    """
+    Packs the control values into the 64 Bit ICU word. Raises ValueError, if a
+    value doesn't fit into its field (0..2047, PitchG/YawG: 0..1023): a value is
+    never wrapped, e.g. Power -1 would be 0x7FF (full power).
+    """
+    if not (0 <= pitch <= 0x7FF and 0 <= roll <= 0x7FF and 0 <= yaw <= 0x7FF
+            and 0 <= power <= 0x7FF and 0 <= pitchg <= 0x3FF and 0 <= yawg <= 0x3FF):
+        raise ValueError(f'Control value out of range: Pitch {pitch}, Roll {roll}, '
+                         f'Yaw {yaw}, Power {power}, PitchG {pitchg}, YawG {yawg}')
+    return (power
+            | yaw << 11
+            | pitch << 22
+            | roll << 33
+            | yawg << 44
+            | pitchg << 54)
+
+
+def encode(pitch, roll, yaw, power, pitchg, yawg):
+    """
+    Encodes the control values into an ICU frame and returns 8 bytes.
+    """
+    return _FRAME.pack(pack(pitch, roll, yaw, power, pitchg, yawg))
+
+
+def encode_into(buffer, offset, pitch, roll, yaw, power, pitchg, yawg):
+    """
+    Encodes the control values into a preallocated buffer (bytearray or writable
+    memoryview) at the given offset without allocating a new frame.
+    """
+    _FRAME.pack_into(buffer, offset, pack(pitch, roll, yaw, power, pitchg, yawg))
+
+
+def decode(frame, offset=0):
+    """
+    Decodes an ICU frame and returns the tuple
+    (Pitch, Roll, Yaw, Power, PitchG, RollG, YawG). RollG is always 0, because it is
+    not transmitted.
+    """
+    word, = _FRAME.unpack_from(frame, offset)
+    return ((word >> 22) & 0x7FF,
+            (word >> 33) & 0x7FF,
+            (word >> 11) & 0x7FF,
+            word & 0x7FF,
+            (word >> 54) & 0x3FF,
+            0,
+            (word >> 44) & 0x3FF)
+
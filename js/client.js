@@ -3,6 +3,7 @@
 // 				removed the statistics
 
 startStream('container', window.location.protocol.replace(/http/, 'ws')+'//'+window.location.hostname+':8084', true, 'auto', 0)
+startTelemetry('telemetry', window.location.protocol.replace(/http/, 'ws')+'//'+window.location.hostname+':8084/telemetry', 1000)
 
 function startStream(playerId, wsUri, useWorker, webgl, reconnectMs) {
 	if (!window.player) {
@@ -65,6 +66,44 @@ function startStream(playerId, wsUri, useWorker, webgl, reconnectMs) {
 	}
 }
 
+// telemetry overlay: the server sends the schema (JSON) once, then binary updates 
+// with the changed fields only (see telemetrystream.py)
+function startTelemetry(overlayId, wsUri, reconnectMs) {
+	var overlay = document.getElementById(overlayId)
+	var schema = null
+	var values = []
+
+	var ws = new WebSocket(wsUri)
+	ws.binaryType = 'arraybuffer'
+	ws.onmessage = function (msg) {
+		if (typeof msg.data === 'string') {
+			schema = JSON.parse(msg.data)
+			values = schema.fields.map(function() { return NaN })
+			return
+		}
+		if (!schema) return
+		var view = new DataView(msg.data)
+		var mask = view.getUint8(0)
+		var offset = 1
+		for (var i = 0; i < schema.fields.length; i++) {
+			if (mask & (1 << i)) {
+				var value = view.getInt32(offset, true)
+				offset += 4
+				values[i] = value == schema.novalue ? NaN : value * schema.steps[i]
+			}
+		}
+		overlay.textContent = schema.fields.map(function(name, i) {
+			var decimals = Math.max(0, Math.round(-Math.log10(schema.steps[i])))
+			return name + ' ' + values[i].toFixed(decimals)
+		}).join('   ')
+	}
+	ws.onclose = function (e) {
+		if (reconnectMs > 0) {
+			setTimeout(function() { startTelemetry(overlayId, wsUri, reconnectMs) }, reconnectMs)
+		}
+	}
+}
+
 // debugger stuff
 function avgFPS(length) {
 	this.index = 0
@@ -0,0 +1,166 @@
+"""
+Load test of the video streaming pipeline without the Pi hardware: runs the video
+server (config.SERVER_MODE or --mode) with a recorded (--file) or synthetic
+camera source (see camerasource.py) and N simulated websocket viewers in
+separate processes. Reports the throughput and the lag (capture --> receive) of
+every viewer and the CPU usage of the server process.
+
+The camera puts its time stamp into every frame, the stream isn't decodable by
+the viewers (they only measure).
+
+Usage:
+    python loadtest.py --viewers 16 --duration 10
+    python loadtest.py --file video.h264 --speed 2 --processes 4 --mode threaded
+"""
+import argparse
+import asyncio
+import base64
+import multiprocessing
+import os
+import time
+
+import config
+from camerasource import FileCamera, SyntheticCamera
+from output import StreamingOutput
+
+
+def percentile(values, p):
+    """
+    Returns the p-th percentile of the values (nearest rank).
+    """
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def websocket_viewer(host, port, duration):
+    """
+    Connects to the websocket server, receives frames for duration seconds and
+    returns the tuple (frames, bytes, latencies in ms) of the stamped frames.
+    """
+    from async_http_server import read_frame
+
+    reader, writer = await asyncio.open_connection(host, port)
+    key = base64.b64encode(os.urandom(16)).decode()
+    writer.write((f'GET / HTTP/1.1\r\nHost: {host}:{port}\r\nUpgrade: websocket\r\n'
+                  f'Connection: Upgrade\r\nSec-WebSocket-Key: {key}\r\n'
+                  f'Sec-WebSocket-Version: 13\r\n\r\n').encode())
+    await reader.readuntil(b'\r\n\r\n')
+
+    loop = asyncio.get_running_loop()
+    end = loop.time() + duration
+    frames = received = 0
+    latencies = []
+    while True:
+        timeout = end - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            opcode, payload = await asyncio.wait_for(read_frame(reader, 2**24), timeout)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+            break
+        frames += 1
+        received += len(payload)
+        stamp = payload[5:25]
+        if stamp.isdigit():
+            latencies.append((time.monotonic_ns() - int(stamp)) / 1e6)
+    writer.close()
+    return frames, received, latencies
+
+
+def run_viewers(viewers, duration, results, host='127.0.0.1', port=None):
+    """
+    Runs the websocket viewers (in a separate process) and puts their results into
+    the results queue.
+    """
+    port = port or config.WS_PORT
+
+    async def run():
+        return await asyncio.gather(*(websocket_viewer(host, port, duration)
+                                      for _ in range(viewers)))
+    results.put(asyncio.run(run()))
+
+
+async def run_load(camera, mode, viewers, duration, processes=1):
+    """
+    Starts the video server with the camera, runs the viewers (distributed over
+    processes) and stops the server. Returns the tuple (server CPU share, list of
+    viewer results).
+    """
+    from videoserver import create_video_server
+
+    output = StreamingOutput(config.KEYFRAME_CACHE_SIZE)
+    server = create_video_server(camera, output, mode, adaptation=False)
+    await server.start()
+    await asyncio.sleep(0.5)
+
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    counts = [viewers // processes + (i < viewers % processes) for i in range(processes)]
+    workers = [context.Process(target=run_viewers, args=(count, duration, results))
+               for count in counts if count]
+    for worker in workers:
+        worker.start()
+    cpu = time.process_time()
+    wall = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    viewer_results = []
+    for worker in workers:
+        viewer_results.extend(await loop.run_in_executor(None, results.get))
+    cpu = time.process_time() - cpu
+    wall = time.perf_counter() - wall
+    for worker in workers:
+        worker.join()
+    await server.stop()
+    return cpu / wall, viewer_results
+
+
+def report(viewer_results, duration, cpu):
+    """
+    Prints the throughput and the lag of every viewer and the totals.
+    """
+    print(f'{"viewer":>6} {"frames":>7} {"Mbit/s":>7} {"lag p50":>8} {"p99":>8} {"max":>8}',
+          flush=True)
+    for i, (frames, received, latencies) in enumerate(viewer_results):
+        print(f'{i:>6} {frames:>7} {received * 8 / duration / 1e6:>7.2f} '
+              f'{percentile(latencies, 50):>8.1f} {percentile(latencies, 99):>8.1f} '
+              f'{max(latencies, default=float("nan")):>8.1f}', flush=True)
+    latencies = [latency for frames, received, lat in viewer_results for latency in lat]
+    received = sum(result[1] for result in viewer_results)
+    print(f'total: {len(viewer_results)} viewers, {received * 8 / duration / 1e6:.2f} Mbit/s, '
+          f'lag p50 {percentile(latencies, 50):.1f} ms p99 {percentile(latencies, 99):.1f} ms, '
+          f'server CPU {cpu * 100:.1f} %', flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--viewers', type=int, default=8, help='websocket viewers')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='processes for the viewers')
+    parser.add_argument('--duration', type=float, default=10, help='seconds')
+    parser.add_argument('--file', help='recorded h264 stream (default: synthetic stream)')
+    parser.add_argument('--framerate', type=float, default=config.FRAMERATE,
+                        help='frames per second of the camera source')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay speed (2: twice the framerate, 0: as fast as possible)')
+    parser.add_argument('--frame-size', type=int, default=20000,
+                        help='average P-frame size of the synthetic stream in bytes')
+    parser.add_argument('--mode', choices=('asyncio', 'threaded'), default=config.SERVER_MODE,
+                        help='video server')
+    args = parser.parse_args(argv)
+
+    if args.file:
+        camera = FileCamera(args.file, args.framerate, args.speed, stamp=True)
+    else:
+        camera = SyntheticCamera(args.framerate, args.speed, args.frame_size, stamp=True)
+    cpu, viewer_results = asyncio.run(run_load(camera, args.mode, args.viewers,
+                                               args.duration, args.processes))
+    report(viewer_results, args.duration, cpu)
+    if camera.late:
+        print(f'camera: {camera.late} of {camera.written} frames late', flush=True)
+
+
+if __name__ == '__main__':
+    main()
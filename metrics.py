@@ -0,0 +1,247 @@
+"""
+Low-overhead latency instrumentation of the hot paths and its export in the
+Prometheus text format (route /metrics of both HTTP servers).
+
+The stages take time.monotonic_ns() timestamps; the latencies between them are
+recorded into preallocated HDR-style histograms (log-linear buckets: 16 linear
+sub-buckets per power of two --> max. 6.25 % relative error, 1 ns to ~18 min).
+Recording is an integer bit_length and a list increment, no allocation.
+"""
+import math
+import os
+import time
+
+SUB_BUCKET_BITS = 4
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+MAX_EXPONENT = 35               # values up to 2**40 ns (~18 min), larger ones in the last bucket
+BUCKETS = SUB_BUCKETS + (MAX_EXPONENT + 1) * SUB_BUCKETS
+
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+#region Histogram
+class Histogram(object):
+    """
+    HDR-style histogram of durations in nanoseconds, exported as Prometheus summary
+    (quantiles, sum and count in seconds).
+    """
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def record(self, value):
+        """
+        Records a duration (ns).
+        """
+        if value < SUB_BUCKETS:
+            index = value if value > 0 else 0
+        else:
+            exponent = value.bit_length() - SUB_BUCKET_BITS - 1
+            index = SUB_BUCKETS + exponent * SUB_BUCKETS + (value >> exponent) - SUB_BUCKETS
+            if index >= BUCKETS:
+                index = BUCKETS - 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """
+        Returns the q-quantile (0..1) in ns (upper bound of its bucket, at most the
+        max. value) or nan, if nothing was recorded.
+        """
+        if not self.count:
+            return math.nan
+        rank = max(1, math.ceil(q * self.count))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bucket_upper(index), self.max)
+        return self.max
+
+    def reset(self):
+        """
+        Clears the histogram.
+        """
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def render(self):
+        """
+        Returns the Prometheus text lines of the histogram.
+        """
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s summary' % self.name]
+        for q in QUANTILES:
+            value = self.quantile(q)
+            lines.append('%s{quantile="%s"} %s' % (self.name, q, 'NaN' if math.isnan(value)
+                                                   else '%.9g' % (value / 1e9)))
+        lines.append('%s_sum %.9g' % (self.name, self.sum / 1e9))
+        lines.append('%s_count %d' % (self.name, self.count))
+        return lines
+
+
+def bucket_upper(index):
+    """
+    Returns the upper bound (ns) of a histogram bucket.
+    """
+    if index < SUB_BUCKETS:
+        return index + 1
+    exponent, sub_bucket = divmod(index - SUB_BUCKETS, SUB_BUCKETS)
+    return (SUB_BUCKETS + sub_bucket + 1) << exponent
+#endregion
+
+#region Counter
+class Counter(object):
+    """
+    Event counter, exported as Prometheus counter.
+    """
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def render(self):
+        """
+        Returns the Prometheus text lines of the counter.
+        """
+        return ['# HELP %s %s' % (self.name, self.help),
+                '# TYPE %s counter' % self.name,
+                '%s %d' % (self.name, self.value)]
+#endregion
+
+#region stages
+CONTROL_QUEUE = Histogram('control_queue_seconds',
+                          'UDP receive --> decode (wait in the control mailbox)')
+CONTROL_DECODE = Histogram('control_decode_seconds',
+                           'Decoding of the communication data (binary packet or JSON)')
+CONTROL_ENCODE = Histogram('control_encode_seconds', 'Encoding of the ICU frame')
+CONTROL_WRITE = Histogram('control_uart_write_seconds', 'UART write of the ICU frame')
+CONTROL_TOTAL = Histogram('control_latency_seconds', 'UDP receive --> UART write done')
+TELEMETRY_QUEUE = Histogram('telemetry_queue_seconds',
+                            'UART receive --> processing (wait in the UART queue)')
+TELEMETRY_TOTAL = Histogram('telemetry_latency_seconds',
+                            'UART receive --> UDP send (batched samples: until batched)')
+VIDEO_BROADCAST = Histogram('video_broadcast_seconds',
+                            'Frame captured --> frame put into the client queues')
+
+HISTOGRAMS = [CONTROL_QUEUE, CONTROL_DECODE, CONTROL_ENCODE, CONTROL_WRITE, CONTROL_TOTAL,
+              TELEMETRY_QUEUE, TELEMETRY_TOTAL, VIDEO_BROADCAST]
+
+CONTROL_INVALID = Counter('control_invalid_total', 'Invalid communication data')
+
+COUNTERS = [CONTROL_INVALID]
+#endregion
+
+#region startup
+class Startup(object):
+    """
+    Startup phases of the server: time (ms) since the start signal (the GPIO edge,
+    server_starter passes its time.monotonic_ns in the environment variable
+    START_TIME_NS) or, without it, since the process start.
+    """
+    def __init__(self):
+        self.phases = {}
+        self.start_ns = None
+        start = os.environ.get('START_TIME_NS')
+        process_start = process_start_ns()
+        if start:
+            self.start_ns = int(start)
+            if process_start is not None:
+                self.phases['process'] = (process_start - self.start_ns) / 1e6
+        else:
+            self.start_ns = process_start or time.monotonic_ns()
+
+    def mark(self, phase):
+        """
+        Records and prints the time of a phase (only the first time).
+        """
+        if phase in self.phases:
+            return
+        elapsed = (time.monotonic_ns() - self.start_ns) / 1e6
+        self.phases[phase] = elapsed
+        print(f'Startup: {phase} after {elapsed:.0f} ms', flush=True)
+
+    def stats(self):
+        """
+        Returns the phases (ms) as dictionary.
+        """
+        return {phase + '_ms': elapsed for phase, elapsed in self.phases.items()}
+
+
+def process_start_ns():
+    """
+    Returns the start time of the process (time.monotonic_ns, from /proc, Linux)
+    or None.
+    """
+    try:
+        with open('/proc/self/stat') as f:
+            stat = f.read()
+        ticks = int(stat[stat.rindex(')') + 2:].split()[19])
+        return ticks * 1000000000 // os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+STARTUP = Startup()
+#endregion
+
+#region export
+STATS = {}          # prefix -> function, which returns a dict of statistics
+REMOTE = []         # functions, which return the metrics text of other processes 
+                    # (bytes, see videoprocess.py)
+
+def register_stats(prefix, stats):
+    """
+    Registers the stats function of a component (e.g. SubscriberRegistry.stats).
+    Its numeric values are exported as gauges <prefix>_<name>.
+    """
+    STATS[prefix] = stats
+
+
+def render():
+    """
+    Returns all metrics in the Prometheus text format (bytes), followed by the
+    metrics of the other processes (REMOTE).
+    """
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    for counter in COUNTERS:
+        lines.extend(counter.render())
+    for prefix, stats in list(STATS.items()):
+        for name, value in stats().items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines.append('# TYPE %s_%s gauge' % (prefix, name))
+                lines.append('%s_%s %s' % (prefix, name, value))
+    text = ('\n'.join(lines) + '\n').encode('utf-8')
+    for remote in REMOTE:
+        text += remote()
+    return text
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+#endregion
+
+
+if __name__ == "__main__":
+    '''
+    Testprogramm for the histogram: the quantiles of random values must be within
+    the relative error of the buckets.
+    '''
+    import random
+
+    rng = random.Random(0)
+    values = sorted(int(rng.lognormvariate(11, 2)) for _ in range(100000))
+    histogram = Histogram('test_seconds', 'test')
+    for value in values:
+        histogram.record(value)
+    for q in QUANTILES:
+        exact = values[max(0, math.ceil(q * len(values)) - 1)]
+        assert exact <= histogram.quantile(q) <= exact * (1 + 1 / SUB_BUCKETS) + 1, q
+    print('\n'.join(histogram.render()))
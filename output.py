@@ -1,37 +1,298 @@
 # Origin: https://github.com/Onixaz/picamera-h264-web-streaming
 # Modified by: Mikail Yoelek
 
-from io import BytesIO
+import time
+
 from threading import Condition
 
+import metrics
+
+# NAL unit types (h264)
+NAL_SLICE = 1       # non-IDR slice (P-frame)
+NAL_IDR = 5         # IDR slice (keyframe)
+NAL_SPS = 7         # sequence parameter set
+NAL_PPS = 8         # picture parameter set
+
+def nal_type(frame):
+    """
+    Returns the NAL unit type of a frame (starting with 00 00 00 01), None if the 
+    frame is too short.
+    """
+    if len(frame) < 5:
+        return None
+    return frame[4] & 0x1F
+
+
+class NalSplitter(object):
+    """
+    This class splits a continuous h264 stream (Annex B) into NAL units.
+
+    Encoders like picamera write a slice (P- or IDR frame) as its own buffer,
+    which starts with the start code 00 00 00 01 (a big slice may be continued in
+    further buffers). Such a buffer (bytes) is kept without copy and passed to the
+    callback as it is, when the next NAL unit starts (slice_per_write). Other data
+    (continuations, parameter sets, several NAL units per buffer) is copied once
+    into a preallocated ring buffer and scanned once for the start code, also when
+    the start code is in the middle of a buffer or split across two buffers. These
+    NAL units (including their start code) are passed to the callback as
+    memoryview slices of the ring buffer (no copy).
+
+    A memoryview stays valid until the ring buffer wraps around (capacity bytes
+    later), so the capacity should be a multiple of the biggest frame.
+    """
+    SEPARATOR = b'\x00\x00\x00\x01'
+
+    def __init__(self, callback, capacity=4 * 1024 * 1024, slice_per_write=True):
+        """
+        Constructor: slice_per_write False --> every buffer is scanned (e.g. a
+        stream written in chunks of any size).
+        """
+        self.callback = callback
+        self.ring = bytearray(capacity)
+        self.view = memoryview(self.ring)
+        self.slice_per_write = slice_per_write
+        self.start = 0      # start of the pending (incomplete) NAL unit
+        self.end = 0        # write position
+        self.pending = None # pending slice, which was written as one buffer
+
+    def write(self, buf):
+        """
+        This method passes every NAL unit completed by the buffer to the callback.
+        Returns the number of written bytes.
+        """
+        separator = self.SEPARATOR
+        if (self.slice_per_write and type(buf) is bytes and len(buf) > 4
+                and 1 <= buf[4] & 0x1F <= 5 and buf.startswith(separator)):
+            # a slice: kept without copy until the next NAL unit starts
+            self._complete()
+            self.pending = buf
+            return len(buf)
+
+        if self.pending is not None:
+            pending = self.pending
+            self.pending = None
+            if buf[:4] == separator:
+                # a new NAL unit starts: the pending slice is complete
+                self.callback(pending)
+            else:
+                # data of the pending slice follows --> into the ring buffer
+                self._append(pending)
+        end = self._append(buf)
+
+        # scan only the new data (and the last 3 bytes before it for a start code,
+        # which is split across two buffers)
+        ring = self.ring
+        new_end = self.end
+        pos = max(self.start + 1, end - 3)
+        while True:
+            pos = ring.find(separator, pos, new_end)
+            if pos < 0:
+                break
+            self.callback(self.view[self.start:pos])
+            self.start = pos
+            pos += 4
+        return len(buf)
+
+    def flush(self):
+        """
+        This method passes the pending NAL unit to the callback (end of stream).
+        """
+        self._complete()
+        self.start = self.end = 0
+
+    def _complete(self):
+        """
+        This method passes the pending NAL unit (a new one starts) to the callback.
+        """
+        if self.pending is not None:
+            self.callback(self.pending)
+            self.pending = None
+        elif self.end > self.start:
+            self.callback(self.view[self.start:self.end])
+            self.start = self.end
+
+    def _append(self, buf):
+        """
+        This method appends the buffer to the ring buffer and returns the previous
+        write position.
+        """
+        size = len(buf)
+        if self.end + size > len(self.ring):
+            self._wrap(size)
+        end = self.end
+        self.view[end:end + size] = buf
+        self.end = end + size
+        return end
+
+    def _wrap(self, size):
+        """
+        This method moves the pending NAL unit to the beginning of the ring buffer. If
+        the NAL unit and the new data doesn't fit into the ring buffer, a bigger ring
+        buffer is allocated (NAL units handed out before keep the old one alive).
+        """
+        pending = self.end - self.start
+        if pending + size > len(self.ring):
+            ring = bytearray(max(pending + size, 2 * len(self.ring)))
+            view = memoryview(ring)
+            view[:pending] = self.view[self.start:self.end]
+            self.ring = ring
+            self.view = view
+        else:
+            self.view[:pending] = self.view[self.start:self.end]
+        self.start = 0
+        self.end = pending
+
+
+class KeyframeCache(object):
+    """
+    This class caches the latest SPS and PPS and the frames since the latest IDR
+    frame (the current group of pictures). A client, which connects during the
+    stream, gets these frames first and can decode the live stream immediately
+    instead of waiting for the next IDR frame. The frames must be bytes (not views
+    of the ring buffer), because they are kept for a whole group of pictures.
+    """
+    def __init__(self, max_size):
+        """
+        Constructor: max_size is the max. size of the cached group of pictures in
+        bytes. If the group of pictures gets bigger, it isn't cached anymore until
+        the next IDR frame.
+        """
+        self.max_size = max_size
+        self.sps = None
+        self.pps = None
+        self.gop = []       # IDR frame and the following P-frames
+        self.gop_size = 0
+
+    def add(self, frame):
+        """
+        This method classifies the frame (NAL unit type) and updates the cache.
+        """
+        frame_type = nal_type(frame)
+        if frame_type == NAL_SLICE:
+            if self.gop:
+                self.gop_size += len(frame)
+                if self.gop_size > self.max_size:
+                    self.gop = []
+                else:
+                    self.gop.append(frame)
+        elif frame_type == NAL_IDR:
+            self.gop = [frame]
+            self.gop_size = len(frame)
+        elif frame_type == NAL_SPS:
+            self.sps = frame
+        elif frame_type == NAL_PPS:
+            self.pps = frame
+
+    def frames(self):
+        """
+        Returns the cached frames in decoding order (SPS, PPS, IDR, P-frames) or an
+        empty list, if there is no complete group of pictures.
+        """
+        if self.sps is None or self.pps is None or not self.gop:
+            return []
+        return [self.sps, self.pps] + self.gop
+
+
 class StreamingOutput(object):
     """
-    This class is used as a custom output for the h264 stream. It receives a 
-    continuous stream of cameradata and writes them into a buffer. When the 
-    camerastream contains the sequence 00 00 00 01, the frame is extracted from the 
-    buffer. After that, the condition variable is set to signal a frame 
-    for broadcasting.
+    This class is used as a custom output for the h264 stream. It receives a
+    continuous stream of cameradata and splits it into frames (NAL units) at the
+    sequence 00 00 00 01 (see NalSplitter). After that, the frame is handed over
+    to the broadcast thread and the condition variable is set to signal it. One
+    write can complete several frames (e.g. SPS, PPS and IDR), therefore all
+    frames since the last wakeup are handed over, not only the newest one.
+
+    The send queues of the clients are registered with subscribe. The broadcast
+    thread puts every frame into them and updates the keyframe cache (both while
+    holding the condition), so a new client gets the cached frames and then the
+    live stream without a gap.
     """
-    def __init__(self):
-        self.frame = None
-        self.buffer = BytesIO()
+    def __init__(self, keyframe_cache_size=0, slice_per_write=True):
+        """
+        Constructor: keyframe_cache_size is the max. size of the keyframe cache in 
+        bytes (0: no cache), slice_per_write see NalSplitter.
+        """
+        self.frames = []            # (frame, capture time in monotonic ns) for the 
+                                    # broadcast thread
         self.condition = Condition()
-        self.separator = b'\x00\x00\x00\x01'
-        
-        
+        self.splitter = NalSplitter(self.frame_ready, slice_per_write=slice_per_write)
+        self.frame_callback = None  # called in the camera thread for every frame 
+                                    # instead of notifying the condition (asyncio server)
+        self.subscribers = []
+        self.adapter = None         # VideoAdapter (observes every published frame)
+        self.keyframe_cache = KeyframeCache(keyframe_cache_size) \
+            if keyframe_cache_size else None
 
     def write(self, buf):
         """
         This method is called when a camerastream is received.
-        The data is written to a buffer. If the buffer contains the frame separator 
-        (00 00 00 01) the frame is extracted from the buffer and the condition variable is 
-        notified.
-        """
-        if buf.startswith(self.separator):           
-            self.buffer.seek(0)
-            with self.condition:
-                self.frame = self.buffer.read()
-                self.condition.notify_all()   
-            self.buffer.seek(0)         # moves the buffer to pos 0
-            self.buffer.truncate()      # resets the buffer
-        return self.buffer.write(buf)
\ No newline at end of file
+        The data is passed to the NAL splitter, which calls frame_ready for every
+        complete frame.
+        """
+        return self.splitter.write(buf)
+
+    def flush(self):
+        """
+        This method is called when the recording stops and broadcasts the last frame.
+        """
+        self.splitter.flush()
+
+    def frame_ready(self, frame):
+        """
+        This method hands the frame over to the broadcast thread and notifies the 
+        condition variable. A view of the ring buffer is copied once (ws4py only 
+        sends bytes, the keyframe cache keeps the frames), a slice written as bytes 
+        is passed as it is. If a frame callback is set, the frame is passed to it 
+        instead.
+        """
+        if self.frame_callback is not None:
+            self.frame_callback(frame)
+            return
+        frame = bytes(frame)
+        with self.condition:
+            self.frames.append((frame, time.monotonic_ns()))
+            self.condition.notify_all()
+
+    def take_frames(self):
+        """
+        This method returns and removes the frames handed over to the broadcast 
+        thread (list of (frame, capture time)). Must be called while holding the 
+        condition.
+        """
+        frames = self.frames
+        self.frames = []
+        return frames
+
+    def subscribe(self, queue):
+        """
+        This method registers the send queue of a client. The cached keyframes are
+        put into the queue first.
+        """
+        with self.condition:
+            if self.keyframe_cache is not None:
+                queue.prefill(self.keyframe_cache.frames())
+            self.subscribers.append(queue)
+
+    def unsubscribe(self, queue):
+        """
+        This method removes the send queue of a client.
+        """
+        with self.condition:
+            if queue in self.subscribers:
+                self.subscribers.remove(queue)
+
+    def publish(self, frame, captured=None):
+        """
+        This method puts the frame (bytes) into the keyframe cache and the send
+        queues of all clients. Must be called while holding the condition. captured
+        is the capture time of the frame (monotonic ns, for the metrics and the 
+        video adapter).
+        """
+        if self.keyframe_cache is not None:
+            self.keyframe_cache.add(frame)
+        if self.adapter is not None and captured is not None:
+            self.adapter.observe(frame, captured)
+        for queue in self.subscribers:
+            queue.put(frame)
+        if captured is not None:
+            metrics.VIDEO_BROADCAST.record(time.monotonic_ns() - captured)
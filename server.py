@@ -2,79 +2,101 @@
 # Modified by: Mikail Yoelek
 
 # libraries
-import picamera         # for setup picamera
-import json             # for serializing, deserializing data
-import serial_asyncio   # for creating async serial connection
 import asyncio          
 import threading        
-import sys              # for exiting program with exit number
 import signal           # for keyboard interrupts
 import config           # config for camera, ports, ...
 import time
+import os
+import metrics
 
-from telemetrydata import TelemetryData,TelemetryDataEncoder
-from http_server import StreamingHttpHandler, StreamingHttpServer, StreamingWebSocket
+from telemetrybatch import TelemetryBatcher
+from camerasource import create_camera
 from communicationdata import CommData
 from communicationtransports import UDP_ServerProtocol, Uart_Protocol
+from controlchannel import ControlMailbox, ControlWatchdog, UartWriter
+from flightrecorder import FlightRecorder
+from subscribers import SubscriberRegistry
+from telemetrystream import TelemetryChannel
+from uarttransports import create_uart_connection
+from output import StreamingOutput
+from videoprocess import VideoProcess
+from videoserver import create_video_server
 
-from threading import Thread
 
-from wsgiref.simple_server import make_server
+READY_MESSAGE = 'Server ready'    # line on stdout, when the server is started 
+                                  # (server_starter waits for it)
 
-from broadcast import BroadcastThread
-from output import StreamingOutput
+#region Flow Control Enable Method
+RTSCTS_DIR = 'rpirtscts'
 
-from ws4py.server.wsgirefserver import (
-    WSGIServer,
-    WebSocketWSGIHandler,
-    WebSocketWSGIRequestHandler,
-)
+def rtscts_build_needed(directory=RTSCTS_DIR):
+    """
+    Returns True, if the rpirtscts executable is missing or older than one of its 
+    sources (*.c, *.h, Makefile).
+    """
+    try:
+        built = os.path.getmtime(os.path.join(directory, 'rpirtscts'))
+        for name in os.listdir(directory):
+            if name.endswith(('.c', '.h')) or name == 'Makefile':
+                if os.path.getmtime(os.path.join(directory, name)) > built:
+                    return True
+    except OSError:
+        return True
+    return False
 
-from ws4py.server.wsgiutils import WebSocketWSGIApplication
+
+async def run_command(command, cwd=None):
+    """
+    Runs a shell command and prints its output.
+    """
+    process = await asyncio.create_subprocess_shell(command, 
+                                                    stdout=asyncio.subprocess.PIPE, 
+                                                    stderr=asyncio.subprocess.PIPE, 
+                                                    cwd=cwd)
+    stdout, stderr = await process.communicate()
+    print(stdout, flush=True)
+    if process.returncode:
+        print(f'{command} failed: {stderr}', flush=True)
 
 
-#region Flow Control Enable Method
 async def config_rtscts():      
     """
     This method sets up the hardware flow control signals, by 
-    1. making the rpirtscts executable, 
+    1. making the rpirtscts executable (only if the sources changed), 
     2. running the rpirtscts executable 
-    3. and then instructing the serial port driver to use the RTS/CTS hardware 
-       flow control signals. 
+    3. and instructing the serial port driver to use the RTS/CTS hardware 
+       flow control signals (2. and 3. concurrently). 
     """
     # make rpirtscts executable
-    process = await asyncio.create_subprocess_shell("make", 
-                                                    stdout=asyncio.subprocess.PIPE, 
-                                                    stderr=asyncio.subprocess.PIPE, 
-                                                    cwd="rpirtscts")
-    stdout, stderr =  await process.communicate()
-    print(stdout, flush=True)
-    
-    # Run rpirtscts executable (enable -> "on")
-    process = await asyncio.create_subprocess_shell("sudo ./rpirtscts on", 
-                                                    stdout=asyncio.subprocess.PIPE, 
-                                                    stderr=asyncio.subprocess.PIPE, 
-                                                    cwd="rpirtscts")
-    stdout, stderr = await process.communicate()
-    print(stdout, flush=True)
+    if rtscts_build_needed():
+        await run_command("make", RTSCTS_DIR)
+    else:
+        print('rpirtscts is up to date', flush=True)
     
-    # Instruct the serial port driver to use hardware flow control signals
-    process = await asyncio.create_subprocess_shell("sudo stty -F /dev/ttyAMA0 crtscts", 
-                                                    stdout=asyncio.subprocess.PIPE, 
-                                                    stderr=asyncio.subprocess.PIPE)
-    stdout, stderr = await process.communicate()
-    print(stdout, flush=True)   
+    # Run rpirtscts executable (enable -> "on") and instruct the serial port 
+    # driver to use hardware flow control signals
+    await asyncio.gather(run_command("sudo ./rpirtscts on", RTSCTS_DIR), 
+                         run_command("sudo stty -F %s crtscts" % config.UART_DEVICE))
 #endregion             
                        
 # converts the communication data (JSON) into ICU-protocol (Bitoperations 
 # and send via UART)
-async def process_udp_data(queue_udp, queue_recent_udp_connection, queue_handshake_uart, 
-                           uart_transport):
+async def process_udp_data(mailbox_udp, queue_handshake_uart, uart_transport, 
+                           uart_writer, watchdog=None):
     """
     This method receives and processes datagram (UDP packet: 
-    JSON communication data), performs bit operations (converting into ICU-Protocol) 
-    and sends the data to the Teensy via UART. But first, it waits for the handshake 
-    to be done and then continuously receives data from the UDP queue.
+    binary or JSON communication data), performs bit operations (converting into 
+    ICU-Protocol) and sends the data to the Teensy via UART. But first, it waits for 
+    the handshake to be done and then continuously takes the newest data from the 
+    UDP mailbox (only the client with control authority, see SubscriberRegistry). 
+    The write cadence is set by config.CONTROL_RATE (0: send on arrival, otherwise: 
+    at most CONTROL_RATE frames per second). The ICU frames are written by the 
+    uart_writer (UartWriter: while the UART is stalled, only the newest frame is 
+    kept). Every packet, which was converted into an ICU frame, is reported to 
+    the watchdog (ControlWatchdog: failsafe frame after config.CONTROL_TIMEOUT 
+    without valid packet), which is armed after the handshake. The latencies of the stages are recorded into the 
+    histograms of metrics, every frame is only printed with config.LOG_LEVEL 'debug'.
     """
     # wait for handshake and perform handshake
     print('Waiting for Handshake', flush=True)
@@ -83,201 +105,304 @@ async def process_udp_data(queue_udp, queue_recent_udp_connection, queue_handsha
     handshake = bytearray([0xAA])
     uart_transport.write(handshake)
 
-    # TODO: find another workaround for clearing queue_udp
+    # discard the communication data received before the handshake
+    mailbox_udp.clear()
     
     print('Handshake done', flush=True)
+    metrics.STARTUP.mark('handshake')
+    if watchdog is not None:
+        watchdog.arm()
     
-    # # TESTING PURPOSES
-    # import struct
-    # # DELETE PREVIOUS LINE
+    log_packets = config.LOG_LEVEL == 'debug'
+    monotonic_ns = time.monotonic_ns
     
-    recently_connected_device = None
+    loop = asyncio.get_running_loop()
+    tick = 1 / config.CONTROL_RATE if config.CONTROL_RATE > 0 else None
+    next_tick = loop.time()
+    first_frame = True
     
     while True:
-        data, address = await queue_udp.get() 
+        if tick is None:
+            # send on arrival
+            address, (received, data) = await mailbox_udp.get()
+        else:
+            # fixed tick rate: send the newest data once per tick
+            next_tick += tick
+            delay = next_tick - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                next_tick = loop.time()     # fell behind --> don't send a burst
+            if mailbox_udp.empty():
+                continue
+            address, (received, data) = mailbox_udp.get_nowait()
         
-        if recently_connected_device != address:
-            # use IP-address of connected device and put it into queue to reply telemetry data
-            recently_connected_device = address
-            queue_recent_udp_connection.put_nowait(address)
-            print('Recently connected device: ' + str(address), flush=True)
-            
-        # print(f'Processing UDP data: {data.decode()}', flush=True)
+        # convert received communication data (binary packet or json) into 
+        # ICU-protocol (Bitoperations)
+        decode_start = monotonic_ns()
+        try:
+            received_CommData = CommData.from_datagram(data)
+            encode_start = monotonic_ns()
+            uart_data = received_CommData.to_uart_data()
+        except (ValueError, KeyError, TypeError, OverflowError) as e:
+            # e.g. missing keys, null or infinite values, values out of range
+            metrics.CONTROL_INVALID.value += 1
+            if log_packets:
+                print(f'Invalid communication data from {address}: {e}', flush=True)
+            continue
+        write_start = monotonic_ns()
+        if watchdog is not None:
+            watchdog.valid(received)
+        # send data to Teensy via UART (or keep it, while the UART is stalled)
+        uart_writer.write(uart_data)
+        write_end = monotonic_ns()
         
-        # convert received communication data (json) into ICU-protocol (Bitoperations)        
-        received_CommData = json.loads(data, object_hook=CommData.to_object)
-        
-        print(received_CommData.to_uart_data(), flush=True)
-        # send data to Teensy via UART
-        uart_transport.write(received_CommData.to_uart_data())
-        
-        # region testing loopback
-        # Create a list of the float values
-        # float_values = [12.5, 23, 25.8, 466, 54, 24, 9.856, 47.58]
-
-        # # Pack the floats into a binary string
-        # packed = struct.pack('<ffffffff', *float_values)
-        # bytearray_32 = bytearray(packed)
-            
-        # uart_transport.write(packed)
-        # endregion
-        
-        # IMPORTANT:
-        await asyncio.sleep(0.001)       # check if sleep is needed
-        
-        # print('Processing UDP data done', flush=True)
+        metrics.CONTROL_QUEUE.record(decode_start - received)
+        metrics.CONTROL_DECODE.record(encode_start - decode_start)
+        metrics.CONTROL_ENCODE.record(write_start - encode_start)
+        metrics.CONTROL_WRITE.record(write_end - write_start)
+        metrics.CONTROL_TOTAL.record(write_end - received)
+        if log_packets:
+            print(uart_data, flush=True)
+        if first_frame:
+            first_frame = False
+            metrics.STARTUP.mark('first_control_frame')
     
 
 
 # sends the received telemetry data (e.g. GPS, sensors, ...) to the smartphone
-async def process_uart_recv_data(queue_recent_udp_connection, queue_uart, udp_transport):
+async def process_uart_recv_data(registry, queue_uart, telemetry_channel):
     """
     This method receives telemetry data from Teensy via UART and sends it 
-    to the connected smartphone via the UDP protocol. It waits until the 
-    address is received of the smartphone, before it begins to receive data from the 
-    UART queue.
+    to the subscribers (the smartphone with control authority and the observers) 
+    via the UDP protocol and to the browser clients (telemetry_channel). The 
+    samples are batched and decimated as configured (config.TELEMETRY_BATCH_SIZE, 
+    ..., see TelemetryBatcher). Every datagram is serialized once and sent to all 
+    subscribers. With config.TELEMETRY_WINDOW the samples are also added to the 
+    rolling statistics (TelemetryWindow, exported on /metrics as snapshot, which 
+    is published once per second).
     """
-    # get the ip address of the smartphone once
-    addr = await queue_recent_udp_connection.get()   
-    
-    print('Smartphone connected', flush=True)
     print('Ready for telemetry data.', flush=True)
     
+    window = None
+    if config.TELEMETRY_WINDOW > 0:
+        try:
+            from telemetryarray import TelemetryWindow
+        except ImportError:
+            print('Telemetry window needs numpy (pip install numpy): disabled', flush=True)
+        else:
+            window = TelemetryWindow(config.TELEMETRY_WINDOW, 
+                                     alpha=config.TELEMETRY_EMA_ALPHA)
+            metrics.register_stats('telemetry_window', window.stats)
+    
+    # send the telemetry data to the subscribers via udp socket
+    batcher = TelemetryBatcher(registry.send, 
+                               config.TELEMETRY_BATCH_SIZE, 
+                               config.TELEMETRY_BATCH_INTERVAL, 
+                               config.TELEMETRY_RATE, 
+                               config.TELEMETRY_BATCH_BINARY, 
+                               config.TELEMETRY_MAX_DATAGRAM)
+    metrics.register_stats('telemetry_batcher', batcher.stats)
+    monotonic_ns = time.monotonic_ns
+    published = 0               # time of the last snapshot of the window (ns)
+    
     while True:
-        # check if connection is new --> send to the recently connected device
-        if not queue_recent_udp_connection.empty():
-            addr = await queue_recent_udp_connection.get()  
-            print(f'New client connected: {addr}', flush=True)
-            
-        data = await queue_uart.get()   # receive telemetry data from Teensy 
-                                        # continously
-                                        
-        # print(f'Processing UART data: {data}', flush=True)
-        teldata = TelemetryData(time.time(), data)
-        teldataJSON = json.dumps(teldata, cls=TelemetryDataEncoder)
-        udp_transport.sendto(teldataJSON.encode('utf-8'), addr)     # send the telemetry data to 
-                                                                    # smartphone via udp socket
-        # print('Processing UART data done', flush=True)
-
+        # receive telemetry data from Teensy continously (wait at most until the 
+        # collected samples must be sent)
+        timeout = batcher.timeout(time.time())
+        if timeout is None:
+            received, data = await queue_uart.get()
+        else:
+            try:
+                received, data = await asyncio.wait_for(queue_uart.get(), timeout)
+            except asyncio.TimeoutError:
+                batcher.flush()
+                continue
         
-async def main():
+        metrics.TELEMETRY_QUEUE.record(monotonic_ns() - received)
+        telemetry_channel.publish(data)
+        batcher.add(time.time(), data)
+        if window is not None:
+            window.append(received / 1e9, data)
+            if received - published >= 1000000000:
+                window.publish()
+                published = received
+        metrics.TELEMETRY_TOTAL.record(monotonic_ns() - received)
+
+
+async def start_control_path(telemetry_channel, recorder=None, uart_mode=None, 
+                             emulator=None):
     """
-    Main method to run web socket (camera frames), broadcast, UART and UDP-socket.
+    Creates the UDP endpoint and the UART connection (config.UART_TRANSPORT or 
+    uart_mode, see uarttransports) with the UartWriter (write buffer limits 
+    config.UART_WRITE_HIGH_WATER/LOW_WATER) and starts the tasks of the control 
+    path and the watchdog of the control link (config.CONTROL_TIMEOUT, 
+    FAILSAFE_CONTROL). Returns the tuple (tasks, transports).
     """
-    #region setup rtscts
-    print('Setup: Flow Control', flush=True)
-    await config_rtscts()
-    print('Flow Control is active', flush=True)
-    #endregion
+    mailbox_udp = ControlMailbox()  # only the newest communication data per client
+    registry = SubscriberRegistry(config.TELEMETRY_SUBSCRIBER_TIMEOUT,     # receivers of the
+                                  config.CONTROL_AUTHORITY_TIMEOUT,        # telemetry data
+                                  config.TELEMETRY_SUBSCRIBERS)
+    queue_uart = asyncio.Queue()
+    queue_uart_handshake = asyncio.Queue()
+    
+    loop = asyncio.get_running_loop()
+    
+    # the writer is created with the UART connection
+    watchdog = ControlWatchdog(None, config.CONTROL_TIMEOUT, 
+                               CommData(*config.FAILSAFE_CONTROL).to_uart_data())
+
+    udp_transport, udp_protocol = await loop.create_datagram_endpoint(
+        lambda: UDP_ServerProtocol(mailbox_udp, registry, watchdog),
+        local_addr=('0.0.0.0', config.SMARTPHONE_PORT)
+    )
+    registry.transport = udp_transport
+    metrics.register_stats('control_mailbox', mailbox_udp.stats)
+    metrics.register_stats('telemetry_subscribers', registry.stats)
+    
+    uart_transport, uart_protocol = await create_uart_connection(
+        loop, 
+        lambda: Uart_Protocol(queue_uart, queue_uart_handshake, recorder), 
+        uart_mode, emulator
+    )
     
-    #region camera stuff
-    #Camera and the configuration
+    uart_writer = UartWriter(uart_transport, 
+                             config.UART_WRITE_HIGH_WATER, 
+                             config.UART_WRITE_LOW_WATER, 
+                             recorder)
+    uart_protocol.writer = uart_writer
+    watchdog.writer = uart_writer
+    
+    metrics.register_stats('uart_frames', uart_protocol.assembler.stats)
+    metrics.register_stats('uart_writer', uart_writer.stats)
+    metrics.register_stats('control_link', watchdog.stats)
+    
+    task_udp = asyncio.create_task(process_udp_data(mailbox_udp, queue_uart_handshake, 
+                                                    uart_transport, uart_writer, 
+                                                    watchdog))
+    task_uart = asyncio.create_task(process_uart_recv_data(registry, queue_uart, 
+                                                           telemetry_channel))
+    task_watchdog = asyncio.create_task(watchdog.run())
+    return (task_udp, task_uart, task_watchdog), (udp_transport, uart_transport)
+
+
+async def init_camera(source=None):
+    """
+    Creates and configures the camera (source, default: config.CAMERA_SOURCE: Pi 
+    camera or recorded/synthetic stream) and waits for the warm-up of the Pi camera. 
+    The camera is created in an executor, so the control path can start meanwhile.
+    """
     print('Initializing camera', flush=True)
-    camera = picamera.PiCamera()
+    source = source or config.CAMERA_SOURCE
+    loop = asyncio.get_running_loop()
+    camera = await loop.run_in_executor(None, create_camera, source)
     camera.framerate = config.FRAMERATE
     camera.resolution = (config.WIDTH, config.HEIGHT)
     camera.vflip = config.VFLIP # flips image rightside up, as needed
     camera.hflip = config.HFLIP # flips image left-right, as needed
-    await asyncio.sleep(1) # camera warm-up time
+    if source == 'picamera':
+        await asyncio.sleep(1) # camera warm-up time
+    metrics.STARTUP.mark('camera')
+    return camera
 
-    #Custom output for h264 stream
-    output = StreamingOutput()    
 
-    #Websocket
-    print('Initializing websockets server on port %d' % config.WS_PORT, flush=True)
-    WebSocketWSGIHandler.http_version = '1.1'
-    websocket_server = make_server(
-            '', config.WS_PORT,
-            server_class=WSGIServer,
-            handler_class=WebSocketWSGIRequestHandler,
-            app=WebSocketWSGIApplication(handler_cls=StreamingWebSocket))
+async def start_uart_path(telemetry_channel, recorder):
+    """
+    Sets up the flow control (serial UART) and starts the control path.
+    """
+    if config.UART_TRANSPORT == 'serial':
+        print('Setup: Flow Control', flush=True)
+        await config_rtscts()
+        print('Flow Control is active', flush=True)
+        metrics.STARTUP.mark('rtscts')
+    control_path = await start_control_path(telemetry_channel, recorder)
+    metrics.STARTUP.mark('control_path')
+    return control_path
 
-    websocket_server.initialize_websockets_manager()
-    websocket_thread = Thread(target=websocket_server.serve_forever)
 
-    #Http
-    print('Initializing HTTP server on port %d' % config.HTTP_PORT, flush=True)
-    http_server = StreamingHttpServer()
-    http_thread = Thread(target=http_server.serve_forever)
-   
-    #Broadcast
-    print('Initializing broadcast thread', flush=True)
-    broadcast_thread = BroadcastThread(camera, output, websocket_server)
-        
-    #endregion
+async def main():
+    """
+    Main method to run web socket (camera frames), broadcast, UART and UDP-socket. 
+    The camera and the control path (flow control, UDP, UART) are initialized 
+    concurrently. With config.VIDEO_PROCESS the video subsystem runs in a separate 
+    process (see videoprocess.py). When everything is started, READY_MESSAGE is 
+    printed (server_starter waits for it). The startup phases are exported on 
+    /metrics (startup_*_ms).
+    """
+    metrics.register_stats('startup', metrics.STARTUP.stats)
 
-    queue_udp = asyncio.Queue()
-    queue_recent_udp_connection = asyncio.Queue()   # get the recent connected device's
-                                                    # IP address and send telemetry data to it
-    queue_uart = asyncio.Queue()
-    queue_uart_handshake = asyncio.Queue()
+    # flight recorder (telemetry and control frames, see config.FLIGHT_RECORDER)
+    recorder = None
+    if config.FLIGHT_RECORDER:
+        recorder = FlightRecorder(config.FLIGHT_RECORDER_DIR, 
+                                  config.FLIGHT_RECORDER_SEGMENT_SIZE, 
+                                  config.FLIGHT_RECORDER_SEGMENTS)
+        recorder.start()
+        metrics.register_stats('flight_recorder', recorder.stats)
     
     loop = asyncio.get_running_loop()
+    
+    if config.VIDEO_PROCESS:
+        # camera, http, websocket and broadcast in the video process, the telemetry 
+        # for the browser clients is passed through shared memory
+        video_server = VideoProcess()
+        telemetry_channel = video_server.status
+        (tasks, transports), _ = await asyncio.gather(
+            start_uart_path(telemetry_channel, recorder), video_server.start())
+    else:
+        #Custom output for h264 stream
+        output = StreamingOutput(config.KEYFRAME_CACHE_SIZE)
 
-    udp_transport, udp_protocol = await loop.create_datagram_endpoint(
-        lambda: UDP_ServerProtocol(queue_udp),
-        local_addr=('0.0.0.0', config.SMARTPHONE_PORT)
-    )
+        #Telemetry for the browser clients (websocket path /telemetry)
+        telemetry_channel = TelemetryChannel()
+        
+        # camera and UDP (smartphone)/UART (Teensy) concurrently
+        camera, (tasks, transports) = await asyncio.gather(
+            init_camera(), start_uart_path(telemetry_channel, recorder))
+        
+        #Http, websocket and broadcast (see config.SERVER_MODE)
+        video_server = create_video_server(camera, output, telemetry=telemetry_channel)
+        await video_server.start()
     
-    uart_transport, uart_protocol = await serial_asyncio.create_serial_connection(
-        loop, 
-        lambda: Uart_Protocol(queue_uart, queue_uart_handshake), 
-        '/dev/ttyAMA0', baudrate=2000000, bytesize=8, parity="N", stopbits=1, 
-        xonxoff=False, rtscts=True
-    )
+    metrics.STARTUP.mark('ready')
+    print(READY_MESSAGE, flush=True)
     
-    task_udp = asyncio.create_task(process_udp_data(queue_udp, queue_recent_udp_connection,
-                                                    queue_uart_handshake, uart_transport))
-    task_uart = asyncio.create_task(process_uart_recv_data(queue_recent_udp_connection, queue_uart, 
-                                                           udp_transport))
+    # CTRL+C (SIGINT from server_starter) or SIGTERM --> Close Application
+    stop_event = asyncio.Event()
+    loop.add_signal_handler(signal.SIGINT, stop_event.set)
+    loop.add_signal_handler(signal.SIGTERM, stop_event.set)
+    task_stop = asyncio.create_task(stop_event.wait())
     
-    print('Starting websockets thread', flush=True)
-    websocket_thread.start()
-    print('Starting HTTP server thread', flush=True)
-    http_thread.start()
-    print('Starting recording and broadcastasting thread', flush=True)
-    broadcast_thread.start()
+    # run until a signal is received (or a task fails)
+    done, pending = await asyncio.wait({*tasks, task_stop}, 
+                                       return_when=asyncio.FIRST_COMPLETED)
     
-    # handler for CTRL+C --> Close Application
-    def signal_handler(*args):
-        # safely stop threads/tasks
-        print('Closing UART and UDP transports', flush=True)
-        udp_transport.close()
-        uart_transport.close()  
-        
-        task_uart.cancel()
-        task_udp.cancel()  
-          
-        # stop thread first --> then stop camera recording
-        print('Waiting for broadcast thread to finish', flush=True)
-        broadcast_thread.stop_thread()  
-        print('Stopping recording', flush=True)
-        camera.stop_recording()
-        
-        # stop http and other sockets
-        print('Shutting down HTTP server', flush=True)
-        http_server.shutdown()
-        print('Shutting down websockets server', flush=True)
-        websocket_server.server_close()
-        websocket_server.shutdown()
-
-        print('Waiting for HTTP server thread to finish', flush=True)
-        http_thread.join()
-        print('Waiting for websockets thread to finish', flush=True)
-        websocket_thread.join()
-        
-        print('Everything is closed', flush=True)
-        
-        # Prints the running threads (after closing all --> only MainThread)
-        main_thread = threading.current_thread()
-        for t in threading.enumerate():
-            print('Running thread: ', t.getName(), flush=True)
-            
-        sys.exit(0)
-
-    signal.signal(signal.SIGINT, signal_handler)
-
-    await asyncio.gather(task_udp, task_uart)
+    # safely stop transports/tasks
+    print('Closing UART and UDP transports', flush=True)
+    for transport in transports:
+        transport.close()
+    
+    for task in (*tasks, task_stop):
+        task.cancel()
+    
+    # stop camera recording, http and websocket server (or the video process)
+    await video_server.stop()
+    
+    # write the staged records and close the segment
+    if recorder is not None:
+        await loop.run_in_executor(None, recorder.stop_thread)
+        print(f'Flight recorder closed: {recorder.stats()}', flush=True)
+    
+    print('Everything is closed', flush=True)
+    
+    # Prints the running threads (after closing all --> only MainThread)
+    for t in threading.enumerate():
+        print('Running thread: ', t.name, flush=True)
+    
+    # report the error of a failed task
+    for task in done:
+        if task is not task_stop and not task.cancelled() and task.exception():
+            raise task.exception()
            
 if __name__ == '__main__':
     asyncio.run(main())
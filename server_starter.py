@@ -1,123 +1,522 @@
-import RPi.GPIO as GPIO
-import subprocess
-import signal
-from time import sleep
+import argparse
 import asyncio
+import queue
+import signal
+import subprocess
+import os
 import sys
-from time import sleep
+import time
+from threading import Thread
+
+import config
+from server import READY_MESSAGE
+from subscribers import encode_subscription, PING
 
 GPIO_PIN_NUMBER = 18
-global gpio_state
+GPIO_BOUNCETIME = 1000          # ms, debouncing of the GPIO edges
+SERVER_COMMAND = ['python', 'server.py']
+READY_TIMEOUT = 30              # max. seconds to wait for READY_MESSAGE
+STOP_TIMEOUT = 10               # max. seconds after SIGINT, then server.py is killed
+LOG_QUEUE_SIZE = 1000           # max. output lines of server.py waiting for stdout,
+                                # further lines are dropped (server.py never blocks)
+HEALTH_INTERVAL = 5.0           # seconds between the health checks (0 --> off): PING
+                                # to config.SMARTPHONE_PORT, answered by the control path
+HEALTH_TIMEOUT = 3.0            # max. seconds per health check
+HEALTH_FAILURES = 3             # failed health checks in a row --> restart
+RESTART_DELAY = 1.0             # delay of the first restart after a crash in s,
+RESTART_DELAY_MAX = 60.0        # doubled with every further restart up to the max.
+RESTART_RESET = 60.0            # server.py ran for RESTART_RESET s --> first delay again
+
+#region GPIO backends
+class RPiGpio(object):
+    """
+    GPIO backend of the Raspberry Pi (RPi.GPIO). The edge callback is called in
+    the event thread of RPi.GPIO.
+    """
+    def __init__(self, pin=GPIO_PIN_NUMBER, bouncetime=GPIO_BOUNCETIME):
+        """
+        Constructor: pin is the GPIO (BCM numbering), bouncetime the debouncing of
+        the edges in ms.
+        """
+        import RPi.GPIO as GPIO
+        self.GPIO = GPIO
+        self.pin = pin
+        self.bouncetime = bouncetime
+
+    def start(self, callback):
+        """
+        Sets up the GPIO pin as an input and calls callback(level) for every
+        rising/falling edge.
+        """
+        GPIO = self.GPIO
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setup(self.pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        GPIO.add_event_detect(self.pin, GPIO.BOTH,
+                              callback=lambda channel: callback(bool(GPIO.input(channel))),
+                              bouncetime=self.bouncetime)
+
+    def stop(self):
+        """
+        Removes the edge detection and releases the pin.
+        """
+        self.GPIO.remove_event_detect(self.pin)
+        self.GPIO.cleanup(self.pin)
+
+
+class MockGpio(object):
+    """
+    GPIO backend without the hardware (e.g. on a laptop). The level is set with
+    set (from any thread) or by lines on stdin: '1'/'on' --> rising edge,
+    '0'/'off' --> falling edge.
+    """
+    LEVELS = {'1': True, 'on': True, 'high': True, '0': False, 'off': False, 'low': False}
+
+    def __init__(self, stdin=True):
+        """
+        Constructor: stdin True --> the level is read from stdin.
+        """
+        self.stdin = stdin
+        self.level = False
+        self.callback = None
+
+    def start(self, callback):
+        """
+        Calls callback(level) for every change of the level.
+        """
+        self.callback = callback
+        if self.stdin:
+            Thread(target=self.read_stdin, name='MockGpio', daemon=True).start()
+
+    def set(self, level):
+        """
+        Sets the level of the pin, a change is reported like an edge.
+        """
+        level = bool(level)
+        if level != self.level:
+            self.level = level
+            self.callback(level)
+
+    def read_stdin(self):
+        """
+        Sets the level from the lines on stdin.
+        """
+        for line in sys.stdin:
+            level = self.LEVELS.get(line.strip().lower())
+            if level is None:
+                print(f'mock gpio: unknown level {line.strip()!r} (1/on, 0/off)', flush=True)
+            else:
+                self.set(level)
+
+    def stop(self):
+        """
+        Nothing to release.
+        """
+#endregion
+
+#region LogRelay
+class LogRelay(Thread):
+    """
+    Bounded, non-blocking relay of the output lines of server.py (and of the
+    supervisor) to stdout. The lines are queued by the event loop with put, which
+    never blocks: if the writer thread falls behind (slow terminal or journal),
+    further lines are dropped and the number of dropped lines is printed before
+    the next relayed line. So a slow stdout can neither stall the event loop nor
+    the pipe of server.py.
+    """
+    def __init__(self, size=LOG_QUEUE_SIZE, output=None):
+        """
+        Constructor: size is the max. number of queued lines, output the stream
+        (default: sys.stdout).
+        """
+        Thread.__init__(self, name='LogRelay', daemon=True)
+        self.queue = queue.Queue(size)
+        self.output = output
+
+        # statistics
+        self.relayed = 0            # lines written to the output
+        self.dropped = 0            # lines dropped (queue full)
+        self.reported = 0           # dropped lines, which were reported in the output
+
+    def put(self, line):
+        """
+        Queues a line (str) for the output or drops it, if the queue is full.
+        """
+        try:
+            self.queue.put_nowait(line)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        """
+        Writes the queued lines (flushed, when the queue is empty) until stop.
+        """
+        output = self.output if self.output is not None else sys.stdout
+        while True:
+            line = self.queue.get()
+            if line is None:
+                break
+            dropped = self.dropped
+            if dropped != self.reported:
+                output.write(f'[{dropped - self.reported} lines dropped]\n')
+                self.reported = dropped
+            output.write(line + '\n')
+            self.relayed += 1
+            if self.queue.empty():
+                output.flush()
+        output.flush()
 
-# get stdout from childprocess and print in console
-async def read_stdout_childprocess(queue, stream):
+    def stop(self, timeout=1.0):
+        """
+        Writes the queued lines and stops the thread (max. timeout s).
+        """
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self.join(timeout)
+
+    def stats(self):
+        """
+        Returns the statistics of the relay as dictionary.
+        """
+        return {
+            'relayed': self.relayed,
+            'dropped': self.dropped,
+            'queued': self.queue.qsize(),
+        }
+#endregion
+
+# get stdout from childprocess and pass it to the relay
+async def read_stdout_childprocess(stream, relay, ready):
     """
-    This function reads the output from a child process's stdout and puts it in a queue.
+    This function reads the output from a child process's stdout as fast as it is
+    written and passes the lines to the relay (which drops lines, when stdout
+    falls behind), so the child never blocks on a full pipe. The event ready is
+    set, when the child prints READY_MESSAGE.
     """
     while True:
-        # , flush=True --> manually force flush --> print instantly
-        output = await stream.readline()
+        try:
+            output = await stream.readline()
+        except ValueError:
+            # line longer than the limit of the stream (the line is discarded)
+            relay.dropped += 1
+            continue
         if not output:
             break
-        await queue.put(output.decode().strip())
+        line = output.decode(errors='replace').rstrip()
+        if line == READY_MESSAGE:
+            ready.set()
+        relay.put(line)
 
 # starts server.py
-async def start_childprocess():
+async def start_childprocess(start_ns, command=SERVER_COMMAND):
     """
-    This function starts the server.py child process.
+    This function starts the server.py child process. start_ns is the time of
+    the GPIO edge (time.monotonic_ns), the server reports its startup phases
+    relative to it (environment variable START_TIME_NS).
 
     Returns:
         The subprocess object.
     """
-    
-    cmd = ["python", "server.py"]
     proc = await asyncio.create_subprocess_exec(
-        *cmd,
-        stdout=asyncio.subprocess.PIPE
+        *command,
+        stdout=asyncio.subprocess.PIPE,
+        env=dict(os.environ, START_TIME_NS=str(start_ns))
     )
     return proc
 
 # stops server.py
-async def stop_childprocess(process):
+async def stop_childprocess(process, timeout=STOP_TIMEOUT):
     """
-     This function stops the specified child process.
+    This function stops the specified child process (SIGINT, after timeout
+    seconds SIGKILL).
     """
-    process.send_signal(signal.SIGINT)
-    await process.wait()            
+    if process.returncode is not None:
+        return
+    try:
+        process.send_signal(signal.SIGINT)
+        await asyncio.wait_for(process.wait(), timeout)
+    except ProcessLookupError:
+        pass
+    except asyncio.TimeoutError:
+        process.kill()
+    await process.wait()
+
+# health check of server.py
+class PingProtocol(asyncio.DatagramProtocol):
+    """
+    Datagram protocol of the health check: waits for the answer to the PING
+    packet.
+    """
+    def __init__(self, ping):
+        self.ping = ping
+        self.answered = asyncio.get_running_loop().create_future()
+
+    def datagram_received(self, data, addr):
+        if data == self.ping and not self.answered.done():
+            self.answered.set_result(True)
+
+    def error_received(self, exc):
+        # e.g. ICMP port unreachable: nobody listens on the port
+        if not self.answered.done():
+            self.answered.set_result(False)
+
+async def check_health(port, timeout=HEALTH_TIMEOUT):
+    """
+    This function sends a PING packet to the UDP port of the control path of
+    server.py and returns True, if it is answered within timeout seconds (the
+    event loop, which handles the communication data, is alive).
+    """
+    ping = encode_subscription(PING)
+    loop = asyncio.get_running_loop()
+    try:
+        transport, protocol = await loop.create_datagram_endpoint(
+            lambda: PingProtocol(ping), remote_addr=('127.0.0.1', port))
+    except OSError:
+        return False
+    try:
+        transport.sendto(ping)
+        return await asyncio.wait_for(protocol.answered, timeout)
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        transport.close()
 
-# check gpio pin state (rising/falling edge)
-def GPIO_pin_state(channel):
+#region Supervisor
+class Supervisor(object):
     """
-    Event callback for GPIO pin (channel) state changes.
+    Event-driven supervisor of server.py. The GPIO backend reports the edges from
+    its own thread, they are passed to the event loop with call_soon_threadsafe
+    (no polling): a rising edge starts server.py, a falling edge stops it. While
+    the switch is on, server.py is restarted, if it exits, doesn't get ready or
+    fails HEALTH_FAILURES health checks in a row, after a delay, which doubles
+    with every restart (exponential backoff, back to the first delay after
+    RESTART_RESET seconds of running). The output of server.py is relayed by the
+    LogRelay.
     """
-    global gpio_state
-    if GPIO.input(channel):
-        print('rising edge')
-        gpio_state = True
-    else:
-        print('falling edge')
-        gpio_state = False
-        
+    def __init__(self, gpio, relay, command=SERVER_COMMAND, health_port=None,
+                 health_interval=HEALTH_INTERVAL, restart_delay=RESTART_DELAY,
+                 restart_delay_max=RESTART_DELAY_MAX):
+        """
+        Constructor: gpio is the GPIO backend (RPiGpio, MockGpio), relay the
+        (started) LogRelay, command the command line of the server, health_port the
+        UDP port of the health check (default: config.SMARTPHONE_PORT, health_interval
+        0 --> no health check).
+        """
+        self.gpio = gpio
+        self.relay = relay
+        self.command = command
+        self.health_port = health_port if health_port is not None else config.SMARTPHONE_PORT
+        self.health_interval = health_interval
+        self.restart_delay = restart_delay
+        self.restart_delay_max = restart_delay_max
+        self.loop = None
+        self.switch_on = None       # asyncio.Event: switch on (after a rising edge)
+        self.switch_off = None      # asyncio.Event: switch off (after a falling edge)
+        self.edge_ns = 0            # time of the last rising edge
+        self.process = None
 
-# main method         
-async def main():
+        # statistics
+        self.edges = 0
+        self.starts = 0
+        self.restarts = 0
+        self.health_failures = 0
+
+    def log(self, message):
+        """
+        Prints a message of the supervisor (through the relay).
+        """
+        self.relay.put(message)
+
+    def gpio_callback(self, level):
+        """
+        This method is called by the GPIO backend (in its thread) for every edge.
+        """
+        self.loop.call_soon_threadsafe(self.edge, level, time.monotonic_ns())
+
+    def edge(self, level, edge_ns):
+        """
+        Handles a rising (level True) or falling edge on the event loop.
+        """
+        self.edges += 1
+        if level:
+            self.log('rising edge')
+            self.edge_ns = edge_ns
+            self.switch_off.clear()
+            self.switch_on.set()
+        else:
+            self.log('falling edge')
+            self.switch_on.clear()
+            self.switch_off.set()
+
+    async def run(self):
+        """
+        Supervises server.py until cancelled.
+        """
+        self.loop = asyncio.get_running_loop()
+        self.switch_on = asyncio.Event()
+        self.switch_off = asyncio.Event()
+        self.switch_off.set()
+        self.gpio.start(self.gpio_callback)
+        try:
+            delay = 0
+            start_ns = None
+            while True:
+                await self.switch_on.wait()
+                if start_ns is None:
+                    start_ns = self.edge_ns
+                self.log('----------starting process-----------------')
+                started = time.monotonic()
+                reason = await self.run_server(start_ns)
+                start_ns = None
+                if self.switch_off.is_set():
+                    self.log('----------ending process--------------------')
+                    delay = 0
+                    continue
+
+                # crashed or unhealthy while the switch is on --> restart after a delay
+                if time.monotonic() - started >= RESTART_RESET:
+                    delay = 0
+                delay = min(max(delay * 2, self.restart_delay), self.restart_delay_max)
+                self.restarts += 1
+                self.log(f'server {reason}: restart in {delay:.1f} s')
+                try:
+                    # a falling edge cancels the restart
+                    await asyncio.wait_for(self.switch_off.wait(), delay)
+                except asyncio.TimeoutError:
+                    start_ns = time.monotonic_ns()
+        finally:
+            self.gpio.stop()
+            if self.process is not None:
+                await stop_childprocess(self.process)
+
+    async def run_server(self, start_ns):
+        """
+        Starts server.py, waits until it is ready and watches it until it is
+        stopped (falling edge), exits or fails the health check. Returns the
+        reason (str).
+        """
+        self.starts += 1
+        self.process = process = await start_childprocess(start_ns, self.command)
+        ready = asyncio.Event()
+        task_read_stdout = asyncio.create_task(
+            read_stdout_childprocess(process.stdout, self.relay, ready))
+        try:
+            reason = await self.wait_until_ready(ready, process, start_ns)
+            if reason is None:
+                reason = await self.watch(process)
+            return reason
+        finally:
+            await stop_childprocess(process)
+            self.process = None
+            # read the remaining output (a child of the server may keep the pipe open)
+            try:
+                await asyncio.wait_for(task_read_stdout, 1.0)
+            except asyncio.TimeoutError:
+                pass
+
+    async def wait_until_ready(self, ready, process, start_ns):
+        """
+        Waits until server.py reports READY_MESSAGE (returns None) or exits, is
+        stopped or READY_TIMEOUT expires (returns the reason).
+        """
+        tasks = {asyncio.create_task(ready.wait()), asyncio.create_task(process.wait()),
+                 asyncio.create_task(self.switch_off.wait())}
+        await asyncio.wait(tasks, timeout=READY_TIMEOUT, return_when=asyncio.FIRST_COMPLETED)
+        for task in tasks:
+            task.cancel()
+        if ready.is_set():
+            self.log('server ready after %.0f ms' % ((time.monotonic_ns() - start_ns) / 1e6))
+            return None
+        if process.returncode is not None:
+            return f'exited with {process.returncode} before ready'
+        if self.switch_off.is_set():
+            return 'stopped'
+        return 'not ready'
+
+    async def watch(self, process):
+        """
+        Waits until server.py is stopped (falling edge), exits or fails the health
+        check and returns the reason.
+        """
+        exited = asyncio.create_task(process.wait())
+        unhealthy = asyncio.create_task(self.watch_health())
+        stopped = asyncio.create_task(self.switch_off.wait())
+        done, pending = await asyncio.wait({exited, unhealthy, stopped},
+                                           return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        if stopped in done:
+            return 'stopped'
+        if exited in done:
+            return f'exited with {process.returncode}'
+        return 'unhealthy'
+
+    async def watch_health(self):
+        """
+        Checks the health of server.py every health interval and returns after
+        HEALTH_FAILURES failed checks in a row (never, if the check is off).
+        """
+        if not self.health_interval:
+            await asyncio.get_running_loop().create_future()
+        failures = 0
+        while failures < HEALTH_FAILURES:
+            await asyncio.sleep(self.health_interval)
+            if await check_health(self.health_port):
+                failures = 0
+            else:
+                failures += 1
+                self.health_failures += 1
+                self.log(f'health check failed ({failures}/{HEALTH_FAILURES})')
+
+    def stats(self):
+        """
+        Returns the statistics of the supervisor and the relay as dictionary.
+        """
+        return {
+            'edges': self.edges,
+            'starts': self.starts,
+            'restarts': self.restarts,
+            'health_failures': self.health_failures,
+            **self.relay.stats(),
+        }
+#endregion
+
+# main method
+async def main(gpio, command=SERVER_COMMAND, health_interval=HEALTH_INTERVAL):
     """
     Main method to run the program.
     """
-    # Set up the GPIO pin as an input
-    GPIO.setmode(GPIO.BCM)
-    GPIO.setup(GPIO_PIN_NUMBER, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-    
-    process = None
-    task_read_stdout = None
-    
-    # queue for print stdout
-    queue = asyncio.Queue()
-    
-    global gpio_state 
-    gpio_state= False
-    
-    # add callback event, when gpio changes state (rising/falling)
-    GPIO.add_event_detect(GPIO_PIN_NUMBER, GPIO.BOTH, 
-                          callback=GPIO_pin_state,
-                          bouncetime=1000)  # add rising/falling edge detection on a channel
+    relay = LogRelay()
+    relay.start()
+    supervisor = Supervisor(gpio, relay, command, health_interval=health_interval)
     try:
-        while True:
-            # add new childprocess, when childprocess doesn't already exists
-            if process is None and gpio_state is True:
-                print('----------starting process-----------------')
-                # Start the subprocess when rising edge
-                process = await start_childprocess()
-                task_read_stdout = asyncio.create_task(read_stdout_childprocess(queue, process.stdout))
-                await asyncio.sleep(5) # wait until server has started
-            
-            # stop childprocess and cancel read stdout task
-            elif process is not None and gpio_state is False:
-                print('----------ending process--------------------')
-                await stop_childprocess(process)
-                process = None
-                task_read_stdout.cancel
-
-            # print stdout of childprocess
-            while not queue.empty():
-                output = await queue.get()
-                print(output)
-                
-            await asyncio.sleep(0.01)
-            
-    except KeyboardInterrupt:        
-        print('cancelling')
-        # cleanup
-        task_read_stdout.cancel()
-        
+        await supervisor.run()
+    finally:
+        relay.stop()
+        print(f'supervisor: {supervisor.stats()}', flush=True)
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Starts/stops server.py with the switch '
+                                                 f'on GPIO {GPIO_PIN_NUMBER}.')
+    parser.add_argument('--mock-gpio', action='store_true',
+                        help='GPIO backend without the hardware: the switch is read from '
+                             'stdin (1/on, 0/off)')
+    parser.add_argument('--command', default=' '.join(SERVER_COMMAND),
+                        help='command line of the server')
+    parser.add_argument('--health-interval', type=float, default=HEALTH_INTERVAL,
+                        help='seconds between the health checks (0: off)')
+    args = parser.parse_args()
+    gpio = MockGpio() if args.mock_gpio else RPiGpio()
     try:
-        print('----------starting programm-----------------')
+        print('----------starting programm-----------------', flush=True)
         # force kill server.py process (if any running)
-        subprocess.run("sudo pkill -f server.py", shell=True)
-        asyncio.run(main())
+        if not args.mock_gpio:
+            subprocess.run("sudo pkill -f server.py", shell=True)
+        asyncio.run(main(gpio, args.command.split(), args.health_interval))
     except KeyboardInterrupt:
         # force kill server.py process (if any running)
-        subprocess.run("sudo pkill -f server.py", shell=True)
+        if not args.mock_gpio:
+            subprocess.run("sudo pkill -f server.py", shell=True)
         print('----------ending programm--------------------')
-        sys.exit(0)
\ No newline at end of file
+        sys.exit(0)
@@ -0,0 +1,187 @@
+import struct
+import time
+
+# Subscription packet (observers, e.g. a ground station laptop or a logger).
+# Layout (little-endian, 5 Bytes):
+#   magic (1 Byte), version (1 Byte), command (1 Byte), max. rate (2 Bytes,
+#   datagrams/s, 0 --> no limit)
+# A subscription expires after the timeout, so observers resend SUBSCRIBE
+# periodically (keepalive). PING is answered with the same packet by the event
+# loop of the control path (health check of server_starter).
+SUBSCRIPTION_MAGIC = 0xC7
+SUBSCRIPTION_VERSION = 1
+SUBSCRIPTION_PACKET = struct.Struct('<BBBH')
+
+SUBSCRIBE = 1
+UNSUBSCRIBE = 2
+PING = 3
+
+def encode_subscription(command, rate=0):
+    """
+    Returns a subscription packet (used by the observers, here for testing).
+    """
+    return SUBSCRIPTION_PACKET.pack(SUBSCRIPTION_MAGIC, SUBSCRIPTION_VERSION,
+                                    command, rate)
+
+
+class Subscriber(object):
+    """
+    A receiver of the telemetry data.
+    """
+    __slots__ = ('addr', 'last_seen', 'min_distance', 'next_send', 'sent', 'skipped')
+
+    def __init__(self, addr, now, rate=0):
+        self.addr = addr
+        self.last_seen = now
+        self.min_distance = 1 / rate if rate > 0 else 0
+        self.next_send = 0
+        self.sent = 0           # datagrams sent
+        self.skipped = 0        # datagrams skipped by the rate limit
+
+
+class SubscriberRegistry(object):
+    """
+    This class keeps the receivers of the telemetry data: the client with control
+    authority and the observers, which subscribed with a subscription packet. Every
+    telemetry datagram is serialized once and sent to all subscribers (with a rate
+    limit per subscriber). Subscribers, which weren't heard of for timeout seconds,
+    are removed: when sending and, at most every timeout / 5 seconds, when a packet
+    arrives (so they also expire without telemetry). stats doesn't change the
+    registry (it may be called by the metrics in another thread).
+
+    Exactly one client holds the control authority: the first client, which sends
+    communication data. Communication data of other clients is rejected, until the
+    control client was silent for control_timeout seconds.
+    """
+    def __init__(self, timeout=5.0, control_timeout=1.0, max_subscribers=8):
+        self.timeout = timeout
+        self.control_timeout = control_timeout
+        self.max_subscribers = max_subscribers
+        self.transport = None           # UDP transport (set, when it is created)
+        self.subscribers = {}           # addr -> Subscriber
+        self.controller = None          # addr of the client with control authority
+        self.controller_seen = 0
+        self.next_expire = 0
+
+        # statistics
+        self.rejected = 0               # communication data of other clients
+        self.expired = 0                # subscribers removed by the timeout
+
+    def control_received(self, addr):
+        """
+        This method is called for every datagram with communication data. Returns
+        True, if the client holds (or got) the control authority.
+        """
+        now = time.monotonic()
+        if addr != self.controller:
+            if (self.controller is not None
+                    and now - self.controller_seen < self.control_timeout):
+                self.rejected += 1
+                return False
+            self.controller = addr
+            print(f'Control authority: {addr}', flush=True)
+        self.controller_seen = now
+
+        subscriber = self.subscribers.get(addr)
+        if subscriber is None:
+            self.add(addr, now)
+        else:
+            subscriber.last_seen = now
+        if now >= self.next_expire:
+            self.expire(now)
+        return True
+
+    def subscription_received(self, data, addr):
+        """
+        This method handles a subscription packet.
+        """
+        try:
+            magic, version, command, rate = SUBSCRIPTION_PACKET.unpack(data)
+        except struct.error:
+            return
+        if version != SUBSCRIPTION_VERSION:
+            return
+        now = time.monotonic()
+        if command == SUBSCRIBE:
+            subscriber = self.subscribers.get(addr)
+            if subscriber is None:
+                self.add(addr, now, rate)
+            else:
+                subscriber.last_seen = now
+                subscriber.min_distance = 1 / rate if rate > 0 else 0
+        elif command == UNSUBSCRIBE:
+            self.remove(addr)
+        elif command == PING:
+            self.transport.sendto(data, addr)
+            return
+        if now >= self.next_expire:
+            self.expire(now)
+
+    def add(self, addr, now, rate=0):
+        """
+        This method adds a subscriber (if the max. number isn't reached).
+        """
+        if len(self.subscribers) >= self.max_subscribers:
+            return
+        self.subscribers[addr] = Subscriber(addr, now, rate)
+        print(f'New client connected: {addr}', flush=True)
+
+    def remove(self, addr):
+        """
+        This method removes a subscriber (and its control authority).
+        """
+        if self.subscribers.pop(addr, None) is not None:
+            print(f'Client disconnected: {addr}', flush=True)
+        if addr == self.controller:
+            self.controller = None
+
+    def expire(self, now):
+        """
+        This method removes the subscribers, which weren't heard of for timeout
+        seconds, and the control authority of a client, which was silent as long.
+        """
+        self.next_expire = now + self.timeout / 5
+        expired = [addr for addr, subscriber in self.subscribers.items()
+                   if now - subscriber.last_seen > self.timeout]
+        for addr in expired:
+            self.expired += 1
+            self.remove(addr)
+        if self.controller is not None and now - self.controller_seen > self.timeout:
+            self.controller = None
+
+    def send(self, datagram):
+        """
+        This method sends the datagram to all subscribers.
+        """
+        if not self.subscribers:
+            return
+        now = time.monotonic()
+        sendto = self.transport.sendto
+        expired = None
+        for subscriber in self.subscribers.values():
+            if now - subscriber.last_seen > self.timeout:
+                expired = expired or []
+                expired.append(subscriber.addr)
+                continue
+            if subscriber.min_distance:
+                if now < subscriber.next_send:
+                    subscriber.skipped += 1
+                    continue
+                subscriber.next_send = now + subscriber.min_distance
+            sendto(datagram, subscriber.addr)
+            subscriber.sent += 1
+        if expired:
+            for addr in expired:
+                self.expired += 1
+                self.remove(addr)
+
+    def stats(self):
+        """
+        Returns the statistics of the registry as dictionary.
+        """
+        return {
+            'subscribers': len(self.subscribers),
+            'controller': self.controller,
+            'rejected': self.rejected,
+            'expired': self.expired,
+        }
@@ -0,0 +1,416 @@
+"""
+Batch decoding and rolling statistics of the telemetry with NumPy (optional
+dependency, the server only imports this module with config.TELEMETRY_WINDOW).
+
+decode_frames turns a run of raw telemetry frames (32 Bytes each, see
+TELEMETRY_FRAME) into a structured array without copying (np.frombuffer),
+read_telemetry reads the telemetry records of the flight recorder the same way
+(the records have a fixed size, see RECORD_DTYPE).
+
+TelemetryWindow keeps the newest samples in a ring buffer with the statistics of
+the last window seconds per channel (mean, min, max, EMA). append only copies a
+sample into the ring; the statistics are brought up to date in batches (every
+BLOCK samples and when they are read) with vectorized operations:
+
+    mean        running sums and counts (the samples, which leave the window,
+                are subtracted; nan/inf are ignored)
+    min, max    min/max per block of BLOCK samples, the window min/max combines
+                the blocks and the partial blocks at both ends
+    EMA         exponential moving average per sample (alpha), nan/inf samples
+                don't change it
+"""
+import os
+
+import numpy as np
+
+import flightrecorder
+from telemetrydata import TELEMETRY_FRAME, TelemetryData
+
+FIELDS = TelemetryData.__slots__[1:]
+CHANNELS = len(FIELDS)
+
+# telemetry frame (Teensy -> Pi): 8x float32, little-endian
+TELEMETRY_DTYPE = np.dtype([(name, '<f4') for name in FIELDS])
+
+# record of the flight recorder (see flightrecorder.py), payload of a telemetry
+# record: the telemetry frame
+RECORD_DTYPE = np.dtype([('monotonic_ns', '<u8'), ('seq', '<u4'), ('type', 'u1'),
+                         ('length', 'u1'), ('reserved', '<u2'),
+                         ('values', '<f4', (CHANNELS,))])
+
+assert TELEMETRY_DTYPE.itemsize == TELEMETRY_FRAME.size
+assert RECORD_DTYPE.itemsize == flightrecorder.RECORD_SIZE
+
+
+def decode_frames(data):
+    """
+    Returns the telemetry frames in data (bytes-like, a multiple of 32 Bytes) as
+    structured array (fields: FIELDS, float32). The array is a view of data (no
+    copy, read-only for bytes).
+    """
+    return np.frombuffer(data, TELEMETRY_DTYPE)
+
+
+def channels(frames):
+    """
+    Returns the frames (structured array of decode_frames) as 2D array (samples x
+    channels, float32), a view of the frames.
+    """
+    return frames.view('<f4').reshape(-1, CHANNELS)
+
+
+def read_telemetry(directory, start=None, end=None):
+    """
+    Returns the telemetry of the flight recorder as tuple (times, values): wall
+    clock times (unix seconds, float64) and values (samples x channels, float32).
+    start and end limit the wall clock time. The records of a segment are decoded
+    at once (np.frombuffer over the segment file).
+    """
+    times = []
+    values = []
+    for index in flightrecorder.segment_indexes(directory):
+        with open(os.path.join(directory, flightrecorder.SEGMENT_NAME % index), 'rb') as f:
+            data = f.read()
+        if len(data) < flightrecorder.HEADER_SIZE:
+            continue
+        (magic, version, record_size, count, index, wall_time,
+         monotonic_ns) = flightrecorder.SEGMENT_HEADER.unpack_from(data)
+        if magic != flightrecorder.SEGMENT_MAGIC or version != flightrecorder.SEGMENT_VERSION:
+            raise ValueError(f'Invalid segment file: {f.name}')
+        records = np.frombuffer(data, RECORD_DTYPE,
+                                (len(data) - flightrecorder.HEADER_SIZE) // RECORD_DTYPE.itemsize,
+                                flightrecorder.HEADER_SIZE)
+        kinds = records['type']
+        end_marks = np.flatnonzero(kinds == 0)
+        if len(end_marks):
+            records = records[:end_marks[0]]
+            kinds = kinds[:end_marks[0]]
+        records = records[kinds == flightrecorder.RECORD_TELEMETRY]
+        record_times = wall_time + (records['monotonic_ns'].astype(np.int64)
+                                    - monotonic_ns) / 1e9
+        selected = np.ones(len(records), bool)
+        if start is not None:
+            selected &= record_times >= start
+        if end is not None:
+            selected &= record_times <= end
+        times.append(record_times[selected])
+        values.append(records['values'][selected])
+    if not times:
+        return np.zeros(0), np.zeros((0, CHANNELS), np.float32)
+    return np.concatenate(times), np.concatenate(values)
+
+
+#region TelemetryWindow
+class TelemetryWindow(object):
+    """
+    Ring buffer of the telemetry samples with the statistics of the last window
+    seconds (see module docstring). The times must not decrease (e.g.
+    time.monotonic). Samples are numbered by the absolute index (head: number of
+    appended samples), the slot in the ring is index % capacity.
+    """
+    BLOCK = 64          # samples per block (min/max), and per batch of append
+
+    def __init__(self, window=10.0, capacity=1 << 16, alpha=0.1):
+        """
+        Constructor: window is the length of the statistics window (s), capacity
+        the max. number of samples in the ring (rounded up to a multiple of BLOCK,
+        must hold the samples of the window, older samples are dropped from the
+        statistics), alpha the weight of a new sample in the EMA.
+        """
+        block = self.BLOCK
+        capacity = max(2 * block, -(-capacity // block) * block)
+        self.window = window
+        self.capacity = capacity
+        self.alpha = alpha
+        self.times = np.zeros(capacity)
+        self.values = np.full((capacity, CHANNELS), np.nan, np.float32)
+        self.block_min = np.full((capacity // block, CHANNELS), np.nan, np.float32)
+        self.block_max = np.full((capacity // block, CHANNELS), np.nan, np.float32)
+        self.head = 0               # next sample
+        self.done = 0               # samples up to here are in the statistics
+        self.tail = 0               # oldest sample of the window
+        self.sums = np.zeros(CHANNELS)
+        self.counts = np.zeros(CHANNELS, np.int64)
+        self.ema = np.full(CHANNELS, np.nan)
+        self.evicted = 0            # samples subtracted since the sums were recomputed
+        self.snapshot = {'samples': 0}  # flat statistics for other threads (publish)
+
+    def append(self, timestamp, floats):
+        """
+        Adds a sample (time in s, 8 floats).
+        """
+        if self.head - self.tail >= self.capacity:
+            self.make_room(1)
+        slot = self.head % self.capacity
+        self.times[slot] = timestamp
+        self.values[slot] = floats
+        self.head += 1
+        if self.head - self.done >= self.BLOCK:
+            self.update()
+
+    def extend(self, timestamps, values):
+        """
+        Adds a batch of samples: timestamps (array of s) and values (samples x
+        channels array or the structured array of decode_frames).
+        """
+        if values.dtype == TELEMETRY_DTYPE:
+            values = channels(values)
+        timestamps = np.asarray(timestamps, np.float64)
+        chunk = self.capacity // 2
+        for start in range(0, len(values), chunk):
+            count = min(chunk, len(values) - start)
+            self.make_room(count)
+            for a, b, offset in self.slices(self.head, self.head + count):
+                self.times[a:b] = timestamps[start + offset:start + offset + b - a]
+                self.values[a:b] = values[start + offset:start + offset + b - a]
+            self.head += count
+            self.update()
+
+    def make_room(self, count):
+        """
+        Drops the oldest samples from the statistics, so count samples fit into the
+        ring without overwriting a sample of the statistics.
+        """
+        self.update()
+        if self.head + count - self.tail > self.capacity:
+            self.evict(self.head + count - self.capacity)
+
+    def slices(self, start, end):
+        """
+        Returns the ring slices (a, b, offset) of the samples start..end (absolute
+        indexes, at most capacity samples): slot range and offset in the samples.
+        """
+        capacity = self.capacity
+        a = start % capacity
+        count = end - start
+        if a + count <= capacity:
+            return [(a, a + count, 0)]
+        return [(a, capacity, 0), (0, a + count - capacity, capacity - a)]
+
+    def update(self):
+        """
+        Adds the new samples to the statistics and drops the samples, which are
+        older than the window.
+        """
+        start, end = self.done, self.head
+        if start == end:
+            return
+        block = self.BLOCK
+        for a, b, offset in self.slices(start, end):
+            values = self.values[a:b]
+            finite = np.isfinite(values)
+            self.sums += np.where(finite, values, 0).sum(0, np.float64)
+            self.counts += finite.sum(0)
+            self.update_ema(values, finite)
+        # min/max of the blocks, which were completed (a block doesn't wrap)
+        first = start // block
+        last = end // block
+        if last > first:
+            for a, b, offset in self.slices(first * block, last * block):
+                blocks = self.values[a:b].reshape(-1, block, CHANNELS)
+                self.block_min[a // block:b // block] = np.fmin.reduce(blocks, 1)
+                self.block_max[a // block:b // block] = np.fmax.reduce(blocks, 1)
+        self.done = end
+
+        newest = self.times[(end - 1) % self.capacity]
+        tail = self.find(newest - self.window)
+        if tail > self.tail:
+            self.evict(tail)
+
+    def update_ema(self, values, finite):
+        """
+        Updates the EMA with the samples (samples x channels): ema = alpha * value +
+        (1 - alpha) * ema for every finite sample, computed as weighted sum (the
+        weight of a value depends on the number of finite samples after it). A
+        channel without EMA starts with its first value.
+        """
+        values = values.astype(np.float64)
+        ema = self.ema.copy()
+        start = np.isnan(ema) & finite.any(0)
+        if start.any():
+            columns = np.flatnonzero(start)
+            ema[columns] = values[finite.argmax(0)[columns], columns]
+        decay = 1.0 - self.alpha
+        later = finite[::-1].cumsum(0)[::-1] - finite     # finite samples after a sample
+        weights = np.where(finite, self.alpha * decay ** later, 0.0)
+        self.ema = (decay ** finite.sum(0) * ema
+                    + (weights * np.where(finite, values, 0.0)).sum(0))
+
+    def find(self, timestamp):
+        """
+        Returns the absolute index of the first sample of the statistics with a
+        time >= timestamp (done, if there is none).
+        """
+        index = self.tail
+        for a, b, offset in self.slices(self.tail, self.done):
+            position = np.searchsorted(self.times[a:b], timestamp)
+            index = self.tail + offset + position
+            if position < b - a:
+                break
+        return index
+
+    def evict(self, tail):
+        """
+        Removes the samples before tail (absolute index) from the statistics. The
+        sums are recomputed after capacity samples (no drift of the float sums).
+        """
+        tail = min(tail, self.done)
+        self.evicted += tail - self.tail
+        if self.evicted >= self.capacity:
+            self.tail = tail
+            self.evicted = 0
+            self.sums[:] = 0
+            self.counts[:] = 0
+            for a, b, offset in self.slices(self.tail, self.done):
+                values = self.values[a:b]
+                finite = np.isfinite(values)
+                self.sums += np.where(finite, values, 0).sum(0, np.float64)
+                self.counts += finite.sum(0)
+            return
+        for a, b, offset in self.slices(self.tail, tail):
+            values = self.values[a:b]
+            finite = np.isfinite(values)
+            self.sums -= np.where(finite, values, 0).sum(0, np.float64)
+            self.counts -= finite.sum(0)
+        self.tail = tail
+
+    def extremes(self):
+        """
+        Returns the tuple (min, max) of the window per channel (nan: no value).
+        """
+        block = self.BLOCK
+        start, end = self.tail, self.done
+        minimum = np.full(CHANNELS, np.nan, np.float32)
+        maximum = np.full(CHANNELS, np.nan, np.float32)
+        if start == end:
+            return minimum, maximum
+        first = -(-start // block)          # first complete block
+        last = end // block                 # end of the complete blocks
+        if first >= last:
+            parts = [(start, end)]
+        else:
+            parts = [(start, first * block), (last * block, end)]
+            blocks = np.arange(first, last) % (self.capacity // block)
+            minimum = np.fmin.reduce(self.block_min[blocks], 0)
+            maximum = np.fmax.reduce(self.block_max[blocks], 0)
+        for part_start, part_end in parts:
+            for a, b, offset in self.slices(part_start, part_end):
+                if b > a:
+                    minimum = np.fmin(minimum, np.fmin.reduce(self.values[a:b], 0))
+                    maximum = np.fmax(maximum, np.fmax.reduce(self.values[a:b], 0))
+        return minimum, maximum
+
+    def statistics(self):
+        """
+        Returns the statistics of the window as dictionary of arrays per channel
+        (mean, min, max, ema, count: finite samples) and the number of samples.
+        """
+        self.update()
+        minimum, maximum = self.extremes()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = self.sums / self.counts
+        return {
+            'samples': self.done - self.tail,
+            'count': self.counts.copy(),
+            'mean': mean,
+            'min': minimum.astype(np.float64),
+            'max': maximum.astype(np.float64),
+            'ema': self.ema.copy(),
+        }
+
+    def last(self, seconds, now=None):
+        """
+        Returns the samples of the last seconds (before now, default: the time of
+        the newest sample) as tuple (times, values), copies. Samples older than the
+        window are returned as long as they are in the ring.
+        """
+        self.update()
+        oldest = max(0, self.head - self.capacity)
+        if self.head == oldest:
+            return np.zeros(0), np.zeros((0, CHANNELS), np.float32)
+        if now is None:
+            now = self.times[(self.head - 1) % self.capacity]
+        parts = self.slices(oldest, self.head)
+        times = np.concatenate([self.times[a:b] for a, b, offset in parts])
+        values = np.concatenate([self.values[a:b] for a, b, offset in parts])
+        start = np.searchsorted(times, now - seconds)
+        end = np.searchsorted(times, now, 'right')
+        return times[start:end], values[start:end]
+
+    def publish(self):
+        """
+        Computes the statistics as flat dictionary (<field>_mean, _min, _max, _ema;
+        field in lower case) and publishes them as snapshot. Must be called by the
+        thread, which appends the samples.
+        """
+        statistics = self.statistics()
+        result = {'samples': statistics['samples']}
+        for i, name in enumerate(FIELDS):
+            name = name.lower()
+            for kind in ('mean', 'min', 'max', 'ema'):
+                result[f'{name}_{kind}'] = float(statistics[kind][i])
+        self.snapshot = result
+
+    def stats(self):
+        """
+        Returns the last published statistics (see publish) for the metrics. Read
+        only, so the metrics can be rendered by another thread (e.g. the HTTP
+        thread in threaded SERVER_MODE), while samples are appended.
+        """
+        return self.snapshot
+#endregion
+
+
+if __name__ == "__main__":
+    '''
+    Testprogramm for the window: random samples (with nan) in irregular batches,
+    the statistics must match the direct computation over the samples of the
+    window, the EMA the sequential computation.
+    '''
+    import math
+    import random
+    import warnings
+
+    rng = np.random.default_rng(1)
+    count = 20000
+    times = np.cumsum(rng.uniform(0.001, 0.003, count))
+    values = rng.normal(0, 10, (count, CHANNELS)).astype(np.float32)
+    values[rng.random((count, CHANNELS)) < 0.01] = np.nan
+    values[:300, 3] = np.nan        # channel without values at the start
+
+    assert np.array_equal(channels(decode_frames(values.tobytes())), values, equal_nan=True)
+
+    window = TelemetryWindow(window=2.0, capacity=2048, alpha=0.05)
+    position = 0
+    random.seed(1)
+    while position < count:
+        if random.random() < 0.5:
+            window.append(times[position], tuple(values[position]))
+            position += 1
+        else:
+            size = min(random.randint(1, 3000), count - position)
+            window.extend(times[position:position + size], values[position:position + size])
+            position += size
+        statistics = window.statistics()
+        selected = values[(times > times[position - 1] - 2.0) & (times <= times[position - 1])]
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            expected_mean = np.nanmean(selected.astype(np.float64), 0)
+            expected_min = np.nanmin(selected, 0)
+            expected_max = np.nanmax(selected, 0)
+        assert statistics['samples'] == len(selected), (statistics['samples'], len(selected))
+        assert np.allclose(statistics['mean'], expected_mean, atol=1e-6, equal_nan=True)
+        assert np.array_equal(statistics['min'], expected_min, equal_nan=True)
+        assert np.array_equal(statistics['max'], expected_max, equal_nan=True)
+
+    ema = [math.nan] * CHANNELS
+    for sample in values.astype(np.float64):
+        for i, value in enumerate(sample):
+            if math.isfinite(value):
+                ema[i] = value if math.isnan(ema[i]) else 0.05 * value + 0.95 * ema[i]
+    assert np.allclose(window.statistics()['ema'], ema), (window.statistics()['ema'], ema)
+
+    last_times, last_values = window.last(0.5)
+    expected = times[times >= times[-1] - 0.5]
+    assert np.array_equal(last_times, expected), (len(last_times), len(expected))
+    print(f'window ok: {window.statistics()["samples"]} samples in the window')
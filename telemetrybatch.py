@@ -0,0 +1,141 @@
+import struct
+
+from telemetrydata import TelemetrySerializer
+
+# Binary telemetry batch (compact alternative to a JSON array).
+# Layout (little-endian):
+#   header: magic (1 Byte), version (1 Byte), number of samples (2 Bytes)
+#   sample: timestamp (float64), BATT_AMP ... LATITUDE (8x float32)
+TELEMETRY_BATCH_MAGIC = 0xD7
+TELEMETRY_BATCH_VERSION = 1
+BATCH_HEADER = struct.Struct('<BBH')
+BATCH_RECORD = struct.Struct('<d8f')
+
+class TelemetryBatcher(object):
+    """
+    Collects telemetry samples and sends them in batches: one datagram per
+    batch_size samples or after interval seconds, whichever comes first. A
+    datagram never gets bigger than max_datagram bytes (MTU). Optionally, the
+    samples are decimated to rate samples per second.
+
+    With batch_size 1 and no interval, every sample is sent as a single JSON object
+    (the original format, see TelemetrySerializer). Otherwise the datagram is a
+    JSON array of these objects or a binary block (see BATCH_HEADER, BATCH_RECORD).
+    """
+    def __init__(self, send, batch_size=1, interval=0, rate=0, binary=False,
+                 max_datagram=1400):
+        """
+        Constructor: send is called with every datagram (bytes).
+        """
+        self.send = send
+        self.batch_size = batch_size
+        self.interval = interval
+        self.min_distance = 1 / rate if rate > 0 else 0
+        self.binary = binary
+        self.max_datagram = max_datagram
+        self.single = not binary and batch_size <= 1 and not interval
+        self.serializer = TelemetrySerializer()
+
+        self.records = []
+        self.size = 0               # size of the collected records
+        self.batch_start = 0        # timestamp of the first collected sample
+        self.next_sample = None     # earliest timestamp of the next sample (decimation)
+
+        # statistics
+        self.samples = 0            # samples sent
+        self.decimated = 0          # samples discarded by the decimation
+        self.datagrams = 0          # datagrams sent (= sendto calls)
+        self.bytes = 0              # bytes sent (UDP payload)
+
+    def add(self, timestamp, floats):
+        """
+        Adds a sample (timestamp, tuple of 8 floats). Sends the batch, if it is full.
+        """
+        if self.min_distance:
+            # keep one sample per period (1 % tolerance for jitter/rounding)
+            if (self.next_sample is not None
+                    and timestamp < self.next_sample - 0.01 * self.min_distance):
+                self.decimated += 1
+                return
+            # next period (after a gap: relative to this sample, no burst)
+            if self.next_sample is None:
+                self.next_sample = timestamp
+            self.next_sample = (max(self.next_sample, timestamp - self.min_distance / 2)
+                                + self.min_distance)
+
+        if self.single:
+            self.send_datagram(self.serializer.serialize(timestamp, floats), 1)
+            return
+        if self.binary:
+            record = BATCH_RECORD.pack(timestamp, *floats)
+            overhead = BATCH_HEADER.size
+        else:
+            record = self.serializer.serialize(timestamp, floats)
+            overhead = 2 + 2 * len(self.records)        # '[', ']' and ', '
+        if self.records and self.size + len(record) + overhead > self.max_datagram:
+            self.flush()
+
+        if not self.records:
+            self.batch_start = timestamp
+        self.records.append(record)
+        self.size += len(record)
+        if (len(self.records) >= self.batch_size
+                or (self.interval and timestamp - self.batch_start >= self.interval)):
+            self.flush()
+
+    def flush(self):
+        """
+        Sends the collected samples (if any) as one datagram.
+        """
+        records = self.records
+        if not records:
+            return
+        if self.binary:
+            datagram = (BATCH_HEADER.pack(TELEMETRY_BATCH_MAGIC, TELEMETRY_BATCH_VERSION,
+                                          len(records)) + b''.join(records))
+        else:
+            datagram = b'[' + b', '.join(records) + b']'
+        self.records = []
+        self.size = 0
+        self.send_datagram(datagram, len(records))
+
+    def send_datagram(self, datagram, samples):
+        """
+        Sends a datagram with the number of samples and counts it.
+        """
+        self.samples += samples
+        self.datagrams += 1
+        self.bytes += len(datagram)
+        self.send(datagram)
+
+    def timeout(self, now):
+        """
+        Returns the seconds until the collected samples must be sent (interval) or
+        None, if there is nothing to wait for.
+        """
+        if not self.records or not self.interval:
+            return None
+        return max(0, self.batch_start + self.interval - now)
+
+    def stats(self):
+        """
+        Returns the statistics of the batcher as dictionary.
+        """
+        return {
+            'samples': self.samples,
+            'decimated': self.decimated,
+            'datagrams': self.datagrams,
+            'bytes': self.bytes,
+        }
+
+
+def decode_batch(datagram):
+    """
+    Decodes a binary telemetry batch and returns a list of tuples
+    (timestamp, 8 floats).
+    """
+    magic, version, count = BATCH_HEADER.unpack_from(datagram)
+    if magic != TELEMETRY_BATCH_MAGIC or version != TELEMETRY_BATCH_VERSION:
+        raise ValueError('Invalid telemetry batch')
+    return list(BATCH_RECORD.iter_unpack(
+        memoryview(datagram)[BATCH_HEADER.size:BATCH_HEADER.size + count * BATCH_RECORD.size]))
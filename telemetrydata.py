@@ -1,13 +1,19 @@
 # https://pynative.com/make-python-class-json-serializable/
 
 import json
+import struct
 from json import JSONEncoder
 
+# Telemetry frame (Teensy -> Pi): 8x float32, little-endian (32 Bytes)
+TELEMETRY_FRAME = struct.Struct('<8f')
+
 class TelemetryData:
     """
     A class representing telemetry data with various sensor readings.
 
     """
+    __slots__ = ('TIMESTAMP', 'BATT_AMP', 'BATT_VOLT', 'BOARD_AMP', 'HYDRO', 'TEMP', 
+                 'PRESSURE', 'LONGITUDE', 'LATITUDE')
     
     def __init__(self, timestamp, float_values_tuple: tuple):
         """
@@ -24,15 +30,24 @@ class TelemetryData:
             LONGITUDE (float): GPS longitude coordinate.
             LATITUDE (float): GPS latitude coordinate.
         """
+        (batt_amp, batt_volt, board_amp, hydro, 
+         temp, pressure, longitude, latitude) = float_values_tuple
         self.TIMESTAMP = timestamp
-        self.BATT_AMP = round(float_values_tuple[0], 6)
-        self.BATT_VOLT = round(float_values_tuple[1],6)
-        self.BOARD_AMP = round(float_values_tuple[2], 6)
-        self.HYDRO = round(float_values_tuple[3], 6)
-        self.TEMP = round(float_values_tuple[4], 6)
-        self.PRESSURE = round(float_values_tuple[5], 6)
-        self.LONGITUDE = round(float_values_tuple[6], 6)
-        self.LATITUDE = round(float_values_tuple[7], 6)
+        self.BATT_AMP = round(batt_amp, 6)
+        self.BATT_VOLT = round(batt_volt, 6)
+        self.BOARD_AMP = round(board_amp, 6)
+        self.HYDRO = round(hydro, 6)
+        self.TEMP = round(temp, 6)
+        self.PRESSURE = round(pressure, 6)
+        self.LONGITUDE = round(longitude, 6)
+        self.LATITUDE = round(latitude, 6)
+    
+    @classmethod
+    def from_bytes(cls, timestamp, data):
+        """
+        Creates a TelemetryData object from a 32 Byte telemetry frame.
+        """
+        return cls(timestamp, TELEMETRY_FRAME.unpack(data))
 
 class TelemetryDataEncoder(JSONEncoder):
     """
@@ -45,4 +60,52 @@ class TelemetryDataEncoder(JSONEncoder):
         Returns:
             A dictionary of the object's attribute-value pairs.
         """
-        return o.__dict__
\ No newline at end of file
+        return {name: getattr(o, name) for name in o.__slots__}
+
+
+def value_text(value):
+    """
+    Returns the JSON text (bytes) of a telemetry value rounded to 6 decimals, the
+    same text as json.dumps(round(value, 6)). The fixed-precision text ('%.6f'
+    without the trailing zeros) is the shortest repr, if the value has at most 15
+    significant digits and repr doesn't use the exponent notation, that is for
+    1e-4 <= |value| < 1e9 and 0. Other values (and nan/inf) are written by json.
+    """
+    if 1e-4 <= abs(value) < 1e9 or value == 0:
+        text = (b'%.6f' % value).rstrip(b'0')
+        if text[-1] == 46:      # '.'
+            text += b'0'
+        return text
+    return json.dumps(round(value, 6)).encode('ascii')
+
+
+class TelemetrySerializer(object):
+    """
+    Compiled JSON serializer of the telemetry samples. The keys and separators are
+    encoded once and the message is written into a reusable bytearray: the
+    constant segments and the fixed-precision text of the values (see value_text).
+    The result is the same as json.dumps(TelemetryData(timestamp, floats),
+    cls=TelemetryDataEncoder), which the smartphone app parses.
+    """
+    def __init__(self):
+        names = TelemetryData.__slots__
+        self.prefix = ('{"%s": ' % names[0]).encode('ascii')
+        # segment before the value of a field: its key
+        self.keys = [(', "%s": ' % name).encode('ascii') for name in names[1:]]
+        self.buffer = bytearray()
+
+    def serialize(self, timestamp, floats):
+        """
+        Returns the JSON object of a sample (timestamp, 8 floats) as bytes.
+        """
+        buffer = self.buffer
+        del buffer[:]
+        extend = buffer.extend
+        text = value_text
+        extend(self.prefix)
+        extend(repr(timestamp).encode('ascii'))
+        for value, key in zip(floats, self.keys):
+            extend(key)
+            extend(text(value))
+        extend(b'}')
+        return bytes(buffer)
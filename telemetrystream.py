@@ -0,0 +1,215 @@
+"""
+Telemetry for the browser clients (websocket path TELEMETRY_PATH).
+
+The values are quantized (FIELD_STEPS) and a client only gets the fields, which
+changed since its last update. After the handshake the client gets the schema
+once (text message, JSON), then binary updates (little-endian):
+
+    mask (1 Byte: bit i --> field i follows) | quantized value (int32) per field
+
+value * step is the field value, NO_VALUE stands for nan/inf. The updates of a
+client are throttled to its rate: values, which change in between, are merged
+into the next update.
+"""
+import json
+import math
+import struct
+from urllib.parse import parse_qs
+
+from framequeue import AsyncSendQueue, SendQueue
+from telemetrydata import TelemetryData
+
+TELEMETRY_PATH = '/telemetry'
+
+# fields of the telemetry frame (without TIMESTAMP) and their quantization step
+# (= threshold: a field is sent, when it changed by at least one step)
+TELEMETRY_FIELDS = TelemetryData.__slots__[1:]
+FIELD_STEPS = (
+    0.01,       # BATT_AMP
+    0.01,       # BATT_VOLT
+    0.01,       # BOARD_AMP
+    0.01,       # HYDRO
+    0.1,        # TEMP
+    0.01,       # PRESSURE
+    1e-6,       # LONGITUDE (~0.1 m)
+    1e-6,       # LATITUDE
+)
+
+NO_VALUE = -0x80000000
+_MAX_VALUE = 0x7FFFFFFF
+
+# update message with n fields
+_UPDATES = [struct.Struct('<B' + 'i' * n) for n in range(len(TELEMETRY_FIELDS) + 1)]
+
+SCHEMA = json.dumps({
+    'fields': TELEMETRY_FIELDS,
+    'steps': FIELD_STEPS,
+    'novalue': NO_VALUE,
+})
+
+
+def quantize(floats):
+    """
+    Returns the quantized values (tuple of int32) of the 8 telemetry floats.
+    """
+    values = []
+    for value, step in zip(floats, FIELD_STEPS):
+        if math.isfinite(value):
+            values.append(max(-_MAX_VALUE, min(_MAX_VALUE, round(value / step))))
+        else:
+            values.append(NO_VALUE)
+    return tuple(values)
+
+
+def encode_update(last, current):
+    """
+    Returns the update message with the fields of current, which differ from last
+    (None: all fields), or None, if nothing changed.
+    """
+    mask = 0
+    values = []
+    for i, value in enumerate(current):
+        if last is None or value != last[i]:
+            mask |= 1 << i
+            values.append(value)
+    if not mask:
+        return None
+    return _UPDATES[len(values)].pack(mask, *values)
+
+
+def decode_update(message, state):
+    """
+    Applies an update message to state (list of 8 floats, used by the clients, here
+    for testing) and returns state.
+    """
+    mask = message[0]
+    offset = 1
+    for i, step in enumerate(FIELD_STEPS):
+        if mask & (1 << i):
+            value, = struct.unpack_from('<i', message, offset)
+            offset += 4
+            state[i] = math.nan if value == NO_VALUE else value * step
+    return state
+
+
+def client_rate(query, max_rate):
+    """
+    Returns the update rate of a client: the rate parameter of the query string
+    (e.g. rate=5), at most max_rate.
+    """
+    try:
+        rate = float(parse_qs(query).get('rate', ['0'])[0])
+    except ValueError:
+        rate = 0
+    if rate <= 0:
+        return max_rate
+    return min(rate, max_rate) if max_rate > 0 else rate
+
+
+#region TelemetryChannel
+class TelemetryChannel(object):
+    """
+    Newest telemetry state for the browser clients. publish is called for every
+    sample on the event loop; the values are quantized once per sample (not per
+    client) and only while clients are connected.
+    """
+    def __init__(self):
+        self.floats = None
+        self.current = None         # quantized values
+        self.clients = frozenset()  # replaced on change (subscribe is called by
+                                    # the ws4py threads)
+
+    def subscribe(self, client):
+        """
+        Adds a client. It gets the current state with the first update.
+        """
+        if self.current is None and self.floats is not None:
+            self.current = quantize(self.floats)
+        self.clients = self.clients | {client}
+        if self.current is not None:
+            client.notify()
+
+    def unsubscribe(self, client):
+        """
+        Removes a client.
+        """
+        self.clients = self.clients - {client}
+
+    def publish(self, floats):
+        """
+        This method sets the newest telemetry values (tuple of 8 floats) and wakes
+        up the clients.
+        """
+        self.floats = floats
+        clients = self.clients
+        if not clients:
+            self.current = None
+            return
+        self.current = quantize(floats)
+        for client in clients:
+            client.notify()
+#endregion
+
+#region TelemetryClient
+class TelemetryClient(SendQueue):
+    """
+    Update state of one browser client: the values it got last and the throttle
+    (max. rate updates per second, 0 --> no limit). It is the send queue of the
+    client (see SendQueue): get returns the update message for the newest state.
+    """
+    def __init__(self, channel, rate=0):
+        super(TelemetryClient, self).__init__(1 / rate if rate > 0 else 0)
+        self.channel = channel
+        self.last = None            # quantized values sent last
+        self.pending = False
+
+        # statistics
+        self.bytes = 0              # bytes sent (without websocket header)
+
+    def update(self):
+        """
+        Returns the update message for the newest state or None, if nothing changed.
+        """
+        current = self.channel.current
+        if current is None:
+            return None
+        message = encode_update(self.last, current)
+        self.last = current
+        return message
+
+    def notify(self):
+        """
+        Marks the state as changed and wakes up the sender.
+        """
+        with self.condition:
+            self.pending = True
+            self.wake()
+
+    def poll(self):
+        """
+        Returns the update message, if the state changed since the last one, or
+        None.
+        """
+        if not self.pending:
+            return None
+        self.pending = False
+        message = self.update()
+        if message is not None:
+            self.bytes += len(message)
+        return message
+
+    def stats(self):
+        """
+        Returns the statistics of the client as dictionary.
+        """
+        return {
+            'sent': self.sent,
+            'bytes': self.bytes,
+        }
+
+class AsyncTelemetryClient(AsyncSendQueue, TelemetryClient):
+    """
+    TelemetryClient for the asyncio server: the sender is a coroutine (see
+    AsyncSendQueue).
+    """
+#endregion
@@ -0,0 +1,20 @@
+import os
+import sys
+
+# the modules of the server are flat modules in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from camerasource import synthetic_h264
+from output import NalSplitter
+
+
+def nal_units(frames=100, frame_size=2000, gop=10):
+    """
+    Returns the NAL units of a synthetic H.264 stream (a keyframe every gop
+    frames), split like the camera output.
+    """
+    units = []
+    splitter = NalSplitter(lambda unit: units.append(bytes(unit)))
+    splitter.write(synthetic_h264(frames, frame_size, gop=gop))
+    splitter.flush()
+    return units
@@ -0,0 +1,99 @@
+"""
+Tests of the asset cache of the web client (assetcache) on a temporary web root:
+ETag and 304 Not Modified, gzip only when accepted (and smaller), reload after a
+change of the file and the allowlist of the paths.
+"""
+import gzip
+import os
+
+import pytest
+
+from assetcache import AssetCache, etag_matches
+
+SCRIPT = b'function draw() { return 1; }\n' * 50
+
+
+@pytest.fixture
+def cache(tmp_path):
+    (tmp_path / 'js').mkdir()
+    (tmp_path / 'css').mkdir()
+    (tmp_path / 'js' / 'app.js').write_bytes(SCRIPT)
+    (tmp_path / 'css' / 'tiny.css').write_bytes(b'a{}')
+    (tmp_path / 'js' / 'notes.txt').write_bytes(b'not served')
+    (tmp_path / 'secret.js').write_bytes(b'secret')
+    (tmp_path / 'index.html').write_text('<script>var ws = "ws://${ADDRESS}/";</script>')
+    return AssetCache(8084, str(tmp_path))
+
+
+def test_plain_response_is_sent_with_sendfile(cache):
+    status, headers, body, filename = cache.get('/js/app.js', '10.0.0.1').response({})
+    headers = dict(headers)
+    assert status == 200 and body is None and filename.endswith('app.js')
+    assert headers['Content-Length'] == len(SCRIPT)
+    assert headers['Content-Type'] == 'application/javascript'
+    assert 'Content-Encoding' not in headers
+
+
+def test_gzip_when_accepted(cache):
+    asset = cache.get('/js/app.js?v=2', '10.0.0.1')
+    status, headers, body, filename = asset.response({'accept-encoding': 'gzip, br'})
+    headers = dict(headers)
+    assert status == 200 and filename is None
+    assert headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(body) == SCRIPT
+    assert headers['ETag'] != asset.etag
+
+
+def test_no_gzip_if_not_smaller(cache):
+    asset = cache.get('/css/tiny.css', '10.0.0.1')
+    assert asset.gzip_body is None
+    status, headers, body, filename = asset.response({'accept-encoding': 'gzip'})
+    assert 'Content-Encoding' not in dict(headers)
+
+
+def test_not_modified(cache):
+    asset = cache.get('/js/app.js', '10.0.0.1')
+    for encoding in ('', 'gzip'):
+        request = {'accept-encoding': encoding}
+        etag = dict(asset.response(request)[1])['ETag']
+        request['if-none-match'] = etag
+        status, headers, body, filename = asset.response(request)
+        assert status == 304 and body is None and filename is None
+    # the ETag of the other encoding doesn't match
+    status = asset.response({'if-none-match': asset.gzip_etag})[0]
+    assert status == 200
+
+
+@pytest.mark.parametrize('header, result', [
+    (None, False), ('', False), ('"a"', True), ('"b", "a"', True), ('W/"a"', True),
+    ('*', True), ('"ab"', False)])
+def test_etag_matches(header, result):
+    assert etag_matches(header, '"a"') == result
+
+
+def test_reload_after_change(cache, tmp_path):
+    asset = cache.get('/js/app.js', '10.0.0.1')
+    assert cache.get('/js/app.js', '10.0.0.1') is asset
+    path = tmp_path / 'js' / 'app.js'
+    path.write_bytes(b'changed')
+    os.utime(path, (asset.mtime + 10, asset.mtime + 10))
+    changed = cache.get('/js/app.js', '10.0.0.1')
+    assert changed.body == b'changed' and changed.etag != asset.etag
+    path.unlink()
+    assert cache.get('/js/app.js', '10.0.0.1') is None
+
+
+def test_index_per_address(cache):
+    first = cache.get('/index.html', '10.0.0.1')
+    assert first.body == b'<script>var ws = "ws://10.0.0.1:8084/";</script>'
+    assert first.filename is None
+    assert cache.get('/index.html', '10.0.0.1') is first
+    assert b'192.168.4.1:8084' in cache.get('/index.html', '192.168.4.1').body
+
+
+@pytest.mark.parametrize('path', [
+    '/secret.js', '/../secret.js', '/js/../secret.js', '/js/../../etc/passwd.js',
+    '//etc/passwd', '/js/notes.txt', '/js/', '/js', '/js/missing.js', '/config.py',
+    '/tests/conftest.py'])
+def test_path_allowlist(cache, path):
+    assert cache.get(path, '10.0.0.1') is None
@@ -0,0 +1,104 @@
+"""
+Tests of the HTTP and websocket parsing of the asyncio server (async_http_server)
+on in-memory streams: request heads, frame headers of all length encodings and
+masked client frames.
+"""
+import asyncio
+import os
+import struct
+
+import pytest
+
+from async_http_server import (MAX_CLIENT_MESSAGE, OPCODE_BINARY, OPCODE_CLOSE,
+                               OPCODE_TEXT, accept_key, frame_header, read_frame,
+                               read_request, response_head)
+
+
+def parse(coroutine_function, data, *args):
+    """
+    Runs coroutine_function(reader, *args) on a stream reader with data (then
+    EOF) and returns the result.
+    """
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        return await coroutine_function(reader, *args)
+    return asyncio.run(run())
+
+
+def client_frame(opcode, payload, mask):
+    """
+    Returns a masked websocket frame (client -> server).
+    """
+    length = len(payload)
+    if length < 126:
+        head = bytes((0x80 | opcode, 0x80 | length))
+    elif length < 65536:
+        head = struct.pack('!BBH', 0x80 | opcode, 0x80 | 126, length)
+    else:
+        head = struct.pack('!BBQ', 0x80 | opcode, 0x80 | 127, length)
+    masked = bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+    return head + mask + masked
+
+
+def test_read_request():
+    request = parse(read_request, b'GET /index.html?x=1 HTTP/1.1\r\nHost: pi:8082\r\n'
+                                  b'Upgrade: WebSocket\r\nX-Empty:\r\n\r\nbody')
+    assert request == ('GET', '/index.html?x=1', {'host': 'pi:8082',
+                                                  'upgrade': 'WebSocket',
+                                                  'x-empty': ''})
+
+
+@pytest.mark.parametrize('data', [b'', b'GET / HTTP/1.1\r\nHost: pi\r\n',
+                                  b'GARBAGE\r\n\r\n'])
+def test_read_request_invalid(data):
+    assert parse(read_request, data) is None
+
+
+@pytest.mark.parametrize('length', [0, 1, 125, 126, 127, 65535, 65536, 70000])
+def test_frame_header_round_trip(length):
+    payload = os.urandom(length)
+    opcode, received = parse(read_frame, frame_header(OPCODE_BINARY, length) + payload,
+                             1 << 20)
+    assert opcode == OPCODE_BINARY and received == payload
+    assert len(frame_header(OPCODE_BINARY, length)) == (2 if length < 126 else
+                                                        4 if length < 65536 else 10)
+
+
+@pytest.mark.parametrize('length', [0, 1, 3, 4, 5, 125, 126, 1000])
+def test_masked_client_frame(length):
+    payload = os.urandom(length)
+    frame = client_frame(OPCODE_TEXT, payload, b'\x37\xfa\x21\x3d')
+    assert parse(read_frame, frame) == (OPCODE_TEXT, payload)
+
+
+def test_close_frame_and_fragmented_input():
+    async def run():
+        reader = asyncio.StreamReader()
+        frame = client_frame(OPCODE_CLOSE, struct.pack('!H', 1000), b'\x01\x02\x03\x04')
+        task = asyncio.create_task(read_frame(reader))
+        for i in range(len(frame)):
+            reader.feed_data(frame[i:i + 1])
+            await asyncio.sleep(0)
+        return await task
+    assert asyncio.run(run()) == (OPCODE_CLOSE, struct.pack('!H', 1000))
+
+
+def test_too_big_message_is_rejected():
+    frame = client_frame(OPCODE_BINARY, bytes(MAX_CLIENT_MESSAGE + 1), b'abcd')
+    with pytest.raises(ValueError):
+        parse(read_frame, frame)
+
+
+def test_truncated_frame():
+    frame = client_frame(OPCODE_BINARY, bytes(100), b'abcd')
+    with pytest.raises(asyncio.IncompleteReadError):
+        parse(read_frame, frame[:-1])
+
+
+def test_handshake_helpers():
+    # example of RFC 6455
+    assert accept_key('dGhlIHNhbXBsZSBub25jZQ==') == 's3pPLMBiTxaQ9kYGzzhZRbK+xOo='
+    assert response_head(304, [('ETag', '"1"')]) == \
+        b'HTTP/1.1 304 Not Modified\r\nETag: "1"\r\n\r\n'
@@ -0,0 +1,55 @@
+"""
+Tests of the decoding of the control datagrams (CommData.from_datagram): valid
+JSON objects and binary control packets are decoded, everything else raises one
+of the errors, which process_udp_data counts as invalid packet.
+"""
+import pytest
+
+from communicationdata import CommData, CONTROL_PACKET, CONTROL_PACKET_MAGIC
+
+VALUES = {'Pitch': 1024, 'Roll': 1000, 'Yaw': 1024, 'Power': 0, 'PitchG': 512,
+          'RollG': 0, 'YawG': 512}
+INVALID = (ValueError, KeyError, TypeError, OverflowError)
+
+
+def test_json_object():
+    data = CommData.from_datagram(b'{"Pitch": 1024, "Roll": 1000, "Yaw": 1024, '
+                                  b'"Power": 0, "PitchG": 512, "RollG": 0, "YawG": 512}')
+    assert {name: getattr(data, name) for name in VALUES} == VALUES
+    assert data.Seq is None
+
+
+def test_binary_packet_round_trip():
+    packet = CommData(**VALUES).to_packet(7)
+    assert packet[0] == CONTROL_PACKET_MAGIC and len(packet) == CONTROL_PACKET.size
+    data = CommData.from_datagram(packet)
+    assert {name: getattr(data, name) for name in VALUES} == VALUES
+    assert data.Seq == 7
+    assert data.to_uart_data() == CommData(**VALUES).to_uart_data()
+
+
+@pytest.mark.parametrize('datagram', [b'[]', b'1', b'"Pitch"', b'null', b'[{}]', b'',
+                                      b'{"Pitch": 1', b'\xff\xfe'])
+def test_not_a_json_object(datagram):
+    with pytest.raises(INVALID):
+        CommData.from_datagram(datagram)
+
+
+@pytest.mark.parametrize('datagram', [
+    b'{"Pitch": 1024}',                                     # missing keys
+    bytes([CONTROL_PACKET_MAGIC]) + bytes(5),               # short packet
+    bytes([CONTROL_PACKET_MAGIC, 99]) + bytes(CONTROL_PACKET.size - 2),  # version
+])
+def test_incomplete(datagram):
+    with pytest.raises(INVALID):
+        CommData.from_datagram(datagram)
+
+
+@pytest.mark.parametrize('name, value', [('Pitch', None), ('Roll', 'x'),
+                                         ('Yaw', float('inf')), ('Power', -1),
+                                         ('PitchG', 1024), ('YawG', 1e30)])
+def test_invalid_values(name, value):
+    values = dict(VALUES)
+    values[name] = value
+    with pytest.raises(INVALID):
+        CommData(**values).to_uart_data()
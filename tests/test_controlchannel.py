@@ -0,0 +1,270 @@
+"""
+Tests of the control path (controlchannel) without network and UART: the mailbox
+keeps only the newest value of every client, process_udp_data writes on arrival
+or once per CONTROL_RATE tick, the UartWriter keeps only the newest frame while
+the UART is stalled, the ControlWatchdog writes the failsafe frame after the
+timeout.
+"""
+import asyncio
+import time
+
+import pytest
+
+import config
+import server
+from communicationdata import CommData
+from controlchannel import ControlMailbox, ControlWatchdog, UartWriter
+
+PHONE = ('192.168.4.2', 5000)
+LAPTOP = ('192.168.4.3', 6000)
+VALUES = {'Pitch': 1024, 'Roll': 1000, 'Yaw': 1024, 'Power': 0, 'PitchG': 512,
+          'RollG': 0, 'YawG': 512}
+
+
+def control_packet(power, seq=0):
+    return CommData(**dict(VALUES, Power=power)).to_packet(seq)
+
+
+def icu_frame(power):
+    return CommData(**dict(VALUES, Power=power)).to_uart_data()
+
+
+class FakeWriter(object):
+    """
+    UartWriter and UART transport replacement, which keeps the written frames.
+    """
+    def __init__(self):
+        self.frames = []
+
+    def write(self, frame):
+        self.frames.append(bytes(frame))
+        return True
+
+
+def test_mailbox_keeps_the_newest_value_per_client():
+    mailbox = ControlMailbox(max_clients=2)
+    mailbox.put_nowait('a', 1)
+    mailbox.put_nowait('b', 2)
+    mailbox.put_nowait('a', 3)
+    mailbox.put_nowait('c', 4)          # too many clients
+    assert mailbox.qsize() == 2
+    assert mailbox.get_nowait() == ('a', 3)
+    assert mailbox.get_nowait() == ('b', 2)
+    assert mailbox.empty()
+    with pytest.raises(asyncio.QueueEmpty):
+        mailbox.get_nowait()
+    assert mailbox.stats() == {'received': 4, 'coalesced': 1, 'dropped': 1,
+                               'pending': 0}
+
+
+def test_mailbox_clear_and_get():
+    async def run():
+        mailbox = ControlMailbox()
+        mailbox.put_nowait('a', 1)
+        mailbox.clear()
+        getter = asyncio.create_task(mailbox.get())
+        await asyncio.sleep(0)
+        assert not getter.done()
+        mailbox.put_nowait('a', 2)
+        mailbox.put_nowait('a', 3)
+        return await asyncio.wait_for(getter, 1), mailbox.stats()
+
+    value, stats = asyncio.run(run())
+    assert value == ('a', 3)
+    assert stats['dropped'] == 1 and stats['coalesced'] == 1
+
+
+async def control_loop(steps):
+    """
+    Runs process_udp_data and calls every step (coroutine function with the
+    mailbox) after the handshake. Returns the written frames.
+    """
+    mailbox = ControlMailbox()
+    handshake = asyncio.Queue()
+    writer = FakeWriter()
+    task = asyncio.create_task(server.process_udp_data(mailbox, handshake, FakeWriter(),
+                                                       writer))
+    mailbox.put_nowait('phone', (0, control_packet(1)))    # before the handshake
+    await handshake.put(True)
+    await asyncio.sleep(0.01)
+    for step in steps:
+        await step(mailbox)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    return writer.frames
+
+
+def burst(count, delay=0.0):
+    async def step(mailbox):
+        for power in range(10, 10 + count):
+            mailbox.put_nowait('phone', (time.monotonic_ns(), control_packet(power, power)))
+            await asyncio.sleep(delay)
+    return step
+
+
+def pause(delay):
+    async def step(mailbox):
+        await asyncio.sleep(delay)
+    return step
+
+
+def test_send_on_arrival(monkeypatch):
+    monkeypatch.setattr(config, 'CONTROL_RATE', 0)
+    frames = asyncio.run(control_loop([burst(5, 0.002)]))
+    # the value received before the handshake is discarded
+    assert frames == [icu_frame(power) for power in range(10, 15)]
+
+
+def test_tick_sends_only_the_newest_value(monkeypatch):
+    monkeypatch.setattr(config, 'CONTROL_RATE', 20)
+    frames = asyncio.run(control_loop([burst(5), pause(0.08)]))
+    assert frames == [icu_frame(14)]
+
+
+def test_tick_limits_the_rate(monkeypatch):
+    monkeypatch.setattr(config, 'CONTROL_RATE', 50)
+    start = time.monotonic()
+    frames = asyncio.run(control_loop([burst(100, 0.002), pause(0.05)]))
+    # packets every 2 ms --> one frame per tick (20 ms), the last is the newest
+    assert 3 <= len(frames) <= (time.monotonic() - start) * 50 + 1
+    assert frames[-1] == icu_frame(109)
+
+
+class FakeSerial(object):
+    def __init__(self):
+        self.out_waiting = 0
+
+
+class FakeUartTransport(object):
+    """
+    UART transport replacement: buffered bytes are set by the test, serial is the
+    driver queue (None: no driver queue).
+    """
+    def __init__(self, serial=None):
+        self.serial = serial
+        self.frames = []
+        self.buffered = 0
+        self.limits = None
+
+    def write(self, frame):
+        self.frames.append(bytes(frame))
+
+    def get_write_buffer_size(self):
+        return self.buffered
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        self.limits = (high, low)
+
+
+def test_writer_coalesces_while_paused():
+    transport = FakeUartTransport()
+    writer = UartWriter(transport, 64, 16)
+    assert transport.limits == (64, 16) and writer.serial is None
+    assert writer.write(b'frame 0')
+    writer.pause()                      # forwarded pause_writing of the transport
+    for i in range(1, 5):
+        assert not writer.write(b'frame %d' % i)
+    assert transport.frames == [b'frame 0']
+    writer.resume()
+    assert transport.frames == [b'frame 0', b'frame 4']
+    writer.resume()                     # not paused: nothing to write
+    stats = writer.stats()
+    assert (stats['written'], stats['coalesced'], stats['pauses'], stats['paused']) == \
+        (2, 3, 1, 0)
+
+
+def test_writer_resume_without_pending_frame():
+    transport = FakeUartTransport()
+    writer = UartWriter(transport)
+    writer.pause()
+    writer.pause()
+    writer.resume()
+    assert transport.frames == [] and writer.stats()['pauses'] == 1
+
+
+def test_writer_waits_for_the_driver_queue():
+    async def run():
+        serial = FakeSerial()
+        transport = FakeUartTransport(serial)
+        writer = UartWriter(transport, 16, 0)
+        assert writer.serial is serial
+
+        # the driver queue is only checked, if the transport buffers data
+        serial.out_waiting = 100
+        writer.write(b'frame 0')
+        assert not writer.paused
+        transport.buffered = 8
+        writer.write(b'frame 1')
+        assert writer.paused and writer.stats()['max_depth'] == 108
+        writer.write(b'frame 2')
+        writer.write(b'frame 3')
+
+        # the transport drained, the driver queue didn't: still paused
+        transport.buffered = 0
+        writer.resume()
+        await asyncio.sleep(0.01)
+        assert writer.paused and transport.frames == [b'frame 0', b'frame 1']
+
+        serial.out_waiting = 0
+        await asyncio.sleep(0.01)
+        assert not writer.paused
+        return transport.frames, writer.stats()
+
+    frames, stats = asyncio.run(run())
+    assert frames == [b'frame 0', b'frame 1', b'frame 3']
+    assert stats['coalesced'] == 1 and stats['pauses'] == 1 and stats['stalled'] > 0
+
+
+FAILSAFE = bytes(8)
+
+
+def test_watchdog_failsafe_timing():
+    async def run():
+        writer = FakeWriter()
+        watchdog = ControlWatchdog(writer, 0.05, FAILSAFE, 0.01)
+        task = asyncio.create_task(watchdog.run())
+        await asyncio.sleep(0.1)
+        assert writer.frames == []          # not armed before the handshake
+
+        watchdog.arm()
+        start = time.monotonic()
+        for _ in range(10):                 # valid packets every 10 ms
+            await asyncio.sleep(0.01)
+            watchdog.valid(time.monotonic_ns())
+        assert writer.frames == [] and not watchdog.failsafe
+
+        while not writer.frames:
+            await asyncio.sleep(0.001)
+        lost_after = time.monotonic() - start - 0.1
+        await asyncio.sleep(0.05)
+        repeated = len(writer.frames)
+        watchdog.valid(time.monotonic_ns())
+        await asyncio.sleep(0.03)
+        task.cancel()
+        return writer.frames, watchdog, lost_after, repeated
+
+    frames, watchdog, lost_after, repeated = asyncio.run(run())
+    # failsafe after the timeout (+ one check interval), repeated every check interval
+    assert 0.04 <= lost_after <= 0.2
+    assert repeated >= 3 and set(frames) == {FAILSAFE}
+    assert len(frames) == repeated          # stopped by the valid packet
+    assert not watchdog.failsafe and watchdog.stats()['failsafes'] == 1
+
+
+def test_watchdog_link_statistics():
+    watchdog = ControlWatchdog(FakeWriter(), 0.5, FAILSAFE)
+    now = 0
+    for seq in (1, 2, 3, 6, 6, 5, 7):       # 4 and 5 lost, 6 duplicated, 5 late
+        now += 10000000
+        watchdog.arrived(now, control_packet(0, seq), PHONE)
+    stats = watchdog.stats()
+    assert (stats['arrivals'], stats['lost'], stats['duplicates'],
+            stats['reordered']) == (7, 2, 1, 1)
+    assert stats['loss'] == pytest.approx(2 / 9)
+    assert stats['jitter'] == 0 and 0 < stats['interval'] <= 0.01
+
+    # a new control client starts new sequence numbers
+    watchdog.arrived(now + 10000000, control_packet(0, 40000), LAPTOP)
+    watchdog.arrived(now + 20000000, control_packet(0, 40001), LAPTOP)
+    assert watchdog.stats()['lost'] == 2
@@ -0,0 +1,97 @@
+"""
+Tests of the flight recorder (flightrecorder) in a temporary directory: records
+round-trip through the segment files, the segments rotate and the oldest are
+deleted, a full staging ring drops records, and the CSV export decodes them.
+"""
+import csv
+import os
+
+from communicationdata import CommData
+from flightrecorder import (HEADER_SIZE, RECORD_CONTROL, RECORD_SIZE, RECORD_TELEMETRY,
+                            FlightRecorder, decode_record, main, read_records,
+                            segment_indexes)
+from telemetrydata import TELEMETRY_FRAME
+
+FLOATS = (1.5, 12.0, 0.5, 40.0, 21.5, 1013.0, 8.5, 49.0)
+
+
+def icu_frame(power):
+    return CommData(Pitch=1024, Roll=1024, Yaw=1024, Power=power, PitchG=512,
+                    RollG=0, YawG=512).to_uart_data()
+
+
+def records_written(recorder, payloads):
+    """
+    Stages the payloads (kind, payload) and writes them like the thread.
+    """
+    recorder.open_segment()
+    for kind, payload in payloads:
+        recorder.record(kind, payload)
+        recorder.write_staged()
+    recorder.close_segment()
+
+
+def test_round_trip(tmp_path):
+    recorder = FlightRecorder(str(tmp_path))
+    recorder.start()
+    for i in range(100):
+        recorder.record(RECORD_TELEMETRY, TELEMETRY_FRAME.pack(float(i), *FLOATS[1:]))
+        recorder.record(RECORD_CONTROL, icu_frame(i))
+    recorder.stop_thread()
+
+    records = list(read_records(str(tmp_path)))
+    assert [record.seq for record in records] == list(range(1, 201))
+    assert all(a.monotonic_ns <= b.monotonic_ns for a, b in zip(records, records[1:]))
+    telemetry = [decode_record(record) for record in records
+                 if record.type == RECORD_TELEMETRY]
+    assert telemetry == [(float(i),) + FLOATS[1:] for i in range(100)]
+    control = list(read_records(str(tmp_path), kind=RECORD_CONTROL))
+    assert [record.payload for record in control] == [icu_frame(i) for i in range(100)]
+    assert decode_record(control[7])[3] == 7
+    # the unused part of the segment is cut off
+    (name,) = os.listdir(tmp_path)
+    assert os.path.getsize(tmp_path / name) == HEADER_SIZE + 200 * RECORD_SIZE
+
+
+def test_segments_rotate(tmp_path):
+    recorder = FlightRecorder(str(tmp_path), segment_size=HEADER_SIZE + 10 * RECORD_SIZE,
+                              max_segments=3, staging_size=16)
+    records_written(recorder, [(RECORD_CONTROL, icu_frame(i)) for i in range(45)])
+    assert recorder.stats()['segments'] == 5
+    assert segment_indexes(str(tmp_path)) == [3, 4, 5]
+    assert [record.seq for record in read_records(str(tmp_path))] == list(range(21, 46))
+
+    # a new recorder continues after the last segment
+    recorder = FlightRecorder(str(tmp_path), segment_size=HEADER_SIZE + 10 * RECORD_SIZE,
+                              max_segments=3)
+    records_written(recorder, [(RECORD_CONTROL, icu_frame(0))])
+    assert segment_indexes(str(tmp_path)) == [4, 5, 6]
+
+
+def test_full_staging_ring_drops(tmp_path):
+    recorder = FlightRecorder(str(tmp_path), staging_size=4)
+    recorder.open_segment()
+    for i in range(6):
+        recorder.record(RECORD_CONTROL, icu_frame(i))
+    assert recorder.stats() == {'seq': 6, 'staged': 4, 'dropped': 2, 'segments': 1}
+    recorder.write_staged()
+    recorder.record(RECORD_CONTROL, icu_frame(6))
+    recorder.write_staged()
+    recorder.close_segment()
+    # the sequence numbers show the gap
+    assert [record.seq for record in read_records(str(tmp_path))] == [1, 2, 3, 4, 7]
+
+
+def test_csv_export(tmp_path):
+    directory = tmp_path / 'recorder'
+    recorder = FlightRecorder(str(directory))
+    records_written(recorder, [(RECORD_TELEMETRY, TELEMETRY_FRAME.pack(*FLOATS)),
+                               (RECORD_CONTROL, icu_frame(3))])
+    output = tmp_path / 'control.csv'
+    main(['export', str(directory), '--type', 'control', '-o', str(output)])
+    with open(output, newline='') as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == ['time', 'monotonic_ns', 'seq', 'Pitch', 'Roll', 'Yaw', 'Power',
+                       'PitchG', 'RollG', 'YawG']
+    assert len(rows) == 2 and rows[1][2:] == ['2', '1024', '1024', '1024', '3', '512',
+                                              '0', '512']
@@ -0,0 +1,183 @@
+"""
+Tests of the send queues of the websocket clients (framequeue) with fake slow
+sockets: the broadcast never waits for a client, a slow client drops frames but
+always restarts at a keyframe, and clients can come and go during the broadcast.
+"""
+import asyncio
+import random
+import sys
+import time
+from threading import Thread
+
+from conftest import nal_units
+from framequeue import AsyncClientFrameQueue, ClientFrameQueue, FrameSender, KEYFRAME_TYPES
+from output import StreamingOutput, nal_type, NAL_SLICE
+
+QUEUE_SIZE = 10
+
+
+class SlowSocket(object):
+    """
+    A websocket replacement, which needs delay seconds to send a frame.
+    """
+    def __init__(self, delay):
+        self.delay = delay
+        self.sent = []
+
+    def send(self, data, binary=False):
+        time.sleep(self.delay)
+        self.sent.append(data)
+
+
+def assert_decodable(sent, units):
+    """
+    Every sent P-frame must follow the frame before it in the stream (a gap is
+    only allowed before a keyframe).
+    """
+    index = {unit: i for i, unit in enumerate(units)}
+    previous = None
+    for frame in sent:
+        i = index[frame]
+        if nal_type(frame) == NAL_SLICE:
+            assert previous == i - 1, f'P-frame {i} after {previous}'
+        else:
+            assert nal_type(frame) in KEYFRAME_TYPES
+        previous = i
+
+
+def test_slow_client_does_not_stall_the_others():
+    units = nal_units()
+    fast, slow = SlowSocket(0), SlowSocket(0.05)
+    queues = []
+    for websocket in (fast, slow):
+        queue = ClientFrameQueue(QUEUE_SIZE)
+        FrameSender(websocket, queue).start()
+        queues.append(queue)
+
+    start = time.perf_counter()
+    for unit in units:
+        for queue in queues:
+            queue.put(unit)
+        time.sleep(0.001)
+    broadcast_time = time.perf_counter() - start
+    deadline = time.monotonic() + 5
+    while len(fast.sent) < len(units) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    for queue in queues:
+        queue.close()
+
+    # the broadcast only waited for itself, not for the slow socket
+    assert broadcast_time < len(units) * slow.delay / 4
+    assert fast.sent == units
+    assert queues[0].dropped == 0
+    assert queues[1].dropped > 0
+    assert 0 < len(slow.sent) < len(units)
+    assert_decodable(slow.sent, units)
+
+
+def test_new_client_starts_at_a_keyframe():
+    units = nal_units()
+    queue = ClientFrameQueue(len(units))
+    for unit in units[3:]:
+        queue.put(unit)
+    frames = []
+    while True:
+        frame = queue.get(timeout=0)
+        if frame is None:
+            break
+        frames.append(frame)
+    assert nal_type(frames[0]) in KEYFRAME_TYPES
+    assert_decodable(frames, units)
+
+
+def test_closed_queue_wakes_the_sender():
+    queue = ClientFrameQueue(QUEUE_SIZE)
+    sender = FrameSender(SlowSocket(0), queue)
+    sender.start()
+    queue.close()
+    sender.join(1)
+    assert not sender.is_alive()
+    assert not queue.put(nal_units(1)[0])
+
+
+def test_async_queue_with_slow_client():
+    units = nal_units()
+
+    async def run():
+        queue = AsyncClientFrameQueue(QUEUE_SIZE)
+        sent = []
+
+        async def sender():
+            while True:
+                frame = await queue.get()
+                if frame is None:
+                    break
+                sent.append(frame)
+                await asyncio.sleep(0.01)
+
+        task = asyncio.create_task(sender())
+        for unit in units:
+            queue.put(unit)
+            await asyncio.sleep(0.001)
+        queue.close()
+        await asyncio.wait_for(task, 1)
+        return queue, sent
+
+    queue, sent = asyncio.run(run())
+    assert queue.dropped > 0
+    assert sent
+    assert_decodable(sent, units)
+
+
+def test_subscribe_while_publishing():
+    """
+    Regression test: clients subscribe and unsubscribe, while the broadcast thread
+    publishes (the subscriber list must not change during the iteration).
+    """
+    units = nal_units(200, 200)
+    output = StreamingOutput(keyframe_cache_size=1024 * 1024)
+    errors = []
+    stop = False
+
+    def broadcast():
+        try:
+            while not stop:
+                for unit in units:
+                    with output.condition:
+                        output.publish(unit)
+        except Exception as e:
+            errors.append(e)
+
+    def client(seed):
+        rng = random.Random(seed)
+        try:
+            for _ in range(200):
+                queue = ClientFrameQueue(len(units))
+                output.subscribe(queue)
+                time.sleep(rng.random() * 0.001)
+                output.unsubscribe(queue)
+                # no frame was skipped, while the client was subscribed
+                frames = list(queue.frames)
+                queue.close()
+                assert_decodable(frames, units)
+        except Exception as e:
+            errors.append(e)
+
+    # switch threads often (the default interval of 5 ms hides most races)
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        broadcaster = Thread(target=broadcast)
+        broadcaster.start()
+        clients = [Thread(target=client, args=(seed,)) for seed in range(8)]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        stop = True
+        broadcaster.join()
+    finally:
+        sys.setswitchinterval(interval)
+
+    assert not errors
+    assert output.subscribers == []
@@ -0,0 +1,89 @@
+"""
+Property tests of the ICU encoder (icuprotocol): random control values of the
+field ranges (seeded, reproducible) against the original byte-by-byte encoder.
+"""
+import random
+
+import pytest
+
+import icuprotocol
+from communicationdata import CommData
+
+LIMITS = (0x7FF, 0x7FF, 0x7FF, 0x7FF, 0x3FF, 0x3FF)   # Pitch, Roll, Yaw, Power, PitchG, YawG
+FIELDS = ('Pitch', 'Roll', 'Yaw', 'Power', 'PitchG', 'YawG')
+
+
+def encode_reference(pitch, roll, yaw, power, pitchg, yawg):
+    """
+    The original byte-by-byte implementation of CommData.to_uart_data (reference
+    for the encoder).
+    """
+    pitch_arr = pitch.to_bytes(2, 'little')
+    roll_arr = roll.to_bytes(2, 'little')
+    yaw_arr = yaw.to_bytes(2, 'little')
+    power_arr = power.to_bytes(2, 'little')
+    pitchg_arr = pitchg.to_bytes(2, 'little')
+    yawg_arr = yawg.to_bytes(2, 'little')
+
+    byte0 = power_arr[0]
+    byte1 = ((yaw_arr[0]<<3) & 0b11111000) | (power_arr[1] & 0b00000111)
+    byte2 = ((pitch_arr[0]<<6) & 0b11000000) | ((yaw_arr[1]<<3) & 0b00111000) | ((yaw_arr[0]>>5) & 0b00000111)
+    byte3 = ((pitch_arr[1]<<6) & 0b11000000) | ((pitch_arr[0]>>2) & 0b00111111)
+    byte4 = ((roll_arr[0]<<1) & 0b11111110) | ((pitch_arr[1]>>2) & 0b00000001)
+    byte5 = ((yawg_arr[0]<<4) & 0b11110000) | ((roll_arr[1]<<1) & 0b00001110) | ((roll_arr[0]>>7) & 0b00000001)
+    byte6 = ((pitchg_arr[0]<<6) & 0b11000000) | ((yawg_arr[1]<<4) & 0b00110000) | ((yawg_arr[0]>>4) & 0b00001111)
+    byte7 = ((pitchg_arr[1]<<6) & 0b11000000) | ((pitchg_arr[0]>>2) & 0b00111111)
+    return bytearray([byte0, byte1, byte2, byte3, byte4, byte5, byte6, byte7])
+
+
+def random_values(rng, count):
+    """
+    Returns count tuples of control values: the field limits first, then random
+    values in the field ranges.
+    """
+    edges = [0, 1, 0x3FF, 0x400, 0x7FF]
+    for a in edges:
+        for b in edges:
+            yield tuple(min(value, limit) for value, limit in zip((a, b, a, b, a, b), LIMITS))
+    for _ in range(count):
+        yield tuple(rng.randrange(limit + 1) for limit in LIMITS)
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_encode_matches_reference(seed):
+    for values in random_values(random.Random(seed), 20000):
+        assert icuprotocol.encode(*values) == encode_reference(*values), values
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_round_trip(seed):
+    buffer = bytearray(3 * icuprotocol.FRAME_SIZE)
+    for values in random_values(random.Random(seed), 20000):
+        pitch, roll, yaw, power, pitchg, yawg = values
+        icuprotocol.encode_into(buffer, icuprotocol.FRAME_SIZE, *values)
+        assert buffer[:icuprotocol.FRAME_SIZE] == bytes(icuprotocol.FRAME_SIZE)
+        assert buffer[2 * icuprotocol.FRAME_SIZE:] == bytes(icuprotocol.FRAME_SIZE)
+        assert (icuprotocol.decode(buffer, icuprotocol.FRAME_SIZE)
+                == (pitch, roll, yaw, power, pitchg, 0, yawg))
+
+
+@pytest.mark.parametrize('field', range(len(LIMITS)))
+def test_out_of_range_is_rejected(field):
+    rng = random.Random(field)
+    limit = LIMITS[field]
+    invalid = [-1, limit + 1, -32768, 32767] + [rng.randint(limit + 1, 1 << 20)
+                                               for _ in range(100)]
+    for value in invalid:
+        values = [0] * len(LIMITS)
+        values[field] = value
+        with pytest.raises(ValueError):
+            icuprotocol.encode(*values)
+
+
+def test_commdata_out_of_range_is_rejected():
+    values = {name: 0 for name in FIELDS}
+    values['RollG'] = 0
+    assert CommData(**values).to_uart_data() == bytes(icuprotocol.FRAME_SIZE)
+    values['Power'] = -1
+    with pytest.raises(ValueError):
+        CommData(**values).to_uart_data()
@@ -0,0 +1,109 @@
+"""
+Tests of the keyframe cache (output.KeyframeCache): a client, which joins at any
+point of the stream, gets a decodable stream at once (SPS, PPS, IDR, the P-frames
+since the IDR, then the live frames without a gap).
+"""
+import pytest
+
+from conftest import nal_units
+from framequeue import ClientFrameQueue
+from output import KeyframeCache, StreamingOutput, nal_type
+from output import NAL_IDR, NAL_PPS, NAL_SLICE, NAL_SPS
+
+GOP = 10
+
+
+def broadcast(output, units):
+    """
+    Writes the NAL units into the output and publishes them like the broadcast
+    thread.
+    """
+    for unit in units:
+        output.write(unit)
+        with output.condition:
+            for frame, captured in output.take_frames():
+                output.publish(frame, captured)
+
+
+def drain(queue):
+    frames = []
+    while True:
+        frame = queue.get(timeout=0)
+        if frame is None:
+            return frames
+        frames.append(frame)
+
+
+@pytest.mark.parametrize('join', range(0, 60, 7))
+def test_late_client_gets_a_decodable_stream(join):
+    units = nal_units(60, 1000, GOP)
+    output = StreamingOutput(keyframe_cache_size=1024 * 1024)
+    broadcast(output, units[:join])
+    queue = ClientFrameQueue(len(units))
+    output.subscribe(queue)
+    broadcast(output, units[join:])
+    output.flush()
+    with output.condition:
+        for frame, captured in output.take_frames():
+            output.publish(frame, captured)
+    frames = drain(queue)
+
+    assert [nal_type(frame) for frame in frames[:3]] == [NAL_SPS, NAL_PPS, NAL_IDR]
+    # from the cached IDR on, the stream is complete (no gap to the live frames),
+    # the parameter sets of the cache aren't sent twice
+    start = units.index(frames[2])
+    assert start <= max(join, 2)
+    assert frames[2:] == [unit for unit in units[start:] if unit not in frames[:2]]
+
+
+def test_no_cache_before_the_first_idr():
+    cache = KeyframeCache(1024 * 1024)
+    units = nal_units(60, 1000, GOP)
+    for unit in units[:2]:          # SPS and PPS only
+        cache.add(unit)
+    assert cache.frames() == []
+    cache.add(units[2])
+    assert cache.frames() == units[:3]
+
+
+def test_p_frames_are_cached_until_the_next_idr():
+    cache = KeyframeCache(1024 * 1024)
+    units = nal_units(60, 1000, GOP)
+    first_gop = 3 + GOP - 1         # SPS, PPS, IDR and the P-frames
+    for unit in units[:first_gop]:
+        cache.add(unit)
+    assert cache.frames() == units[:first_gop]
+    for unit in units[first_gop:first_gop + 3]:
+        cache.add(unit)
+    assert cache.frames() == units[first_gop:first_gop + 3]
+
+
+def test_oversized_gop_is_not_cached():
+    units = nal_units(60, 1000, GOP)
+    idr = units[2]
+    p_frames = units[3:3 + GOP - 1]
+    assert all(nal_type(unit) == NAL_SLICE for unit in p_frames)
+    cache = KeyframeCache(len(idr) + len(p_frames[0]))
+    for unit in units[:4]:
+        cache.add(unit)
+    assert cache.frames() == units[:4]
+    cache.add(p_frames[1])
+    assert cache.frames() == []
+    # the next P-frames don't restart the cache, only the next IDR
+    cache.add(p_frames[2])
+    assert cache.frames() == []
+    for unit in units[3 + GOP - 1:3 + GOP - 1 + 3]:
+        cache.add(unit)
+    assert [nal_type(frame) for frame in cache.frames()] == [NAL_SPS, NAL_PPS, NAL_IDR]
+
+
+def test_without_cache_the_client_waits_for_the_next_idr():
+    units = nal_units(60, 1000, GOP)
+    output = StreamingOutput()
+    broadcast(output, units[:5])
+    queue = ClientFrameQueue(len(units))
+    output.subscribe(queue)
+    broadcast(output, units[5:])
+    frames = drain(queue)
+    assert nal_type(frames[0]) == NAL_SPS
+    assert frames == units[units.index(frames[0]):len(frames) + units.index(frames[0])]
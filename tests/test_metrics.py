@@ -0,0 +1,28 @@
+"""
+Tests of the latency histograms (metrics.Histogram): relative error of the
+quantiles and the range of the buckets.
+"""
+import random
+
+from metrics import BUCKETS, Histogram
+
+
+def test_quantile_relative_error():
+    rng = random.Random(0)
+    values = sorted(int(10 ** rng.uniform(0, 12)) for _ in range(10000))
+    histogram = Histogram('test', 'test')
+    for value in values:
+        histogram.record(value)
+    for q in (0.1, 0.5, 0.9, 0.99):
+        exact = values[int(q * len(values)) - 1]
+        assert exact <= histogram.quantile(q) <= exact * 1.0625 + 1
+
+
+def test_range_up_to_2_40_ns():
+    histogram = Histogram('test', 'test')
+    histogram.record(2 ** 40 - 2 ** 35)     # first value of the last bucket
+    assert histogram.counts[BUCKETS - 1] == 1
+    histogram.record(2 ** 40 - 2 ** 35 - 1)
+    assert histogram.counts[BUCKETS - 2] == 1
+    histogram.record(2 ** 45)               # beyond the range: last bucket
+    assert histogram.counts[BUCKETS - 1] == 2 and histogram.max == 2 ** 45
@@ -0,0 +1,75 @@
+"""
+Tests of the NAL splitter (output.NalSplitter): a synthetic H.264 stream written
+in random chunks (start codes split across writes, small ring buffers, which wrap
+and grow) or one buffer per NAL unit like picamera gives the same NAL units as
+splitting the whole stream at the start codes.
+"""
+import random
+
+import pytest
+
+from camerasource import synthetic_h264
+from output import NalSplitter
+
+SEPARATOR = NalSplitter.SEPARATOR
+
+
+def reference_units(stream):
+    return [SEPARATOR + part for part in stream.split(SEPARATOR)[1:]]
+
+
+def split(writes, **options):
+    units = []
+    splitter = NalSplitter(lambda unit: units.append(bytes(unit)), **options)
+    for buf in writes:
+        assert splitter.write(buf) == len(buf)
+    splitter.flush()
+    return units
+
+
+@pytest.mark.parametrize('seed', range(4))
+@pytest.mark.parametrize('capacity', [4096, 65536, 4 * 1024 * 1024])
+def test_random_chunks(seed, capacity):
+    rng = random.Random(seed)
+    stream = synthetic_h264(40, 3000, gop=10, seed=seed)
+    writes = []
+    pos = 0
+    while pos < len(stream):
+        size = rng.choice((1, 2, 3, 4, 5, 100, 1000, 5000, 20000))
+        writes.append(stream[pos:pos + size])
+        pos += size
+    assert split(writes, capacity=capacity, slice_per_write=False) == \
+        reference_units(stream)
+
+
+def test_slice_per_write_is_passed_without_copy():
+    stream = synthetic_h264(30, 2000, gop=10)
+    writes = reference_units(stream)
+    units = []
+    splitter = NalSplitter(units.append, capacity=4096)
+    for buf in writes:
+        splitter.write(buf)
+    splitter.flush()
+    assert [bytes(unit) for unit in units] == writes
+    slices = [unit for unit in units if 1 <= unit[4] & 0x1F <= 5]
+    assert len(slices) == 30
+    assert all(any(unit is buf for buf in writes) for unit in slices)
+
+
+def test_continued_slice_and_parameter_sets_in_one_buffer():
+    units = reference_units(synthetic_h264(12, 2000, gop=10))
+    writes = []
+    for unit in units:
+        if unit[4] & 0x1F == 5:
+            # a big slice in three buffers
+            writes.extend((unit[:100], unit[100:1000], unit[1000:]))
+        else:
+            writes.append(unit)
+    # SPS and PPS in one buffer
+    writes[0:2] = [writes[0] + writes[1]]
+    assert split(writes, capacity=8192) == units
+
+
+def test_single_unit_and_empty_flush():
+    assert split([]) == []
+    assert split([SEPARATOR + b'\x27abc']) == [SEPARATOR + b'\x27abc']
@@ -0,0 +1,126 @@
+"""
+Tests of the supervisor (server_starter) with the MockGpio and small stand-in
+servers (python -c): restart backoff, a falling edge during the backoff, the
+ready timeout and the health check through the control UDP endpoint.
+"""
+import asyncio
+import re
+import sys
+
+import pytest
+
+import server_starter
+from communicationtransports import UDP_ServerProtocol
+from controlchannel import ControlMailbox
+from server import READY_MESSAGE
+from server_starter import MockGpio, Supervisor, check_health
+from subscribers import SubscriberRegistry
+
+
+def stand_in(code):
+    """
+    Returns the command line of a stand-in server, which prints READY_MESSAGE
+    and then runs code.
+    """
+    return [sys.executable, '-c', f'print({READY_MESSAGE!r}, flush=True)\n{code}']
+
+
+class ListRelay(object):
+    """
+    LogRelay replacement, which keeps the lines.
+    """
+    def __init__(self):
+        self.lines = []
+        self.dropped = 0
+
+    def put(self, line):
+        self.lines.append(line)
+
+    def stats(self):
+        return {}
+
+
+async def supervise(command, steps, **options):
+    """
+    Runs the supervisor with a MockGpio and calls every step (coroutine function
+    with the gpio). Returns the supervisor and the relayed lines.
+    """
+    gpio = MockGpio(stdin=False)
+    relay = ListRelay()
+    supervisor = Supervisor(gpio, relay, command, health_interval=0, **options)
+    task = asyncio.create_task(supervisor.run())
+    await asyncio.sleep(0)
+    for step in steps:
+        await step(gpio)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    return supervisor, relay.lines
+
+
+def switch(level, wait):
+    async def step(gpio):
+        gpio.set(level)
+        await asyncio.sleep(wait)
+    return step
+
+
+def restart_delays(lines):
+    return [float(delay) for delay in re.findall(r'restart in ([0-9.]+) s', '\n'.join(lines))]
+
+
+def test_crash_restarts_with_backoff():
+    supervisor, lines = asyncio.run(supervise(
+        stand_in('raise SystemExit(3)'), [switch(True, 1.5), switch(False, 0.3)],
+        restart_delay=0.1, restart_delay_max=0.4))
+    delays = restart_delays(lines)
+    assert delays[:4] == [0.1, 0.2, 0.4, 0.4]
+    assert 'server exited with 3: restart in 0.1 s' in lines
+    assert supervisor.restarts == len(delays) and supervisor.starts >= len(delays)
+    # no restart after the falling edge
+    assert supervisor.starts <= supervisor.restarts + 1
+
+
+def test_falling_edge_cancels_the_restart():
+    supervisor, lines = asyncio.run(supervise(
+        stand_in('raise SystemExit(1)'), [switch(True, 0.5), switch(False, 0.3)],
+        restart_delay=5.0))
+    assert restart_delays(lines) == [5.0]
+    assert supervisor.starts == 1 and supervisor.edges == 2
+
+
+def test_stopped_by_the_switch():
+    supervisor, lines = asyncio.run(supervise(
+        stand_in('import time\ntime.sleep(30)'), [switch(True, 0.5), switch(False, 0.5)]))
+    assert READY_MESSAGE in lines
+    assert lines[-1] == '----------ending process--------------------'
+    assert supervisor.starts == 1 and supervisor.restarts == 0
+    assert supervisor.process is None
+
+
+def test_not_ready(monkeypatch):
+    monkeypatch.setattr(server_starter, 'READY_TIMEOUT', 0.3)
+    command = [sys.executable, '-c', 'import time\ntime.sleep(30)']
+    supervisor, lines = asyncio.run(supervise(
+        command, [switch(True, 0.6), switch(False, 0.1)], restart_delay=5.0))
+    assert 'server not ready: restart in 5.0 s' in lines
+
+
+def test_health_check_pings_the_control_endpoint():
+    async def run():
+        loop = asyncio.get_running_loop()
+        registry = SubscriberRegistry()
+        transport, protocol = await loop.create_datagram_endpoint(
+            lambda: UDP_ServerProtocol(ControlMailbox(), registry),
+            local_addr=('127.0.0.1', 0))
+        registry.transport = transport
+        port = transport.get_extra_info('sockname')[1]
+        try:
+            alive = await check_health(port, 1.0)
+        finally:
+            transport.close()
+        # nobody answers on the closed port
+        return alive, await check_health(port, 0.2), registry
+    alive, closed, registry = asyncio.run(run())
+    assert alive and not closed
+    assert not registry.subscribers and registry.controller is None
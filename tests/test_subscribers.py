@@ -0,0 +1,138 @@
+"""
+Tests of the telemetry subscribers (subscribers.SubscriberRegistry) with a fake
+clock and a fake UDP transport: control authority, rate limit per subscriber,
+expiry (also without telemetry) and the PING of the health check.
+"""
+import pytest
+
+import subscribers
+from subscribers import (PING, SUBSCRIBE, SUBSCRIPTION_MAGIC, UNSUBSCRIBE,
+                         SubscriberRegistry, encode_subscription)
+
+PHONE = ('192.168.4.2', 5000)
+LAPTOP = ('192.168.4.3', 6000)
+LOGGER = ('192.168.4.4', 7000)
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def monotonic(self):
+        return self.now
+
+
+class FakeTransport(object):
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, addr):
+        self.sent.append((data, addr))
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(subscribers, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def registry(clock):
+    registry = SubscriberRegistry(timeout=5.0, control_timeout=1.0, max_subscribers=3)
+    registry.transport = FakeTransport()
+    return registry
+
+
+def receivers(registry, datagram=b'x'):
+    registry.transport.sent.clear()
+    registry.send(datagram)
+    return [addr for data, addr in registry.transport.sent]
+
+
+def test_control_authority(registry, clock):
+    assert registry.control_received(PHONE)
+    assert not registry.control_received(LAPTOP)
+    clock.now += 0.5
+    assert registry.control_received(PHONE)
+    clock.now += 0.9
+    assert not registry.control_received(LAPTOP)
+    clock.now += 0.2                    # the phone was silent for 1.1 s
+    assert registry.control_received(LAPTOP)
+    assert not registry.control_received(PHONE)
+    assert registry.stats()['rejected'] == 3
+    assert registry.controller == LAPTOP
+
+
+def test_subscribe_rate_limit_and_unsubscribe(registry, clock):
+    registry.control_received(PHONE)
+    registry.subscription_received(encode_subscription(SUBSCRIBE, 2), LAPTOP)
+    assert receivers(registry) == [PHONE, LAPTOP]
+    clock.now += 0.1
+    assert receivers(registry) == [PHONE]
+    clock.now += 0.45
+    assert receivers(registry) == [PHONE, LAPTOP]
+    assert registry.subscribers[LAPTOP].skipped == 1
+
+    # resubscribe without limit
+    registry.subscription_received(encode_subscription(SUBSCRIBE), LAPTOP)
+    assert receivers(registry) == [PHONE, LAPTOP]
+    registry.subscription_received(encode_subscription(UNSUBSCRIBE), PHONE)
+    assert receivers(registry) == [LAPTOP]
+    assert registry.controller is None
+
+
+def test_max_subscribers(registry):
+    for port in range(5):
+        registry.subscription_received(encode_subscription(SUBSCRIBE), ('10.0.0.1', port))
+    assert registry.stats()['subscribers'] == 3
+
+
+@pytest.mark.parametrize('data', [
+    bytes((SUBSCRIPTION_MAGIC,)),
+    encode_subscription(SUBSCRIBE) + b'x',
+    bytes((SUBSCRIPTION_MAGIC, 99, SUBSCRIBE, 0, 0)),
+])
+def test_invalid_subscription_is_ignored(registry, data):
+    registry.subscription_received(data, LAPTOP)
+    assert not registry.subscribers and not registry.transport.sent
+
+
+def test_expired_when_sending(registry, clock):
+    registry.subscription_received(encode_subscription(SUBSCRIBE), LAPTOP)
+    registry.subscription_received(encode_subscription(SUBSCRIBE), LOGGER)
+    clock.now += 4
+    registry.subscription_received(encode_subscription(SUBSCRIBE), LOGGER)   # keepalive
+    clock.now += 1.5
+    assert receivers(registry) == [LOGGER]
+    assert registry.stats()['expired'] == 1
+
+
+def test_expired_without_telemetry(registry, clock):
+    """
+    Without telemetry (no send), the stale subscribers and the control authority
+    are removed, when packets arrive.
+    """
+    registry.control_received(PHONE)
+    registry.subscription_received(encode_subscription(SUBSCRIBE), LAPTOP)
+    for _ in range(60):
+        clock.now += 0.1
+        registry.subscription_received(encode_subscription(SUBSCRIBE), LOGGER)
+    assert set(registry.subscribers) == {LOGGER}
+    assert registry.controller is None
+    assert registry.stats() == {'subscribers': 1, 'controller': None, 'rejected': 0,
+                                'expired': 2}
+
+
+def test_stats_is_read_only(registry, clock):
+    registry.control_received(PHONE)
+    clock.now += 60
+    assert registry.stats()['subscribers'] == 1
+    assert registry.stats()['controller'] == PHONE
+
+
+def test_ping_is_answered(registry):
+    ping = encode_subscription(PING)
+    registry.subscription_received(ping, LAPTOP)
+    assert registry.transport.sent == [(ping, LAPTOP)]
+    assert not registry.subscribers
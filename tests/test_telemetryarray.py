@@ -0,0 +1,31 @@
+"""
+Tests of the rolling telemetry statistics (telemetryarray.TelemetryWindow).
+"""
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from telemetryarray import TelemetryWindow
+
+
+def test_stats_is_read_only():
+    """
+    stats is called by the metrics (possibly another thread): it only returns the
+    published snapshot and doesn't change the window.
+    """
+    window = TelemetryWindow(window=1.0, capacity=256)
+    assert window.stats() == {'samples': 0}
+    for i in range(10):
+        window.append(i * 0.01, (float(i),) * 8)
+    done, ema = window.done, window.ema.copy()
+    assert window.stats() == {'samples': 0}
+    assert window.done == done
+    assert np.array_equal(window.ema, ema, equal_nan=True)
+
+    window.publish()
+    stats = window.stats()
+    assert stats['samples'] == 10
+    assert stats['batt_amp_mean'] == pytest.approx(4.5)
+    assert stats['latitude_max'] == 9.0
+    window.append(0.1, (100.0,) * 8)
+    assert window.stats() is stats
@@ -0,0 +1,95 @@
+"""
+Round-trip tests of the compiled telemetry serializer (TelemetrySerializer): the
+bytes must be the same as json.dumps with TelemetryDataEncoder (the format, which
+the smartphone app parses) and parse to the same values.
+"""
+import json
+import math
+import random
+
+import pytest
+
+from telemetrybatch import TelemetryBatcher
+from telemetrydata import (TelemetryData, TelemetryDataEncoder, TelemetrySerializer,
+                           TELEMETRY_FRAME, value_text)
+
+EDGE_CASES = [0.0, -0.0, 1e-4, -1e-4, 9.99995e-5, 5e-5, 4.9e-7, -4.9e-7, 1e-7, 0.1,
+              0.5, 1.0, 12.5, 47.580002, 180.0, -180.0, 999999999.9999996, 1e9, -1e9,
+              3.4e38, 1e16, 123456.1234565, math.nan, math.inf, -math.inf]
+
+
+def reference(timestamp, floats):
+    return json.dumps(TelemetryData(timestamp, floats),
+                      cls=TelemetryDataEncoder).encode('utf-8')
+
+
+def same_values(a, b):
+    return all(a[key] == b[key] or (a[key] != a[key] and b[key] != b[key])
+               for key in TelemetryData.__slots__)
+
+
+def random_samples(rng, count):
+    """
+    Returns count float32 samples (as received from the Teensy) with random
+    magnitudes between 1e-8 and 1e12.
+    """
+    samples = []
+    for _ in range(count):
+        exponent = rng.randint(-8, 12)
+        samples.append(TELEMETRY_FRAME.unpack(TELEMETRY_FRAME.pack(
+            *(rng.uniform(-1, 1) * 10 ** exponent for _ in range(8)))))
+    return samples
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_same_bytes_as_json_dumps(seed):
+    rng = random.Random(seed)
+    serializer = TelemetrySerializer()
+    for i, floats in enumerate(random_samples(rng, 5000)):
+        timestamp = 1697000000 + i * 0.001234567
+        expected = reference(timestamp, floats)
+        result = serializer.serialize(timestamp, floats)
+        assert result == expected
+        assert same_values(json.loads(result), json.loads(expected))
+
+
+def test_edge_cases():
+    rng = random.Random(0)
+    serializer = TelemetrySerializer()
+    samples = [(value,) * 8 for value in EDGE_CASES]
+    samples += [tuple(rng.choice(EDGE_CASES) for _ in range(8)) for _ in range(2000)]
+    for floats in samples:
+        expected = reference(1697000000.5, floats)
+        assert serializer.serialize(1697000000.5, floats) == expected
+
+
+@pytest.mark.parametrize('value', EDGE_CASES)
+def test_value_text(value):
+    assert value_text(value) == json.dumps(round(value, 6)).encode('ascii')
+
+
+def test_buffer_is_reused():
+    """
+    The returned message is a copy, a later sample doesn't change it.
+    """
+    serializer = TelemetrySerializer()
+    first = serializer.serialize(1.0, (1.5,) * 8)
+    second = serializer.serialize(2.0, (123456.25,) * 8)
+    assert json.loads(first)['BATT_AMP'] == 1.5
+    assert json.loads(second)['BATT_AMP'] == 123456.25
+    assert first == reference(1.0, (1.5,) * 8)
+
+
+def test_batch_is_a_json_array():
+    rng = random.Random(0)
+    datagrams = []
+    batcher = TelemetryBatcher(datagrams.append, batch_size=5)
+    samples = random_samples(rng, 20)
+    for i, floats in enumerate(samples):
+        batcher.add(1697000000 + i / 100, floats)
+    assert len(datagrams) == 4
+    parsed = [sample for datagram in datagrams for sample in json.loads(datagram)]
+    expected = [json.loads(reference(1697000000 + i / 100, floats))
+                for i, floats in enumerate(samples)]
+    assert all(same_values(a, b) for a, b in zip(parsed, expected))
+    assert len(parsed) == len(expected)
@@ -0,0 +1,108 @@
+"""
+Tests of the telemetry updates for the browser clients (telemetrystream): a random
+walk of the telemetry values is sent as delta updates, the decoded state must
+match the quantized values; the updates of a throttled client merge the changes
+in between.
+"""
+import asyncio
+import math
+import random
+import time
+
+import pytest
+
+from telemetrystream import (FIELD_STEPS, AsyncTelemetryClient, TelemetryChannel,
+                             TelemetryClient, client_rate, decode_update,
+                             encode_update, quantize)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_random_walk(seed):
+    rng = random.Random(seed)
+    floats = [1.5, 12.2, 0.3, 0.0, 21.5, 1013.25, 8.4036, 49.0134]
+    channel = TelemetryChannel()
+    client = TelemetryClient(channel)
+    channel.subscribe(client)
+    state = [0.0] * len(floats)
+    size = 0
+    for i in range(10000):
+        j = rng.randrange(len(floats))
+        floats[j] += rng.gauss(0, FIELD_STEPS[j])
+        if i == 5000:
+            floats[4] = math.nan
+        channel.publish(tuple(floats))
+        message = client.update()
+        if message is not None:
+            decode_update(message, state)
+            size += len(message)
+        for value, expected, step in zip(state, floats, FIELD_STEPS):
+            if math.isnan(expected):
+                assert math.isnan(value)
+            else:
+                assert abs(value - expected) <= step / 2 + 1e-9
+    # mostly one changed field per update (mask and one int32)
+    assert size / 10000 < 5
+
+
+def test_unchanged_state_sends_nothing():
+    current = quantize((1.5, 12.2, 0.3, 0.0, 21.5, 1013.25, 8.4036, 49.0134))
+    assert len(encode_update(None, current)) == 1 + 4 * len(current)
+    assert encode_update(current, current) is None
+    assert encode_update(current, quantize((1.504,) + (math.inf,) * 7)) is not None
+
+
+def test_client_without_changes_polls_none():
+    channel = TelemetryChannel()
+    client = TelemetryClient(channel)
+    assert client.poll() is None
+    channel.publish((1.0,) * 8)
+    channel.subscribe(client)
+    assert client.poll() is not None
+    assert client.poll() is None
+    channel.publish((1.001,) * 8)       # below the quantization steps of most fields
+    message = client.poll()
+    assert message is not None and message[0] == 0b11000000
+
+
+@pytest.mark.parametrize('query, max_rate, rate', [
+    ('', 10, 10), ('rate=5', 10, 5), ('rate=50', 10, 10), ('rate=x', 10, 10),
+    ('rate=-1', 10, 10), ('rate=5', 0, 5.0), ('', 0, 0)])
+def test_client_rate(query, max_rate, rate):
+    assert client_rate(query, max_rate) == rate
+
+
+def test_throttled_client_merges_the_changes():
+    async def run():
+        channel = TelemetryChannel()
+        client = AsyncTelemetryClient(channel, 20)
+        channel.subscribe(client)
+        received = []
+
+        async def sender():
+            while True:
+                message = await client.get()
+                if message is None:
+                    return
+                received.append((time.monotonic(), message))
+
+        task = asyncio.create_task(sender())
+        floats = [1.5, 12.2, 0.3, 0.0, 21.5, 1013.25, 8.4036, 49.0134]
+        for i in range(60):                     # 0.3 s of changes every 5 ms
+            floats[i % 8] += FIELD_STEPS[i % 8] * 3
+            channel.publish(tuple(floats))
+            await asyncio.sleep(0.005)
+        await asyncio.sleep(0.1)
+        closed = time.monotonic()
+        client.close()
+        await asyncio.wait_for(task, 1)
+        return received, floats, time.monotonic() - closed
+
+    received, floats, close_delay = asyncio.run(run())
+    times = [sent for sent, message in received]
+    assert all(b - a >= 0.045 for a, b in zip(times, times[1:]))
+    assert 3 <= len(received) <= (times[-1] - times[0]) * 20 + 1
+    state = [0.0] * 8
+    for sent, message in received:
+        decode_update(message, state)
+    assert state == pytest.approx(floats, abs=1e-6)
+    assert close_delay < 0.04           # close wakes up the waiting sender
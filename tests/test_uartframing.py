@@ -0,0 +1,118 @@
+"""
+Tests of the telemetry framing (uartframing) with fragmented input: the stream is
+fed in random pieces (single bytes up to several frames per read), with garbage
+and corrupted frames in between.
+"""
+import asyncio
+import random
+
+import pytest
+
+import config
+from communicationtransports import Uart_Protocol
+from telemetrydata import TELEMETRY_FRAME
+from uartframing import (FixedFrameAssembler, TelemetryFrameAssembler, SYNC,
+                         encode_frame)
+
+PAYLOAD_SIZE = TELEMETRY_FRAME.size
+
+
+def random_payloads(rng, count):
+    payloads = [rng.randbytes(PAYLOAD_SIZE) for _ in range(count)]
+    # sync words inside the payload must not start a frame
+    payloads[1] = SYNC * (PAYLOAD_SIZE // 2)
+    payloads[2] = bytes((PAYLOAD_SIZE,)) + SYNC + bytes(PAYLOAD_SIZE - 3)
+    return payloads
+
+
+def feed_in_pieces(feed, stream, rng, sizes):
+    pos = 0
+    while pos < len(stream):
+        size = rng.choice(sizes)
+        feed(bytes(stream[pos:pos + size]))
+        pos += size
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_framed_fragmented_with_garbage(seed):
+    rng = random.Random(seed)
+    payloads = random_payloads(rng, 1000)
+    stream = bytearray()
+    expected = []
+    for i, payload in enumerate(payloads):
+        frame = bytearray(encode_frame(payload))
+        if i % 10 == 3:
+            frame[rng.randrange(3, len(frame))] ^= 1 << rng.randrange(8)  # corrupted
+        else:
+            expected.append(payload)
+        if i % 17 == 5:
+            stream.extend(SYNC[:1] + rng.randbytes(7))                  # garbage
+        if i % 23 == 7:
+            stream.extend(SYNC + bytes((PAYLOAD_SIZE - 1,)))            # wrong length
+        stream.extend(frame)
+
+    received = []
+    assembler = TelemetryFrameAssembler(lambda p: received.append(bytes(p)),
+                                        PAYLOAD_SIZE, 256)
+    feed_in_pieces(assembler.feed, stream, rng, (1, 2, 3, 5, 31, 37, 100, 300, 1000))
+    assert received == expected
+    assert assembler.good == len(expected)
+    assert assembler.bad >= len(payloads) - len(expected)
+
+
+@pytest.mark.parametrize('size', [1, 2, 36, 37, 38, 4096])
+def test_framed_fixed_piece_sizes(size):
+    payloads = random_payloads(random.Random(size), 300)
+    stream = b''.join(encode_frame(payload) for payload in payloads)
+    received = []
+    assembler = TelemetryFrameAssembler(lambda p: received.append(bytes(p)),
+                                        PAYLOAD_SIZE, 256)
+    for pos in range(0, len(stream), size):
+        assembler.feed(stream[pos:pos + size])
+    assert received == payloads
+    assert assembler.stats() == {'good': len(payloads), 'bad': 0, 'resynced': 0}
+
+
+def test_framed_resync_after_lost_byte():
+    payloads = random_payloads(random.Random(0), 10)
+    frames = [encode_frame(payload) for payload in payloads]
+    stream = b''.join(frames[:4]) + frames[4][:10] + frames[4][11:] + b''.join(frames[5:])
+    received = []
+    assembler = TelemetryFrameAssembler(lambda p: received.append(bytes(p)), PAYLOAD_SIZE)
+    for byte in stream:
+        assembler.feed(bytes((byte,)))
+    assert received == payloads[:4] + payloads[5:]
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_unframed_fragmented(seed):
+    rng = random.Random(seed)
+    payloads = random_payloads(rng, 1000)
+    received = []
+    assembler = FixedFrameAssembler(lambda p: received.append(bytes(p)), PAYLOAD_SIZE)
+    feed_in_pieces(assembler.feed, b''.join(payloads), rng, (1, 5, 31, 32, 33, 64, 100))
+    assert received == payloads
+
+
+@pytest.mark.parametrize('framing', [False, True])
+def test_protocol_handshake_and_fragmented_telemetry(framing, monkeypatch):
+    monkeypatch.setattr(config, 'UART_FRAMING', framing)
+    rng = random.Random(1)
+    samples = [tuple(rng.uniform(-100, 100) for _ in range(8)) for _ in range(50)]
+    payloads = [TELEMETRY_FRAME.pack(*sample) for sample in samples]
+    if framing:
+        stream = b''.join(encode_frame(payload) for payload in payloads)
+    else:
+        stream = b''.join(payloads)
+
+    async def run():
+        queue, handshake = asyncio.Queue(), asyncio.Queue()
+        protocol = Uart_Protocol(queue, handshake)
+        # the handshake and the first telemetry bytes in the same read
+        protocol.data_received(b'\xAA' + stream[:7])
+        feed_in_pieces(protocol.data_received, stream[7:], rng, (1, 3, 20, 40, 77))
+        assert handshake.get_nowait() is True
+        return [queue.get_nowait()[1] for _ in range(queue.qsize())]
+
+    received = asyncio.run(run())
+    assert received == [TELEMETRY_FRAME.unpack(payload) for payload in payloads]
@@ -0,0 +1,144 @@
+"""
+Tests of the in-memory UART (uarttransports.LoopbackTransport) and the Teensy
+emulator: handshake, reassembly of the ICU frames, telemetry (raw and framed),
+CTS stall with pause/resume and close.
+"""
+import asyncio
+
+import pytest
+
+import config
+from communicationdata import CommData
+from telemetrydata import TELEMETRY_FRAME
+from uartframing import encode_frame
+from uarttransports import HANDSHAKE, TeensyEmulator, create_uart_connection
+
+FLOATS = (1.5, 12.0, 0.5, 40.0, 21.5, 1013.0, 8.4036, 49.0134)
+
+
+class RecordingProtocol(asyncio.Protocol):
+    """
+    Server side protocol, which keeps the received bytes and the flow control
+    calls.
+    """
+    def __init__(self):
+        self.data = bytearray()
+        self.events = []
+
+    def data_received(self, data):
+        self.data.extend(data)
+
+    def pause_writing(self):
+        self.events.append('pause')
+
+    def resume_writing(self):
+        self.events.append('resume')
+
+    def connection_lost(self, exc):
+        self.events.append('lost')
+
+
+async def connect(emulator):
+    transport, protocol = await create_uart_connection(
+        asyncio.get_running_loop(), RecordingProtocol, 'emulator', emulator)
+    # handshake: sent by the emulator and received by the protocol in two iterations
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    return transport, protocol
+
+
+def icu_frame(power):
+    return CommData(Pitch=1024, Roll=1024, Yaw=1024, Power=power, PitchG=512,
+                    RollG=0, YawG=512).to_uart_data()
+
+
+def test_handshake_and_fragmented_frames():
+    async def run():
+        emulator = TeensyEmulator(log=True)
+        transport, protocol = await connect(emulator)
+        assert bytes(protocol.data) == HANDSHAKE
+        transport.write(icu_frame(1))           # before the handshake: ignored
+        stream = HANDSHAKE + b''.join(icu_frame(power) for power in range(2, 12))
+        for start in range(0, len(stream), 3):
+            transport.write(stream[start:start + 3])
+        return emulator
+    emulator = asyncio.run(run())
+    assert [frame for now, frame in emulator.frames] == [icu_frame(power)
+                                                         for power in range(2, 12)]
+    assert emulator.received == 10 and not emulator.buffer
+
+
+@pytest.mark.parametrize('framing', [False, True])
+def test_telemetry(monkeypatch, framing):
+    monkeypatch.setattr(config, 'UART_FRAMING', framing)
+
+    async def run():
+        emulator = TeensyEmulator(log=True)
+        transport, protocol = await connect(emulator)
+        emulator.send_telemetry(FLOATS)
+        emulator.send_payload(TELEMETRY_FRAME.pack(*FLOATS[::-1]))
+        await asyncio.sleep(0)
+        return emulator, protocol
+    emulator, protocol = asyncio.run(run())
+    payloads = [TELEMETRY_FRAME.pack(*FLOATS), TELEMETRY_FRAME.pack(*FLOATS[::-1])]
+    if framing:
+        payloads = [encode_frame(payload) for payload in payloads]
+    assert bytes(protocol.data) == HANDSHAKE + b''.join(payloads)
+    assert emulator.sent == 2
+    assert [floats for now, floats in emulator.telemetry] == \
+        [pytest.approx(FLOATS), pytest.approx(FLOATS[::-1])]
+
+
+def test_synthetic_telemetry():
+    async def run():
+        emulator = TeensyEmulator()
+        transport, protocol = await connect(emulator)
+        await emulator.send_synthetic(1000, 0.05)
+        await asyncio.sleep(0)
+        return emulator, protocol
+    emulator, protocol = asyncio.run(run())
+    data = bytes(protocol.data[len(HANDSHAKE):])
+    assert emulator.sent == 50 and len(data) == 50 * TELEMETRY_FRAME.size
+    # BATT_AMP is the frame counter
+    assert [TELEMETRY_FRAME.unpack_from(data, offset)[0] for offset in
+            range(0, len(data), TELEMETRY_FRAME.size)] == [float(i) for i in range(50)]
+
+
+def test_cts_stall_pauses_and_resumes():
+    async def run():
+        emulator = TeensyEmulator(log=True)
+        transport, protocol = await connect(emulator)
+        transport.set_write_buffer_limits(64)
+        assert transport.get_write_buffer_limits() == (16, 64)
+        transport.write(HANDSHAKE)
+        transport.set_cts(False)
+        for power in range(10):
+            transport.write(icu_frame(power))
+        assert emulator.received == 0 and transport.get_write_buffer_size() == 80
+        assert protocol.events == ['pause']
+        transport.set_cts(True)
+        assert transport.get_write_buffer_size() == 0
+        assert protocol.events == ['pause', 'resume']
+        transport.write(icu_frame(10))
+        return emulator
+    emulator = asyncio.run(run())
+    assert [frame for now, frame in emulator.frames] == [icu_frame(power)
+                                                         for power in range(11)]
+
+
+def test_close():
+    async def run():
+        emulator = TeensyEmulator(rate=1000)
+        transport, protocol = await connect(emulator)
+        await asyncio.sleep(0.01)
+        transport.close()
+        transport.close()
+        await asyncio.sleep(0)
+        sent = emulator.sent
+        transport.write(HANDSHAKE + icu_frame(1))
+        await asyncio.sleep(0.01)
+        return emulator, protocol, transport, sent
+    emulator, protocol, transport, sent = asyncio.run(run())
+    assert transport.is_closing() and protocol.events == ['lost']
+    assert emulator.task.cancelled() and emulator.sent == sent
+    assert emulator.received == 0
@@ -0,0 +1,229 @@
+"""
+Tests of the video adaptation (videoadaptation) with a simulated camera and a
+simulated link in logical time: the profile steps down, when the bandwidth
+drops, and up again after the hold time, the switch happens at a keyframe and
+the backlog of the old stream is dropped.
+"""
+import struct
+
+from framequeue import ClientFrameQueue
+from output import StreamingOutput, nal_type, NAL_IDR, NAL_PPS, NAL_SPS
+from videoadaptation import LadderController, VideoAdapter, VideoProfile
+
+PROFILES = [VideoProfile(1280, 720, 25, 4000000),
+            VideoProfile(848, 480, 25, 1500000),
+            VideoProfile(424, 240, 15, 400000)]
+
+
+class SimulatedCamera(object):
+    """
+    A picamera replacement in logical time: a frame of the size given by the
+    bitrate every 1/framerate seconds, a group of pictures per second (SPS, PPS
+    and IDR at the start of the recording and after request_key_frame). The
+    capture time is put after the NAL header.
+    """
+    def __init__(self, restart_delay=0.2):
+        self.restart_delay = restart_delay
+        self.resolution = (0, 0)
+        self.framerate = 25
+        self.bitrate = 0
+        self.keyframe_requested = False
+        self.gop_position = 0
+        self.now = 0.0
+        self.next_time = 0.0
+        self.recordings = []        # (time, resolution, framerate, bitrate)
+
+    def start_recording(self, output, format, **options):
+        self.bitrate = options['bitrate']
+        self.gop_position = 0
+        self.next_time = self.now + self.restart_delay
+        self.recordings.append((self.now, self.resolution, self.framerate, self.bitrate))
+
+    def stop_recording(self):
+        pass
+
+    def request_key_frame(self):
+        self.keyframe_requested = True
+
+    def unit(self, nal, size):
+        return b'\x00\x00\x00\x01' + bytes((nal,)) + struct.pack('<d', self.now) + \
+            bytes(max(0, size - 13))
+
+    def capture(self):
+        self.now = self.next_time
+        self.next_time += 1 / self.framerate
+        size = int(self.bitrate / 8 / self.framerate)
+        if self.gop_position == 0 or self.keyframe_requested:
+            self.keyframe_requested = False
+            self.gop_position = 1
+            return [self.unit(0x67, 20), self.unit(0x68, 20), self.unit(0x65, 2 * size)]
+        self.gop_position = (self.gop_position + 1) % int(self.framerate)
+        return [self.unit(0x41, size)]
+
+
+def simulate(schedule, duration):
+    """
+    Streams the simulated camera through the adapter to one client over a link
+    with the bandwidth schedule (list of (start time in s, bit/s)). Returns the
+    tuple (camera, adapter, sent frames as (capture time, send time, frame)).
+    """
+    camera = SimulatedCamera()
+    output = StreamingOutput()
+    queue = ClientFrameQueue(30)
+    output.subscribe(queue)
+    adapter = VideoAdapter(camera, output, PROFILES, 0)
+    adapter.ladder.up_hold = adapter.ladder.hold = 5.0
+    adapter.start_recording()
+
+    sent = []
+    free_at = 0.0
+
+    def bandwidth(now):
+        return [rate for start, rate in schedule if start <= now][-1]
+
+    while camera.next_time < duration:
+        units = camera.capture()
+        now = camera.now
+        # send the queued frames, which are sent completely until now
+        while queue.frames:
+            frame = queue.frames[0]
+            captured, = struct.unpack_from('<d', frame, 5)
+            end = max(free_at, captured) + len(frame) * 8 / bandwidth(free_at)
+            if end > now:
+                break
+            queue.poll()
+            free_at = end
+            sent.append((captured, end, frame))
+        for unit in units:
+            # like StreamingOutput.publish, but in logical time
+            adapter.observe(unit, int(now * 1e9), int(now * 1e9))
+            with output.condition:
+                output.publish(unit)
+            if adapter.switch_event.is_set():
+                adapter.switch(int(now * 1e9))
+    return camera, adapter, sent
+
+
+def test_steps_down_and_up_with_the_bandwidth():
+    schedule = [(0, 6e6), (10, 1e6), (30, 6e6)]
+    camera, adapter, sent = simulate(schedule, 60)
+    switches = [(start, bitrate) for start, resolution, framerate, bitrate
+                in camera.recordings]
+    assert adapter.switches == len(switches) - 1
+
+    # down within a few windows after the drop, until the profile fits the link
+    first_down = switches[1]
+    assert 10 < first_down[0] < 12 and first_down[1] < PROFILES[0].bitrate
+    low = [bitrate for start, bitrate in switches if 10 < start < 30]
+    assert min(low) < 1e6
+    # a step up at the low bandwidth fails (the next switch is a step down) and
+    # doubles the hold time of the next step up
+    ups = [start for (start, bitrate), (_, previous) in zip(switches[1:], switches)
+           if bitrate > previous]
+    probe = min(ups)
+    last_down = max(start for start, bitrate in switches if start < 30)
+    assert 10 < probe < last_down < 30
+    next_up = min(start for start in ups if start > last_down)
+    assert next_up - last_down >= 2 * 5.0
+    # back to the best profile after the recovery
+    assert switches[-1][0] > 30 and switches[-1][1] == PROFILES[0].bitrate
+
+    # after the last step down, the latency stays below the target
+    latencies = [end - captured for captured, end, frame in sent
+                 if last_down + 2 < captured < 30]
+    assert latencies and max(latencies) < 0.3
+
+
+def test_fixed_profile_falls_behind():
+    """
+    Without a step down, the client falls behind at the low bandwidth (reference
+    for the test above).
+    """
+    schedule = [(0, 6e6), (10, 1e6)]
+    camera = SimulatedCamera()
+    camera.bitrate = PROFILES[0].bitrate
+    output = StreamingOutput()
+    queue = ClientFrameQueue(30)
+    output.subscribe(queue)
+    adapter = VideoAdapter(camera, output, PROFILES[:1], 0)
+    adapter.start_recording()
+    free_at = 0.0
+    latencies = []
+    while camera.next_time < 20:
+        units = camera.capture()
+        now = camera.now
+        while queue.frames:
+            frame = queue.frames[0]
+            captured, = struct.unpack_from('<d', frame, 5)
+            rate = [rate for start, rate in schedule if start <= free_at][-1]
+            end = max(free_at, captured) + len(frame) * 8 / rate
+            if end > now:
+                break
+            queue.poll()
+            free_at = end
+            latencies.append(end - captured)
+        for unit in units:
+            adapter.observe(unit, int(now * 1e9), int(now * 1e9))
+            with output.condition:
+                output.publish(unit)
+    assert adapter.switches == 0
+    assert max(latencies) > 0.3
+    assert queue.dropped > 0
+
+
+def test_switch_at_keyframe_drops_the_backlog():
+    camera = SimulatedCamera(restart_delay=0)
+    output = StreamingOutput()
+    queue = ClientFrameQueue(1000)
+    output.subscribe(queue)
+    adapter = VideoAdapter(camera, output, PROFILES, 0)
+    output.adapter = adapter
+    adapter.start_recording()
+    for _ in range(10):
+        for unit in camera.capture():
+            with output.condition:
+                output.publish(unit, 0)
+
+    # step down requested: a keyframe is requested, the switch waits for it
+    adapter.pending = 1
+    camera.request_key_frame()
+    units = camera.capture()
+    assert [nal_type(unit) for unit in units] == [NAL_SPS, NAL_PPS, NAL_IDR]
+    for unit in units:
+        with output.condition:
+            output.publish(unit, 0)
+    assert adapter.switch_event.is_set()
+    adapter.switch()
+    assert adapter.profile == PROFILES[1]
+    assert camera.recordings[-1][1:] == ((848, 480), 25, 1500000)
+
+    # the queued frames of the old stream are dropped at the SPS of the new one
+    backlog = len(queue.frames)
+    new_units = camera.capture()
+    for unit in new_units:
+        with output.condition:
+            output.publish(unit, 0)
+    assert list(queue.frames) == new_units
+    assert queue.dropped == backlog
+
+
+def test_ladder_holds_after_an_unstable_step_up():
+    def run(ladder, start, end, latency):
+        now = start
+        while now < end:
+            index = ladder.update(now, latency)
+            if index is not None:
+                ladder.switched(index, now)
+                return now, index
+            now += 0.04
+        return now, None
+
+    ladder = LadderController(3, 0, target=0.3, interval=1.0, up_hold=5.0)
+    now, index = run(ladder, 0, 10, 0.5)
+    assert index == 1 and now < 1.1
+    now, index = run(ladder, now, 30, 0.05)
+    assert index == 0 and 6 < now < 8
+    now, index = run(ladder, now, 40, 0.5)
+    assert index == 1 and ladder.hold == 10.0
+    now, index = run(ladder, now, 40, 0.2)
+    assert index is None
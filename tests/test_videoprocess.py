@@ -0,0 +1,71 @@
+"""
+Tests of the shared status block of the video process (videoprocess.SharedStatus):
+round trip of the regions, detection of torn reads by the CRC and a concurrent
+writer in another process.
+"""
+import multiprocessing
+
+import videoprocess
+from videoprocess import RUNNING, SharedStatus, TELEMETRY_OFFSET
+
+
+def write_samples(buffer, count):
+    """
+    Writer of the concurrency test (child process): samples with 8 equal values.
+    """
+    status = SharedStatus(buffer)
+    for i in range(1, count + 1):
+        status.publish((float(i),) * 8)
+
+
+def test_round_trip():
+    status = SharedStatus()
+    assert status.telemetry() is None
+    assert status.video() == (0, 0, 0, 0, 0)
+    assert status.metrics() == b''
+    status.publish(tuple(float(i) for i in range(8)))
+    status.set_video(RUNNING, 25, 2, 1)
+    status.set_metrics(b'a 1\nb 2\n')
+    assert status.telemetry() == (2, tuple(float(i) for i in range(8)))
+    assert status.video()[0::2] == (RUNNING, 25, 1)
+    assert status.metrics() == b'a 1\nb 2\n'
+    assert status.torn == 0
+
+
+def test_metrics_truncated_at_a_line_end():
+    status = SharedStatus()
+    status.set_metrics(b'metric_name 12345\n' * 5000)
+    text = status.metrics()
+    assert len(text) <= videoprocess.METRICS_SIZE and text.endswith(b'\n')
+    assert text == b'metric_name 12345\n' * (len(text) // 18)
+
+
+def test_torn_values_are_detected():
+    """
+    Values, which don't match the sequence number (e.g. stores seen out of order on
+    ARM), are retried and finally reported as torn.
+    """
+    status = SharedStatus()
+    status.publish((1.0,) * 8)
+    status.view[TELEMETRY_OFFSET + videoprocess._SEQ.size] ^= 1
+    assert status.telemetry() is None
+    assert status.torn == 1
+    status.publish((2.0,) * 8)
+    assert status.telemetry() == (4, (2.0,) * 8)
+
+
+def test_concurrent_writer():
+    status = SharedStatus()
+    writer = multiprocessing.get_context('spawn').Process(
+        target=write_samples, args=(status.buffer, 200000))
+    writer.start()
+    reads = 0
+    while writer.is_alive():
+        result = status.telemetry()
+        if result is not None:
+            seq, values = result
+            assert len(set(values)) == 1 and seq == 2 * values[0]
+            reads += 1
+    writer.join()
+    assert writer.exitcode == 0 and reads > 0
+    assert status.telemetry() == (400000, (200000.0,) * 8)
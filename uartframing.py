@@ -0,0 +1,203 @@
+"""
+Incremental framing of the telemetry stream (Teensy -> Pi).
+
+Serial reads don't keep frame boundaries: one data_received call can contain a
+part of a frame or several frames. The assemblers collect the bytes in a
+preallocated buffer and pass every complete frame (memoryview) to a callback.
+
+Framed telemetry (TelemetryFrameAssembler), little-endian:
+
+    sync (2 Bytes: A5 5A) | length (1 Byte) | payload (length Bytes) | CRC-16 (2 Bytes)
+
+The CRC-16/CCITT-FALSE (polynomial 0x1021, init 0xFFFF) is calculated over the
+length byte and the payload.
+"""
+import struct
+
+from binascii import crc_hqx
+
+SYNC = b'\xA5\x5A'
+HEADER_SIZE = len(SYNC) + 1
+CRC_SIZE = 2
+
+_CRC = struct.Struct('<H')
+
+
+def crc16(data):
+    """
+    Returns the CRC-16/CCITT-FALSE of the data.
+    """
+    return crc_hqx(data, 0xFFFF)
+
+
+def encode_frame(payload):
+    """
+    Returns the framed payload (used by the Teensy, here for testing).
+    """
+    body = bytes((len(payload),)) + bytes(payload)
+    return SYNC + body + _CRC.pack(crc16(body))
+
+
+#region TelemetryFrameAssembler
+class TelemetryFrameAssembler(object):
+    """
+    Reassembles framed telemetry (sync word, length, CRC-16) from a byte stream.
+    After garbage or a corrupted frame, the assembler resynchronizes at the next
+    sync word.
+    """
+    def __init__(self, callback, payload_size, capacity=4096):
+        """
+        Constructor: callback is called with the payload (memoryview, only valid
+        during the call) of every valid frame. Frames with another length than
+        payload_size are rejected.
+        """
+        self.callback = callback
+        self.payload_size = payload_size
+        self.frame_size = HEADER_SIZE + payload_size + CRC_SIZE
+        self.buffer = bytearray(max(capacity, 2 * self.frame_size))
+        self.view = memoryview(self.buffer)
+        self.start = 0      # first unprocessed byte
+        self.end = 0        # write position
+
+        # statistics
+        self.good = 0       # valid frames
+        self.bad = 0        # frames with wrong length or CRC
+        self.resynced = 0   # times bytes were skipped to find the next sync word
+
+    def feed(self, data):
+        """
+        This method appends the received bytes and processes all complete frames.
+        """
+        # bigger reads are processed in pieces, so the buffer never grows
+        piece = len(self.buffer) - self.frame_size
+        for offset in range(0, len(data), piece):
+            self.append(data[offset:offset + piece] if len(data) > piece else data)
+            self.process()
+
+    def append(self, data):
+        """
+        This method appends the bytes to the buffer (moves the unprocessed bytes to
+        the beginning of the buffer, if necessary).
+        """
+        size = len(data)
+        if self.end + size > len(self.buffer):
+            pending = self.end - self.start
+            self.view[:pending] = self.view[self.start:self.end]
+            self.start = 0
+            self.end = pending
+        self.view[self.end:self.end + size] = data
+        self.end += size
+
+    def process(self):
+        """
+        This method searches the frames in the unprocessed bytes.
+        """
+        buffer = self.buffer
+        view = self.view
+        payload_size = self.payload_size
+        start = self.start
+        end = self.end
+        while True:
+            pos = buffer.find(SYNC, start, end)
+            if pos < 0:
+                # keep the last byte, it could be the first byte of the sync word
+                if end - start > 1:
+                    self.resynced += 1
+                    start = end - 1
+                break
+            if pos > start:
+                self.resynced += 1
+                start = pos
+
+            if end - pos < HEADER_SIZE:
+                break
+            length = buffer[pos + 2]
+            if length != payload_size:
+                self.bad += 1
+                start = pos + 1
+                continue
+            frame_end = pos + HEADER_SIZE + length + CRC_SIZE
+            if frame_end > end:
+                break
+
+            crc, = _CRC.unpack_from(buffer, frame_end - CRC_SIZE)
+            if crc16(view[pos + 2:frame_end - CRC_SIZE]) != crc:
+                self.bad += 1
+                start = pos + 1
+                continue
+            self.good += 1
+            self.callback(view[pos + HEADER_SIZE:frame_end - CRC_SIZE])
+            start = frame_end
+
+        if start == end:
+            start = end = 0
+        self.start = start
+        self.end = end
+
+    def stats(self):
+        """
+        Returns the statistics of the assembler as dictionary.
+        """
+        return {
+            'good': self.good,
+            'bad': self.bad,
+            'resynced': self.resynced,
+        }
+#endregion
+
+#region FixedFrameAssembler
+class FixedFrameAssembler(object):
+    """
+    Reassembles unframed fixed-size telemetry (the original protocol without sync
+    word and CRC). Merged and split reads are handled, but there is no way to
+    resynchronize after a lost byte.
+    """
+    def __init__(self, callback, payload_size):
+        self.callback = callback
+        self.payload_size = payload_size
+        self.buffer = bytearray(payload_size)
+        self.view = memoryview(self.buffer)
+        self.fill = 0
+
+        # statistics
+        self.good = 0
+        self.bad = 0
+        self.resynced = 0
+
+    def feed(self, data):
+        """
+        This method appends the received bytes and passes every complete frame to
+        the callback.
+        """
+        size = self.payload_size
+        data = memoryview(data)
+        pos = 0
+        if self.fill:
+            count = min(size - self.fill, len(data))
+            self.view[self.fill:self.fill + count] = data[:count]
+            self.fill += count
+            pos = count
+            if self.fill < size:
+                return
+            self.good += 1
+            self.callback(self.view)
+            self.fill = 0
+        while len(data) - pos >= size:
+            self.good += 1
+            self.callback(data[pos:pos + size])
+            pos += size
+        rest = len(data) - pos
+        if rest:
+            self.view[:rest] = data[pos:]
+            self.fill = rest
+
+    def stats(self):
+        """
+        Returns the statistics of the assembler as dictionary.
+        """
+        return {
+            'good': self.good,
+            'bad': self.bad,
+            'resynced': self.resynced,
+        }
+#endregion
@@ -0,0 +1,283 @@
+"""
+UART connection to the Teensy (config.UART_TRANSPORT):
+
+    'serial':   /dev/ttyAMA0 (config.UART_DEVICE) with RTS/CTS flow control
+    'pty':      pseudo terminal, the TeensyEmulator is on the other side (the
+                serial code path is the same as on the Pi)
+    'emulator': in-memory loopback to the TeensyEmulator (no serial port at all)
+
+The emulator answers the handshake, collects the ICU frames written by the server
+and sends telemetry frames (synthetic or replayed), so the control path can run
+and be benchmarked without the Pi hardware.
+"""
+import asyncio
+import os
+import time
+import tty
+
+import config
+import icuprotocol
+from telemetrydata import TELEMETRY_FRAME
+from uartframing import encode_frame
+
+HANDSHAKE = b'\xAA'
+
+#region TeensyEmulator
+class TeensyEmulator(object):
+    """
+    Emulates the Teensy side of the UART: sends the handshake, reassembles the ICU
+    frames (8 Bytes) written by the server and sends telemetry frames (framed, if
+    config.UART_FRAMING). The send times of the telemetry and the receive times
+    of the ICU frames (time.monotonic_ns) are logged, if log is True.
+    """
+    def __init__(self, rate=0, log=False):
+        """
+        Constructor: rate is the rate of the synthetic telemetry (frames/s, 0 -->
+        telemetry only by send_telemetry/replay).
+        """
+        self.rate = rate
+        self.log = log
+        self.send = None            # sends bytes to the server (set by the transport)
+        self.loop = None
+        self.buffer = bytearray()
+        self.handshake = False
+        self.task = None
+
+        self.frames = []            # received ICU frames: (monotonic_ns, frame)
+        self.telemetry = []         # sent telemetry: (monotonic_ns, floats)
+
+        # statistics
+        self.received = 0           # ICU frames received
+        self.sent = 0               # telemetry frames sent
+
+    def start(self, send):
+        """
+        Connects the emulator (send: function, which passes bytes to the server)
+        and sends the handshake.
+        """
+        self.send = send
+        self.loop = asyncio.get_running_loop()
+        self.loop.call_soon(send, HANDSHAKE)
+        if self.rate > 0:
+            self.task = asyncio.create_task(self.send_synthetic(self.rate))
+
+    def close(self):
+        """
+        Stops the synthetic telemetry.
+        """
+        if self.task is not None:
+            self.task.cancel()
+
+    def data_received(self, data):
+        """
+        This method is called with the bytes written by the server.
+        """
+        if not self.handshake:
+            if data[:1] != HANDSHAKE:
+                return
+            self.handshake = True
+            data = data[1:]
+        now = time.monotonic_ns()
+        buffer = self.buffer
+        buffer.extend(data)
+        while len(buffer) >= icuprotocol.FRAME_SIZE:
+            frame = bytes(buffer[:icuprotocol.FRAME_SIZE])
+            del buffer[:icuprotocol.FRAME_SIZE]
+            self.received += 1
+            if self.log:
+                self.frames.append((now, frame))
+
+    def send_telemetry(self, floats):
+        """
+        Sends a telemetry frame (tuple of 8 floats).
+        """
+        self.send_payload(TELEMETRY_FRAME.pack(*floats))
+
+    def send_payload(self, payload):
+        """
+        Sends a raw telemetry frame (32 Bytes, e.g. replayed from the flight
+        recorder).
+        """
+        if config.UART_FRAMING:
+            data = encode_frame(payload)
+        else:
+            data = payload
+        if self.log:
+            self.telemetry.append((time.monotonic_ns(), TELEMETRY_FRAME.unpack(payload)))
+        self.sent += 1
+        self.send(data)
+
+    async def send_synthetic(self, rate, duration=None, start=None):
+        """
+        Sends synthetic telemetry at rate frames/s (BATT_AMP is the frame counter),
+        for duration seconds (None --> until cancelled). start is the monotonic time
+        (ns) of the first frame.
+        """
+        interval = 1 / rate
+        start = (start or time.monotonic_ns()) / 1e9
+        count = None if duration is None else int(duration * rate)
+        i = 0
+        while count is None or i < count:
+            delay = start + i * interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            # send all frames, which are due (sleep is not precise at high rates)
+            while (count is None or i < count) and start + i * interval <= time.monotonic():
+                self.send_telemetry((float(i), 12.0, 0.5, 40.0, 21.5, 1013.0,
+                                     8.4036, 49.0134))
+                i += 1
+
+    async def replay(self, records, start=None):
+        """
+        Sends recorded telemetry frames (flight recorder records, oldest first) with
+        their original timing. start is the monotonic time (ns) of the first frame.
+        """
+        if not records:
+            return
+        start = (start or time.monotonic_ns()) / 1e9
+        first = records[0].monotonic_ns
+        for record in records:
+            delay = start + (record.monotonic_ns - first) / 1e9 - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.send_payload(record.payload)
+#endregion
+
+#region LoopbackTransport
+class LoopbackTransport(asyncio.Transport):
+    """
+    In-memory transport between the server protocol (Uart_Protocol) and the
+    emulator: writes are passed to the emulator, the emulator's bytes are passed to
+    data_received of the protocol (in a new event loop iteration, like a serial
+    read). set_cts(False) emulates the Teensy holding CTS: writes are buffered and
+    the protocol is paused/resumed by the write buffer limits.
+    """
+    def __init__(self, protocol, emulator):
+        super(LoopbackTransport, self).__init__()
+        self.protocol = protocol
+        self.emulator = emulator
+        self.loop = asyncio.get_running_loop()
+        self.closing = False
+        self.cts = True
+        self.buffer = bytearray()
+        self.high = 64 * 1024       # default limits of the asyncio transports
+        self.low = 16 * 1024
+        self.paused = False
+
+    def receive(self, data):
+        """
+        Passes the bytes of the emulator to the protocol.
+        """
+        if not self.closing:
+            self.loop.call_soon(self.protocol.data_received, data)
+
+    def set_cts(self, ready):
+        """
+        Sets the emulated CTS line: False --> writes are buffered, True --> the
+        buffer is passed to the emulator and the protocol is resumed.
+        """
+        self.cts = ready
+        if ready and self.buffer:
+            data = bytes(self.buffer)
+            self.buffer.clear()
+            self.emulator.data_received(data)
+        if ready and self.paused:
+            self.paused = False
+            self.protocol.resume_writing()
+
+    def write(self, data):
+        if self.closing:
+            return
+        if self.cts and not self.buffer:
+            self.emulator.data_received(data)
+            return
+        self.buffer.extend(data)
+        if not self.paused and len(self.buffer) > self.high:
+            self.paused = True
+            self.protocol.pause_writing()
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        if high is None:
+            high = 64 * 1024 if low is None else 4 * low
+        if low is None:
+            low = high // 4
+        self.high, self.low = high, low
+
+    def get_write_buffer_limits(self):
+        return self.low, self.high
+
+    def get_write_buffer_size(self):
+        return len(self.buffer)
+
+    def is_closing(self):
+        return self.closing
+
+    def close(self):
+        if not self.closing:
+            self.closing = True
+            self.emulator.close()
+            self.loop.call_soon(self.protocol.connection_lost, None)
+#endregion
+
+#region pty
+class PtyEndpoint(object):
+    """
+    Connects the emulator to the master side of a pseudo terminal.
+    """
+    def __init__(self, master, emulator):
+        self.master = master
+        self.emulator = emulator
+        self.loop = asyncio.get_running_loop()
+        self.loop.add_reader(master, self.read)
+
+    def read(self):
+        try:
+            data = os.read(self.master, 4096)
+        except OSError:
+            self.close()
+            return
+        self.emulator.data_received(data)
+
+    def write(self, data):
+        os.write(self.master, data)
+
+    def close(self):
+        self.loop.remove_reader(self.master)
+        self.emulator.close()
+#endregion
+
+
+async def create_uart_connection(loop, protocol_factory, mode=None, emulator=None):
+    """
+    Creates the UART connection (mode: 'serial', 'pty' or 'emulator', default:
+    config.UART_TRANSPORT) and returns the tuple (transport, protocol) like
+    serial_asyncio.create_serial_connection. emulator is the TeensyEmulator for
+    'pty' and 'emulator' (default: synthetic telemetry at config.EMULATOR_RATE).
+    """
+    mode = mode or config.UART_TRANSPORT
+    if mode == 'serial':
+        import serial_asyncio   # for creating async serial connection
+        return await serial_asyncio.create_serial_connection(
+            loop, protocol_factory, config.UART_DEVICE, baudrate=2000000, bytesize=8,
+            parity="N", stopbits=1, xonxoff=False, rtscts=True)
+
+    if emulator is None:
+        emulator = TeensyEmulator(config.EMULATOR_RATE)
+    if mode == 'emulator':
+        protocol = protocol_factory()
+        transport = LoopbackTransport(protocol, emulator)
+        protocol.connection_made(transport)
+        emulator.start(transport.receive)
+        return transport, protocol
+    if mode == 'pty':
+        import serial_asyncio
+        master, slave = os.openpty()
+        tty.setraw(master)
+        tty.setraw(slave)
+        transport, protocol = await serial_asyncio.create_serial_connection(
+            loop, protocol_factory, os.ttyname(slave), baudrate=2000000)
+        os.close(slave)     # the serial port has its own file descriptor
+        endpoint = PtyEndpoint(master, emulator)
+        emulator.start(endpoint.write)
+        return transport, protocol
+    raise ValueError(f'Unknown UART transport: {mode}')
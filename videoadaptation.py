@@ -0,0 +1,277 @@
+"""
+Adaptive video quality: steps the encoder through a ladder of profiles
+(resolution, framerate, bitrate; config.VIDEO_PROFILES) to keep the video latency
+of the websocket clients below a target.
+
+The latency of every published P-frame is estimated as
+
+    broadcast delay (capture --> publish)
+    + backlog of the slowest client (queued frames / framerate)
+
+and its peak per window (config.VIDEO_ADAPT_INTERVAL) is compared with the target
+(LadderController): above the target --> one profile down, below
+VIDEO_ADAPT_UP_RATIO * target for VIDEO_ADAPT_UP_HOLD seconds --> one profile up.
+
+The resolution and the framerate of the Pi camera can't change while recording,
+so a profile is applied by restarting the recording (the new stream starts with
+SPS, PPS and an IDR frame). The restart waits for the next IDR frame of the
+current stream (keyframe boundary); for a step down a keyframe is requested, so
+the switch doesn't wait for a whole group of pictures, and the frames of the old
+stream, which are still queued for the clients, are dropped at the SPS of the new
+stream.
+"""
+import time
+from collections import namedtuple
+from threading import Event, Thread
+
+import config
+from output import nal_type, NAL_IDR, NAL_SLICE, NAL_SPS
+
+VideoProfile = namedtuple('VideoProfile', ('width', 'height', 'framerate', 'bitrate'))
+
+PROFILES = [VideoProfile(*profile) for profile in config.VIDEO_PROFILES]
+
+
+def recording_options(profile):
+    """
+    Returns the options of camera.start_recording for the profile (h264 baseline
+    profile, see BroadcastThread).
+    """
+    return {'profile': 'baseline', 'bitrate': profile.bitrate}
+
+
+def start_profile(profiles):
+    """
+    Returns the index of the profile, which matches config.WIDTH, HEIGHT and
+    FRAMERATE (the first profile, if none matches).
+    """
+    for i, profile in enumerate(profiles):
+        if (profile.width, profile.height, profile.framerate) == \
+                (config.WIDTH, config.HEIGHT, config.FRAMERATE):
+            return i
+    return 0
+
+
+#region LadderController
+class LadderController(object):
+    """
+    Decision logic of the adaptation (no I/O, the time is passed in): index 0 is
+    the best profile, count - 1 the lowest. A step up is only tried after the
+    latency was low for the hold time; if the latency exceeds the target again
+    within the hold time after a step up, the hold time of the next step up is
+    doubled (max. 8 times), so the quality doesn't oscillate at the link limit.
+    """
+    def __init__(self, count, index=0, target=0.3, interval=1.0, up_hold=10.0,
+                 up_ratio=0.5):
+        """
+        Constructor: count is the number of profiles, index the current profile,
+        target the latency target (s), interval the window of the peak latency (s),
+        up_hold the time (s) below up_ratio * target before a step up.
+        """
+        self.count = count
+        self.index = index
+        self.target = target
+        self.interval = interval
+        self.up_hold = up_hold
+        self.up_ratio = up_ratio
+        self.hold = up_hold
+        self.window_start = None
+        self.peak = 0.0             # peak latency of the current window
+        self.last_peak = 0.0        # peak latency of the last window
+        self.good_since = None      # start of the low latency period
+        self.stepped_up = None      # time of the last step up
+        self.settle_until = 0.0     # no decisions until the backlog of the old
+                                    # profile is drained
+
+    def update(self, now, latency):
+        """
+        Adds the latency (s) of a frame at time now (s). Returns the index of the
+        profile, which should be used, if it changes, otherwise None.
+        """
+        if now < self.settle_until:
+            return None
+        if latency > self.peak:
+            self.peak = latency
+        if self.window_start is None:
+            self.window_start = now
+            return None
+        if now - self.window_start < self.interval:
+            return None
+
+        peak = self.last_peak = self.peak
+        self.peak = 0.0
+        self.window_start = now
+        if peak > self.target:
+            self.good_since = None
+            if self.stepped_up is not None and now - self.stepped_up < self.hold:
+                self.hold = min(self.hold * 2, self.up_hold * 8)
+            if self.index < self.count - 1:
+                return self.index + 1
+            return None
+        if peak < self.target * self.up_ratio:
+            if self.good_since is None:
+                self.good_since = now - self.interval
+            elif now - self.good_since >= self.hold and self.index > 0:
+                return self.index - 1
+        else:
+            self.good_since = None
+        return None
+
+    def switched(self, index, now):
+        """
+        This method is called, when the profile was applied. The latencies of the
+        old profile are discarded and the next window starts after one interval
+        (the frames of the old profile are still queued).
+        """
+        if index < self.index:
+            self.stepped_up = now
+        elif self.stepped_up is not None and now - self.stepped_up >= self.hold:
+            self.hold = self.up_hold    # the last step up was stable
+        self.index = index
+        self.settle_until = now + self.interval
+        self.window_start = None
+        self.peak = 0.0
+        self.good_since = None
+#endregion
+
+#region VideoAdapter
+class VideoAdapter(Thread):
+    """
+    A Class that inherits from Thread and applies the profile changes of the
+    LadderController to the camera. observe is called by StreamingOutput.publish
+    for every frame (holding the output condition, so it only collects the
+    latency); the recording is restarted in this thread (stopping the recording
+    in the broadcast thread would deadlock, the encoder flushes into the output).
+    """
+    def __init__(self, camera, output, profiles=None, index=None):
+        """
+        Constructor: params are the camera object, streamoutput, the profiles (best
+        first, default: config.VIDEO_PROFILES) and the start profile (default: the
+        profile of config.WIDTH, HEIGHT and FRAMERATE).
+        """
+        super(VideoAdapter, self).__init__(daemon=True)
+        self.camera = camera
+        self.output = output
+        self.profiles = profiles or PROFILES
+        if index is None:
+            index = start_profile(self.profiles)
+        self.ladder = LadderController(len(self.profiles), index,
+                                       config.VIDEO_TARGET_LATENCY,
+                                       config.VIDEO_ADAPT_INTERVAL,
+                                       config.VIDEO_ADAPT_UP_HOLD,
+                                       config.VIDEO_ADAPT_UP_RATIO)
+        self.pending = None         # index of the requested profile
+        self.skip_backlog = False   # drop the queued frames at the next SPS
+        self.switch_event = Event()
+        self.stop_event = Event()
+
+        # statistics
+        self.switches = 0
+        self.restart_time = 0.0     # duration of the last restart (s)
+
+    @property
+    def profile(self):
+        """
+        Returns the current profile.
+        """
+        return self.profiles[self.ladder.index]
+
+    def start_recording(self):
+        """
+        Starts the recording with the current profile.
+        """
+        profile = self.profile
+        self.camera.resolution = (profile.width, profile.height)
+        self.camera.framerate = profile.framerate
+        self.camera.start_recording(self.output, 'h264', **recording_options(profile))
+
+    def observe(self, frame, captured, now=None):
+        """
+        This method is called for every published frame, before it is put into the
+        send queues (captured, now: monotonic ns). Requests a profile change or, if
+        a change is pending and the frame is an IDR frame, wakes up the thread.
+        """
+        frame_type = nal_type(frame)
+        if self.skip_backlog and frame_type == NAL_SPS:
+            self.skip_backlog = False
+            for queue in self.output.subscribers:
+                queue.skip()
+        if self.pending is not None:
+            if frame_type == NAL_IDR:
+                self.switch_event.set()
+            return
+        if frame_type != NAL_SLICE:
+            return      # SPS, PPS and IDR: the P-frames after them see their backlog
+        if now is None:
+            now = time.monotonic_ns()
+        backlog = 0
+        for queue in self.output.subscribers:
+            if queue.depth > backlog:
+                backlog = queue.depth
+        latency = (now - captured) / 1e9 + backlog / self.profile.framerate
+        index = self.ladder.update(now / 1e9, latency)
+        if index is not None:
+            self.pending = index
+            if index > self.ladder.index:
+                # step down: don't wait for the end of the group of pictures
+                self.camera.request_key_frame()
+
+    def run(self):
+        """
+        This function applies the requested profiles at the keyframes until the
+        thread is stopped (the recording is started with start_recording by the
+        video server).
+        """
+        while True:
+            self.switch_event.wait()
+            if self.stop_event.is_set():
+                break
+            self.switch()
+
+    def switch(self, now=None):
+        """
+        Restarts the recording with the requested profile (now: monotonic ns).
+        """
+        index = self.pending
+        self.switch_event.clear()
+        if index is None:
+            return
+        start = time.monotonic()
+        old = self.profile
+        self.camera.stop_recording()
+        self.skip_backlog = index > self.ladder.index
+        self.ladder.switched(index, (now or time.monotonic_ns()) / 1e9)
+        self.start_recording()
+        self.pending = None
+        self.switches += 1
+        self.restart_time = time.monotonic() - start
+        profile = self.profile
+        print(f'Video profile {old.width}x{old.height}@{old.framerate} --> '
+              f'{profile.width}x{profile.height}@{profile.framerate} '
+              f'{profile.bitrate / 1e6:g} Mbit/s '
+              f'(latency {self.ladder.last_peak * 1000:.0f} ms)', flush=True)
+
+    def stop_thread(self, timeout=5):
+        """
+        Stops the thread (the recording isn't stopped).
+        """
+        self.stop_event.set()
+        self.switch_event.set()
+        self.join(timeout)
+
+    def stats(self):
+        """
+        Returns the statistics of the adapter as dictionary.
+        """
+        profile = self.profile
+        return {
+            'profile': self.ladder.index,
+            'width': profile.width,
+            'height': profile.height,
+            'framerate': profile.framerate,
+            'bitrate': profile.bitrate,
+            'latency': self.ladder.last_peak,
+            'switches': self.switches,
+            'restart_time': self.restart_time,
+        }
+#endregion
@@ -0,0 +1,402 @@
+"""
+Video subsystem in a separate process (config.VIDEO_PROCESS).
+
+The camera thread, StreamingOutput, the broadcast and the HTTP/websocket servers
+share the GIL with the control loop, if they run in the server process: a large
+frame fan-out can delay a control packet by milliseconds. With VIDEO_PROCESS they
+run in a child process (multiprocessing, spawn), pinned to VIDEO_PROCESS_CPUS,
+and the control/telemetry loop keeps the server process (pinned to
+CONTROL_PROCESS_CPUS).
+
+The processes share a status block (SharedStatus, shared memory without locks):
+
+    telemetry   newest telemetry sample (control --> video process, for the
+                browser clients on the websocket path /telemetry)
+    video       state, heartbeat, published frames, clients and profile of the
+                video process (video --> control process)
+    metrics     metrics of the control process in the Prometheus text format
+                (control --> video process, served on /metrics with the video
+                metrics)
+
+Every region has one writer and a sequence number (seqlock): odd while the
+writer updates the region, the reader retries, if the sequence number is odd or
+changed while reading. So neither process waits for the other. The writes into
+the shared memory have no memory barriers: on a weakly ordered CPU (ARM) the
+reader can see the new sequence number with old or partly written values. So the
+writer stores a CRC32 of the values with the sequence number and the reader
+retries as well, if the CRC doesn't match (a torn read is detected, not
+prevented).
+"""
+import asyncio
+import ctypes
+import multiprocessing
+import os
+import signal
+import struct
+import time
+import zlib
+
+import config
+import metrics
+
+# states of the video process
+STARTING = 0
+RUNNING = 1
+STOPPED = 2
+FAILED = 3
+
+POLL_INTERVAL = 0.05        # s, telemetry poll and heartbeat of the video process
+METRICS_INTERVAL = 1.0      # s, metrics of the control process --> shared status
+METRICS_SIZE = 65536        # max. size of the metrics text of the control process
+START_TIMEOUT = 30.0        # s, max. startup time of the video process
+STOP_TIMEOUT = 10.0         # s, then the video process is killed
+
+_SEQ = struct.Struct('<QI4x')                # sequence number, CRC32 of the values
+_TELEMETRY = struct.Struct('<8d')       # TelemetryData without TIMESTAMP
+_VIDEO = struct.Struct('<qqqqq')        # state, heartbeat (ns), frames, clients, profile
+_LENGTH = struct.Struct('<I')           # length of the metrics text
+
+TELEMETRY_OFFSET = 0
+VIDEO_OFFSET = TELEMETRY_OFFSET + _SEQ.size + _TELEMETRY.size
+METRICS_OFFSET = VIDEO_OFFSET + _SEQ.size + _VIDEO.size
+SHARED_SIZE = METRICS_OFFSET + _SEQ.size + _LENGTH.size + METRICS_SIZE
+
+
+def pin_process(cpus):
+    """
+    Pins the calling process (and its threads started later) to the cpus
+    (iterable of cpu numbers, empty/None: no pinning). Cpus, which don't exist, are
+    ignored.
+    """
+    if not cpus or not hasattr(os, 'sched_setaffinity'):
+        return
+    cpus = set(cpus) & set(range(os.cpu_count() or 1))
+    if not cpus:
+        print('CPU pinning skipped: none of the cpus exists', flush=True)
+        return
+    try:
+        os.sched_setaffinity(0, cpus)
+    except OSError as e:
+        print(f'CPU pinning failed: {e}', flush=True)
+
+
+#region SharedStatus
+class SharedStatus(object):
+    """
+    Status block in shared memory (see module docstring). Created by the control
+    process, the buffer is passed to the video process.
+    """
+    def __init__(self, buffer=None):
+        """
+        Constructor: buffer is the shared memory of the control process
+        (multiprocessing RawArray, None: a new one is created).
+        """
+        if buffer is None:
+            buffer = multiprocessing.get_context('spawn').RawArray(ctypes.c_ubyte, SHARED_SIZE)
+        self.buffer = buffer
+        self.view = memoryview(buffer).cast('B')
+        self.torn = 0               # reads, which gave up (writer didn't finish)
+
+    def write(self, offset, layout, *values):
+        """
+        Writes the values of a region (single writer): sequence number odd -->
+        values --> sequence number even with the CRC of the values.
+        """
+        self.write_data(offset, layout.pack(*values))
+
+    def write_data(self, offset, data):
+        """
+        Writes the bytes of a region (see write).
+        """
+        view = self.view
+        seq = _SEQ.unpack_from(view, offset)[0] + 1
+        _SEQ.pack_into(view, offset, seq, 0)
+        start = offset + _SEQ.size
+        view[start:start + len(data)] = data
+        _SEQ.pack_into(view, offset, seq + 1, zlib.crc32(data))
+
+    def read_data(self, offset, size, retries=100):
+        """
+        Returns the tuple (sequence number, bytes) of a region or None, if the
+        writer didn't finish within the retries. size is the size of the data or a
+        function, which returns it from the data read so far (a view).
+        """
+        view = self.view
+        start = offset + _SEQ.size
+        for _ in range(retries):
+            seq, crc = _SEQ.unpack_from(view, offset)
+            if seq == 0:
+                return 0, None      # never written
+            if seq & 1:
+                continue
+            length = size if isinstance(size, int) else size(view[start:])
+            data = bytes(view[start:start + length])
+            if _SEQ.unpack_from(view, offset) == (seq, crc) and zlib.crc32(data) == crc:
+                return seq, data
+        self.torn += 1
+        return None
+
+    def read(self, offset, layout, retries=100):
+        """
+        Returns the tuple (sequence number, values) of a region or None, if the
+        writer didn't finish within the retries (values are zeros, if the region
+        wasn't written yet).
+        """
+        result = self.read_data(offset, layout.size, retries)
+        if result is None:
+            return None
+        seq, data = result
+        if data is None:
+            return 0, layout.unpack(bytes(layout.size))
+        return seq, layout.unpack(data)
+
+    def publish(self, floats):
+        """
+        This method sets the newest telemetry values (tuple of 8 floats, control
+        process; the interface of TelemetryChannel).
+        """
+        self.write(TELEMETRY_OFFSET, _TELEMETRY, *floats)
+
+    def telemetry(self):
+        """
+        Returns the tuple (sequence number, telemetry floats) or None (no sample
+        yet or torn read).
+        """
+        result = self.read(TELEMETRY_OFFSET, _TELEMETRY)
+        if result is None or result[0] == 0:
+            return None
+        return result
+
+    def set_video(self, state, frames=0, clients=0, profile=-1):
+        """
+        Sets the status of the video process (with the heartbeat: now).
+        """
+        self.write(VIDEO_OFFSET, _VIDEO, state, time.monotonic_ns(), frames, clients,
+                   profile)
+
+    def video(self):
+        """
+        Returns the tuple (state, heartbeat, frames, clients, profile) of the video
+        process or None (torn read).
+        """
+        result = self.read(VIDEO_OFFSET, _VIDEO)
+        return None if result is None else result[1]
+
+    def set_metrics(self, text):
+        """
+        Sets the metrics text (bytes) of the control process (truncated to
+        METRICS_SIZE at a line end).
+        """
+        if len(text) > METRICS_SIZE:
+            text = text[:text.rindex(b'\n', 0, METRICS_SIZE) + 1]
+        self.write_data(METRICS_OFFSET, _LENGTH.pack(len(text)) + text)
+
+    def metrics(self):
+        """
+        Returns the metrics text of the control process (bytes, empty if torn).
+        """
+        def size(view):
+            return _LENGTH.size + min(_LENGTH.unpack_from(view)[0], METRICS_SIZE)
+
+        result = self.read_data(METRICS_OFFSET, size)
+        if result is None or result[1] is None:
+            return b''
+        return result[1][_LENGTH.size:]
+
+    def stats(self):
+        """
+        Returns the status of the video process as dictionary (control process,
+        heartbeat: seconds since the last update).
+        """
+        video = self.video()
+        if video is None:
+            return {'torn': self.torn}
+        state, heartbeat, frames, clients, profile = video
+        return {
+            'state': state,
+            'heartbeat': (time.monotonic_ns() - heartbeat) / 1e9 if heartbeat else 0.0,
+            'frames': frames,
+            'clients': clients,
+            'profile': profile,
+            'torn': self.torn,
+        }
+#endregion
+
+#region VideoProcess
+class VideoProcess(object):
+    """
+    Runs the video subsystem (camera, StreamingOutput, video server) in a child
+    process. Has the interface of the video servers (start, stop), the telemetry
+    for the browser clients is published into status (see SharedStatus.publish).
+    """
+    def __init__(self, source=None, mode=None, adaptation=None, cpus=None):
+        """
+        Constructor: source is the camera source (default: config.CAMERA_SOURCE),
+        mode the video server (default: config.SERVER_MODE), adaptation see
+        create_video_server, cpus the cpus of the video process (default:
+        config.VIDEO_PROCESS_CPUS).
+        """
+        self.status = SharedStatus()
+        self.cpus = config.VIDEO_PROCESS_CPUS if cpus is None else cpus
+        self.process = multiprocessing.get_context('spawn').Process(
+            target=run_video_process,
+            args=(self.status.buffer, source, mode, adaptation, self.cpus),
+            name='video', daemon=True)
+        self.metrics_task = None
+
+    async def start(self, timeout=START_TIMEOUT):
+        """
+        Starts the video process and waits until its video server runs. The video
+        histogram is served by the video process, the metrics of this process are
+        passed to it every METRICS_INTERVAL. Raises RuntimeError, if the video
+        process fails or doesn't start within the timeout.
+        """
+        print('Starting video process', flush=True)
+        if metrics.VIDEO_BROADCAST in metrics.HISTOGRAMS:
+            metrics.HISTOGRAMS.remove(metrics.VIDEO_BROADCAST)
+        metrics.register_stats('video_process', self.status.stats)
+        self.process.start()
+        pin_process(config.CONTROL_PROCESS_CPUS)
+
+        loop = asyncio.get_running_loop()
+        end = loop.time() + timeout
+        while True:
+            video = self.status.video()
+            state = video[0] if video is not None else STARTING
+            if state == RUNNING:
+                break
+            if state != STARTING or not self.process.is_alive():
+                raise RuntimeError(f'Video process failed (exitcode {self.process.exitcode})')
+            if loop.time() > end:
+                raise RuntimeError('Video process not started within %g s' % timeout)
+            await asyncio.sleep(0.01)
+        self.metrics_task = asyncio.create_task(self.publish_metrics())
+        metrics.STARTUP.mark('video')
+
+    async def publish_metrics(self):
+        """
+        Passes the metrics of this process to the video process and reports, if the
+        video process exited (the control path keeps running).
+        """
+        alive = True
+        while True:
+            self.status.set_metrics(metrics.render())
+            if alive and not self.process.is_alive():
+                alive = False
+                print(f'Video process exited (exitcode {self.process.exitcode})', flush=True)
+            await asyncio.sleep(METRICS_INTERVAL)
+
+    async def stop(self):
+        """
+        Stops the video process (SIGTERM: it stops the recording and the video
+        server) and waits for it (killed after STOP_TIMEOUT).
+        """
+        if self.metrics_task is not None:
+            self.metrics_task.cancel()
+        if self.process.is_alive():
+            print('Stopping video process', flush=True)
+            self.process.terminate()
+            await asyncio.get_running_loop().run_in_executor(None, self.process.join,
+                                                             STOP_TIMEOUT)
+            if self.process.is_alive():
+                print('Video process not stopped: killed', flush=True)
+                self.process.kill()
+                self.process.join()
+        print(f'Video process closed (exitcode {self.process.exitcode})', flush=True)
+#endregion
+
+#region video process
+def run_video_process(buffer, source=None, mode=None, adaptation=None, cpus=None):
+    """
+    Main function of the video process: pins the process and runs the video
+    subsystem until SIGTERM/SIGINT or until the control process exits.
+    """
+    pin_process(cpus)
+    status = SharedStatus(buffer)
+    try:
+        asyncio.run(video_main(status, source, mode, adaptation))
+    except BaseException:
+        status.set_video(FAILED)
+        raise
+
+
+async def video_main(status, source=None, mode=None, adaptation=None):
+    """
+    Starts the camera and the video server, then passes the telemetry from the
+    shared status to the browser clients and updates the status of the video
+    process every POLL_INTERVAL.
+    """
+    # the server module is only needed in the video process (it imports this module)
+    from output import StreamingOutput
+    from server import init_camera
+    from telemetrystream import TelemetryChannel
+    from videoserver import create_video_server
+
+    status.set_video(STARTING)
+    parent = os.getppid()
+
+    # this process only records the video histogram, the metrics of the control
+    # process are appended from the shared status
+    metrics.HISTOGRAMS[:] = [metrics.VIDEO_BROADCAST]
+    metrics.COUNTERS[:] = []
+    metrics.REMOTE.append(status.metrics)
+
+    loop = asyncio.get_running_loop()
+    stop_event = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stop_event.set)
+    loop.add_signal_handler(signal.SIGINT, stop_event.set)
+
+    camera = await init_camera(source)
+    output = StreamingOutput(config.KEYFRAME_CACHE_SIZE)
+    telemetry_channel = TelemetryChannel()
+    video_server = create_video_server(camera, output, mode, telemetry_channel, adaptation)
+    await video_server.start()
+
+    telemetry_seq = 0
+    while not stop_event.is_set():
+        telemetry = status.telemetry()
+        if telemetry is not None and telemetry[0] != telemetry_seq:
+            telemetry_seq, floats = telemetry
+            telemetry_channel.publish(floats)
+        adapter = output.adapter
+        status.set_video(RUNNING, metrics.VIDEO_BROADCAST.count, len(output.subscribers),
+                         adapter.ladder.index if adapter is not None else -1)
+        if os.getppid() != parent:
+            print('Control process exited: stopping video process', flush=True)
+            break
+        try:
+            await asyncio.wait_for(stop_event.wait(), POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+    await video_server.stop()
+    status.set_video(STOPPED, metrics.VIDEO_BROADCAST.count)
+#endregion
+
+
+if __name__ == "__main__":
+    '''
+    Testprogramm for the shared status: a writer process updates the telemetry
+    region continuously, the reader must never get a torn sample (all 8 values
+    equal).
+    '''
+    def writer(buffer, count):
+        status = SharedStatus(buffer)
+        for i in range(1, count + 1):
+            status.publish((float(i),) * 8)
+
+    status = SharedStatus()
+    status.set_metrics(b'test_metric 1\n')
+    assert status.metrics() == b'test_metric 1\n'
+    process = multiprocessing.get_context('fork').Process(target=writer,
+                                                          args=(status.buffer, 200000))
+    process.start()
+    reads = 0
+    while process.is_alive():
+        telemetry = status.telemetry()
+        if telemetry is not None:
+            reads += 1
+            assert len(set(telemetry[1])) == 1, telemetry
+    process.join()
+    assert status.telemetry()[1] == (200000.0,) * 8
+    print(f'{reads} consistent reads, {status.torn} torn')
@@ -0,0 +1,201 @@
+import asyncio
+import config
+import metrics
+import time
+
+from threading import Thread
+
+from async_http_server import AsyncHttpServer, AsyncWebSocketServer
+from videoadaptation import VideoAdapter
+
+#region AsyncVideoServer
+class AsyncVideoServer(object):
+    """
+    Video subsystem on the event loop of the control loop: HTTP server, websocket
+    server and the frame handover run as tasks/callbacks of one loop. The camera
+    thread hands every frame over with loop.call_soon_threadsafe (no broadcast
+    thread, no condition variable).
+    """
+    def __init__(self, camera, output, telemetry=None, adapter=None):
+        """
+        Constructor: params are the camera object, streamoutput, the telemetry
+        channel for the browser clients (optional) and the VideoAdapter (optional)
+        """
+        self.camera = camera
+        self.output = output
+        self.adapter = adapter
+        self.http_server = AsyncHttpServer()
+        self.websocket_server = AsyncWebSocketServer(output, telemetry)
+
+    async def start(self):
+        """
+        Starts the servers and the camera recording.
+        """
+        loop = asyncio.get_running_loop()
+
+        def frame_callback(frame):
+            # camera thread: copy the frame once, if it is a view of the ring 
+            # buffer (a slice written as bytes isn't copied), and hand it over 
+            # to the event loop
+            loop.call_soon_threadsafe(self.publish, bytes(frame), time.monotonic_ns())
+
+        print('Initializing websockets server on port %d' % config.WS_PORT, flush=True)
+        await self.websocket_server.start()
+        print('Initializing HTTP server on port %d' % config.HTTP_PORT, flush=True)
+        await self.http_server.start()
+
+        print('Starting recording', flush=True)
+        self.output.frame_callback = frame_callback
+        if self.adapter is not None:
+            self.adapter.start_recording()
+            self.adapter.start()
+        else:
+            self.camera.start_recording(self.output, 'h264', profile="baseline")
+
+    def publish(self, frame, captured):
+        """
+        This method puts the frame into the send queues of the clients (event loop).
+        """
+        with self.output.condition:
+            self.output.publish(frame, captured)
+
+    async def stop(self):
+        """
+        Stops the camera recording and the servers. The adapter thread is joined 
+        and the recording is stopped (blocks, while the encoder flushes) in the 
+        executor, the control path shares the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        if self.adapter is not None:
+            await loop.run_in_executor(None, self.adapter.stop_thread)
+        print('Stopping recording', flush=True)
+        await loop.run_in_executor(None, self.camera.stop_recording)
+        self.output.frame_callback = None
+        print('Shutting down HTTP server', flush=True)
+        await self.http_server.close()
+        print('Shutting down websockets server', flush=True)
+        await self.websocket_server.close()
+#endregion
+
+#region ThreadedVideoServer
+class ThreadedVideoServer(object):
+    """
+    Video subsystem with threads: ws4py websocket server thread, HTTP server thread
+    and broadcast thread (the camera frames are handed over with a condition
+    variable).
+    """
+    def __init__(self, camera, output, telemetry=None, adapter=None):
+        """
+        Constructor: params are the camera object, streamoutput, the telemetry
+        channel for the browser clients (optional) and the VideoAdapter (optional)
+        """
+        # ws4py is only needed for the threaded server
+        from wsgiref.simple_server import make_server
+        from ws4py.server.wsgirefserver import (
+            WSGIServer,
+            WebSocketWSGIHandler,
+            WebSocketWSGIRequestHandler,
+        )
+        from ws4py.server.wsgiutils import WebSocketWSGIApplication
+
+        from broadcast import BroadcastThread
+        from http_server import (
+            StreamingHttpServer,
+            StreamingWebSocket,
+            TelemetryWebSocket,
+            WebSocketRouter,
+        )
+        from telemetrystream import TELEMETRY_PATH
+
+        self.camera = camera
+        self.adapter = adapter
+        StreamingWebSocket.output = output
+        TelemetryWebSocket.channel = telemetry
+        routes = {}
+        if telemetry is not None:
+            routes[TELEMETRY_PATH] = WebSocketWSGIApplication(handler_cls=TelemetryWebSocket)
+
+        #Websocket
+        print('Initializing websockets server on port %d' % config.WS_PORT, flush=True)
+        WebSocketWSGIHandler.http_version = '1.1'
+        self.websocket_server = make_server(
+                '', config.WS_PORT,
+                server_class=WSGIServer,
+                handler_class=WebSocketWSGIRequestHandler,
+                app=WebSocketRouter(WebSocketWSGIApplication(handler_cls=StreamingWebSocket),
+                                    routes))
+
+        self.websocket_server.initialize_websockets_manager()
+        self.websocket_thread = Thread(target=self.websocket_server.serve_forever)
+
+        #Http
+        print('Initializing HTTP server on port %d' % config.HTTP_PORT, flush=True)
+        self.http_server = StreamingHttpServer()
+        self.http_thread = Thread(target=self.http_server.serve_forever)
+
+        #Broadcast
+        print('Initializing broadcast thread', flush=True)
+        self.broadcast_thread = BroadcastThread(camera, output, adapter)
+
+    async def start(self):
+        """
+        Starts the threads.
+        """
+        print('Starting websockets thread', flush=True)
+        self.websocket_thread.start()
+        print('Starting HTTP server thread', flush=True)
+        self.http_thread.start()
+        print('Starting recording and broadcastasting thread', flush=True)
+        self.broadcast_thread.start()
+        if self.adapter is not None:
+            self.adapter.start()
+
+    async def stop(self):
+        """
+        Stops the threads (in an executor, the joins would block the event loop).
+        """
+        await asyncio.get_running_loop().run_in_executor(None, self.stop_threads)
+
+    def stop_threads(self):
+        """
+        Stops the broadcast thread first, then the camera recording and the servers.
+        """
+        if self.adapter is not None:
+            self.adapter.stop_thread()
+        print('Waiting for broadcast thread to finish', flush=True)
+        self.broadcast_thread.stop_thread()
+        print('Stopping recording', flush=True)
+        self.camera.stop_recording()
+
+        print('Shutting down HTTP server', flush=True)
+        self.http_server.shutdown()
+        print('Shutting down websockets server', flush=True)
+        self.websocket_server.server_close()
+        self.websocket_server.shutdown()
+
+        print('Waiting for HTTP server thread to finish', flush=True)
+        self.http_thread.join()
+        print('Waiting for websockets thread to finish', flush=True)
+        self.websocket_thread.join()
+#endregion
+
+def create_video_server(camera, output, mode=None, telemetry=None, adaptation=None):
+    """
+    Returns the video server for the mode ('asyncio' or 'threaded', default:
+    config.SERVER_MODE). telemetry is the TelemetryChannel for the browser clients. 
+    With adaptation (default: config.VIDEO_ADAPTATION) the video profile follows 
+    the latency of the clients (see VideoAdapter).
+    """
+    mode = mode or config.SERVER_MODE
+    if adaptation is None:
+        adaptation = config.VIDEO_ADAPTATION
+    adapter = None
+    if adaptation:
+        adapter = VideoAdapter(camera, output)
+        output.adapter = adapter
+        metrics.register_stats('video_adapter', adapter.stats)
+    if mode == 'asyncio':
+        return AsyncVideoServer(camera, output, telemetry, adapter)
+    if mode == 'threaded':
+        return ThreadedVideoServer(camera, output, telemetry, adapter)
+    raise ValueError(f'Unknown server mode: {mode}')